@@ -0,0 +1,104 @@
+#!/usr/bin/env python2
+
+################################################################################
+## This script measures the compression of the compact data files.
+## Copyright (C) 2014  Rachel Simone Domagalski: domagalski@berkeley.edu
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## ## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pocketcorr as pc
+
+if __name__ == '__main__':
+    # Parse command-line options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rpoco', default='rpoco8',
+                        help='Pocket correlator model (default: rpoco8).')
+    parser.add_argument('-c', '--calfile',
+                        default='psa898_v003',
+                        help='Antenna calibration file (default: psa898_v003).')
+    parser.add_argument('-n', '--num-integs', type=int, default=256,
+                        help='Number of integrations to write.')
+    parser.add_argument('-j', '--journal',
+                        help=' '.join(['Raw journal to take the integrations',
+                                       'from instead of simulated data.']))
+    parser.add_argument('-l', '--levels', default='0,1,6',
+                        help=' '.join(['Comma separated zlib levels to try',
+                                       '(default: 0,1,6).']))
+    args = parser.parse_args()
+
+    # Compact files are written from the raw BRAM data, whether it is
+    # simulated or taken from a journal.
+    roach = pc.FakeROACH('')
+    if args.journal is None:
+        roach.get_model(args.rpoco)
+        roach.set_attributes(args.calfile, 200e6, 2)
+        roach.start_bof()
+        plan = roach.plan
+        stream = []
+        for i in range(args.num_integs):
+            raw = roach.new_raw_buffer(plan)
+            roach.read_raw(plan, raw)
+            stream.append(raw)
+    else:
+        header, records = pc.read_journal(args.journal)
+        roach.get_model(header['poco'])
+        roach.set_attributes(header['calfile'],
+                             header['samp_rate'],
+                             header['nyquist'])
+        roach.start_bof(header['acc_len'])
+        roach.set_channel_range(*header['chan_range'])
+        antennas = sorted(set(sum(header['baselines'], ())))
+        plan = roach.compile_plan(antennas)
+        stream = list(records['payload'][:args.num_integs])
+    jd_start = pc.get_jul_date()
+
+    # Size that the data takes as complex64 visibilities and int flags.
+    nintegs = len(stream)
+    nbytes = float(nintegs * roach.new_vis_buffer(plan).nbytes)
+    uv_nbytes = nbytes + nbytes / 8 * np.dtype(np.int).itemsize
+
+    writedir = tempfile.mkdtemp()
+    try:
+        for level in map(int, args.levels.split(',')):
+            for delta in [False, True]:
+                roach.set_compression(level, delta)
+                roach.set_filename(os.path.join(writedir, 'poco'))
+                writer = pc.CompactWriter(roach, plan)
+
+                tstart = time.time()
+                writer.open()
+                for i, raw in enumerate(stream):
+                    writer.write(jd_start + i * roach.int_time / 86400., raw)
+                writer.close()
+                encode_time = time.time() - tstart
+
+                filename = os.path.join(writedir, os.listdir(writedir)[0])
+                tstart = time.time()
+                pc.read_compact(filename)
+                decode_time = time.time() - tstart
+                ratio = uv_nbytes / os.path.getsize(filename)
+                os.remove(filename)
+
+                print 'level %d, delta %-5s:' % (level, delta),
+                print 'ratio %.2f,' % ratio,
+                print 'encode %.1f MiB/s,' % (nbytes / encode_time / (1 << 20)),
+                print 'decode %.1f MiB/s' % (nbytes / decode_time / (1 << 20))
+    finally:
+        shutil.rmtree(writedir)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python2
+
+################################################################################
+## This script compares the speed of the LST lookups for the UV files.
+## Copyright (C) 2014  Rachel Simone Domagalski: domagalski@berkeley.edu
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## ## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+import time
+import aipy
+import argparse
+import numpy as np
+import pocketcorr as pc
+
+if __name__ == '__main__':
+    # Parse command-line options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--calfile',
+                        default='psa898_v003',
+                        help='Antenna calibration file (default: psa898_v003).')
+    parser.add_argument('-n', '--num-lookups', type=int, default=10000,
+                        help='Number of LST lookups.')
+    parser.add_argument('-A', '--int-time', type=float, default=10.,
+                        help='Time between lookups in seconds.')
+    args = parser.parse_args()
+
+    # The frequency setup doesn't matter for the LST.
+    aa = aipy.cal.get_aa(args.calfile, 0.0001, 0.1, 1024)
+    lst_cache = pc.LstCache(aa)
+    jd_start = pc.get_jul_date()
+    jd_list = [jd_start + i * args.int_time / 86400.
+               for i in range(args.num_lookups)]
+
+    # LST computed by the antenna array for every lookup.
+    tstart = time.time()
+    exact_lst = [lst_cache.get_exact_lst(jd) for jd in jd_list]
+    exact_time = time.time() - tstart
+
+    # LST interpolated from the cache.
+    tstart = time.time()
+    fast_lst = [lst_cache.get_lst(jd) for jd in jd_list]
+    fast_time = time.time() - tstart
+
+    # Difference between the two in seconds of time
+    lst_diff = np.angle(np.exp(1j * (np.array(fast_lst) - exact_lst)))
+    max_error = np.max(np.abs(lst_diff)) * 86400 / (2 * np.pi)
+
+    nlookups = float(args.num_lookups)
+    print 'aipy LST time:', exact_time / nlookups * 1e6, 'us'
+    print 'Cached LST time:', fast_time / nlookups * 1e6, 'us',
+    print '(' + str(lst_cache.refreshes), 'refreshes)'
+    print 'Cached LST speedup:', exact_time / fast_time
+    print 'Maximum LST error:', max_error, 's'
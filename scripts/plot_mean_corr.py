@@ -26,10 +26,82 @@ import numpy as np
 import pocketcorr as pc
 import matplotlib.pyplot as plt
 
+def new_figure(frequency, title, plot_all=False, log=False):
+    """
+    Make the figure of the mean correlation and return its lines.
+    """
+    figure_size = (15,8)
+    if plot_all:
+        f, axes = plt.subplots(3, 1, sharex=True, figsize=figure_size)
+        lines = []
+        for ax, label in zip(axes, ['real', 'imag', 'abs']):
+            lines.append(ax.plot(frequency, np.zeros(len(frequency)), 'b')[0])
+            if log:
+                ax.set_yscale('log')
+            ax.set_ylabel(label)
+        f.subplots_adjust(hspace=0)
+        axes[-1].set_xlabel('Frequency (MHz)')
+        axes[0].set_title(title)
+    else:
+        plt.figure(figsize=figure_size)
+        lines = plt.plot(frequency, np.zeros(len(frequency)))
+        plt.xlabel('Frequency (MHz)')
+        plt.title(title)
+    plt.tight_layout()
+    return lines
+
+def set_spectrum(lines, mean_spec):
+    """
+    Show a mean correlation on the lines of the figure.
+    """
+    mean_spec_a = np.abs(mean_spec)
+    if len(lines) == 1:
+        spectra = [mean_spec_a]
+    else:
+        spectra = [mean_spec.real, mean_spec.imag, mean_spec_a]
+    for line, spectrum in zip(lines, spectra):
+        line.set_ydata(spectrum)
+        line.axes.relim()
+        line.axes.autoscale_view()
+
+def plot_live(args):
+    """
+    Plot the mean correlation of the integrations in a live export,
+    updating the plot as new integrations are published.
+    """
+    reader = pc.LiveReader(args.live)
+    header = reader.header
+    ant_i = pc.get_ant_index(header['poco'], args.ant_i)
+    ant_j = pc.get_ant_index(header['poco'], args.ant_j)
+    ant_i, ant_j = min(ant_i, ant_j), max(ant_i, ant_j)
+    baseline = header['baselines'].index((ant_i, ant_j))
+
+    sdf, sfreq, nchan = header['sdf'], header['sfreq'], header['nchan']
+    frequency = 1e3 * (sfreq + sdf * np.arange(nchan))
+    scale_factor = 1
+    if args.scale:
+        scale_factor = header['acc_len'] / header['fft_size']
+
+    plt.ion()
+    title = 'Mean correlation of antennas %s and %s' % (args.ant_i, args.ant_j)
+    lines = new_figure(frequency, title, args.plot_all, args.log)
+    count = 0
+    while plt.get_fignums():
+        new_count = reader.wait(count, timeout=0.5)
+        if new_count is not None:
+            count = new_count
+            jd, vis = reader.get_latest(reader.nslots)
+            if len(jd):
+                set_spectrum(lines, np.mean(vis[:, baseline], axis=0) /
+                             scale_factor)
+                if not args.quiet:
+                    print 'Integrations: %d, JD: %.5f' % (count, jd[-1])
+        plt.pause(0.01)
+
 if __name__ == '__main__':
     # Get options fromt the command line
     parser = argparse.ArgumentParser()
-    parser.add_argument('infiles', nargs='+', help='Input uv files.')
+    parser.add_argument('infiles', nargs='*', help='Input uv files.')
     parser.add_argument('-i',
                         dest='ant_i',
                         required=True,
@@ -40,6 +112,11 @@ if __name__ == '__main__':
                         required=True,
                         metavar='num',
                         help='Antenna j to use.')
+    parser.add_argument('--live',
+                        metavar='NAME',
+                        help=' '.join(['Plot the integrations that',
+                                       'pocketcorr_rx.py publishes under NAME',
+                                       'as they come in.']))
     parser.add_argument('-l', '--log',
                         action='store_true',
                         dest='log',
@@ -55,6 +132,11 @@ if __name__ == '__main__':
                         help=' '.join(['Scale the output by number of spectra',
                                        'per integration.']))
     args = parser.parse_args()
+    if args.live is not None:
+        plot_live(args)
+        sys.exit()
+    if not args.infiles:
+        parser.error('Input uv files are needed without --live.')
 
     # Get the antenna numbers
     model = pc.get_model_uv(args.infiles)
@@ -93,29 +175,13 @@ if __name__ == '__main__':
             scale_factor = acclen / fft_size
         mean_spec_r /= scale_factor
         mean_spec_i /= scale_factor
-    mean_spec_a = np.sqrt(mean_spec_r**2 + mean_spec_i**2)
+    mean_spec = mean_spec_r + 1j * mean_spec_i
 
     # The reference UV file is no longer needed.
     del uv
 
     # Plot the spectrum
-    figure_size = (15,8)
     title = 'Mean correlation of antennas %s and %s' % (args.ant_i, args.ant_j)
-    if args.plot_all:
-        f, axes = plt.subplots(3, 1, sharex=True, figsize=figure_size)
-        for mean_spec, title, ax, in zip([mean_spec_r, mean_spec_i, mean_spec_a],
-                                         ['real', 'imag', 'abs'], axes):
-            ax.plot(frequency, mean_spec, 'b')
-            if args.log:
-                ax.set_yscale('log')
-            ax.set_ylabel(title)
-        f.subplots_adjust(hspace=0)
-        axes[-1].set_xlabel('Frequency (MHz)')
-        axes[0].set_title(title)
-    else:
-        plt.figure(figsize=figure_size)
-        plt.plot(frequency, mean_spec_a)
-        plt.xlabel('Frequency (MHz)')
-        plt.title(title)
-    plt.tight_layout()
+    lines = new_figure(frequency, title, args.plot_all, args.log)
+    set_spectrum(lines, mean_spec)
     plt.show()
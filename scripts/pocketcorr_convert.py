@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+
+################################################################################
+## This script converts raw journals from the pocket correlator to data files.
+## Copyright (C) 2014  Rachel Simone Domagalski: domagalski@berkeley.edu
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## ## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+import os
+import sys
+import argparse
+import functools
+import multiprocessing as mp
+import pocketcorr as pc
+
+def convert(journal, fmt, delete):
+    """
+    Convert one journal and return the name of the converted file.
+    """
+    outfile = pc.convert_journal(journal, fmt)
+    if delete:
+        os.remove(journal)
+    return outfile
+
+if __name__ == '__main__':
+    # Parse command-line options
+    formats = sorted([fmt for fmt in pc.WRITERS if fmt != 'journal'])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('journals', nargs='+',
+                        help='Raw journals to convert.')
+    parser.add_argument('--format',
+                        choices=formats,
+                        default='miriad',
+                        help=' '.join(['Format of the data files. Defaults to',
+                                       'Miriad UV files.']))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of journals to convert in parallel.')
+    parser.add_argument('--delete', action='store_true',
+                        help='Delete the journals once they are converted.')
+    args = parser.parse_args()
+
+    convert_one = functools.partial(convert, fmt=args.format,
+                                    delete=args.delete)
+    if args.jobs > 1:
+        pool = mp.Pool(args.jobs)
+        outfiles = pool.imap(convert_one, args.journals)
+    else:
+        outfiles = map(convert_one, args.journals)
+
+    for journal, outfile in zip(args.journals, outfiles):
+        print journal, '->', outfile
+        sys.stdout.flush()
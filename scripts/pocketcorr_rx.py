@@ -18,9 +18,12 @@
 ################################################################################
 
 import os
+import ast
 import glob
 import time
 import socket
+import struct
+import Queue
 import argparse
 import threading
 import pocketcorr
@@ -53,6 +56,18 @@ class bcolors:
 
 CLIENT_PROMPT = bcolors.OKBLUE + 'poco> ' + bcolors.ENDC
 
+# Readout messages start with their type and the length of what follows. The
+# data of the files is sent in frames of up to MSG_MAX_FRAME bytes.
+MSG_FORMAT    = '<cI'
+MSG_SIZE      = struct.calcsize(MSG_FORMAT)
+MSG_MAX_FRAME = 1 << 30
+
+# A readout uses at most MAX_STREAMS TCP connections, which have to connect
+# within READOUT_TIMEOUT seconds. MAX_STREAMS is the same as in
+# pocketcorr_shell.py.
+MAX_STREAMS     = 16
+READOUT_TIMEOUT = 60
+
 def collect_data(roach, args, manager=None):
     """
     Open a UV file and read data into it.
@@ -60,14 +75,14 @@ def collect_data(roach, args, manager=None):
     if manager is not None:
         manager['writing'] = True
     if args.channels is None:
-        roach.retrieve_data()
+        roach.retrieve_data(None, args.ring_size, args.ring_block)
     else:
         channels = args.channels.split(',')
         if roach.model == 1:
             channels = map(int, channels)
 
 
-        roach.retrieve_data(channels)
+        roach.retrieve_data(channels, args.ring_size, args.ring_block)
 
     if manager is not None:
         manager['writing'] = False
@@ -84,7 +99,7 @@ def ctrl_help():
     helpstr += '\n\tfft_shift <shift>   Set the FFT shifting stages'
     helpstr += '\n\tinsel <selector>    Select the input sources'
     helpstr += '\n\thelp                Show this help message'
-    helpstr += '\n\treadout             Copy data from server to client'
+    helpstr += '\n\treadout [dir] [n]   Copy data to the client over n streams'
     helpstr += '\n\tstatus              Get the correlator status'
     helpstr += '\n\tstart               Start writing data to disk'
     helpstr += '\n\tstop                Stop writing data to disk'
@@ -115,6 +130,7 @@ def ctrl_poco(lock, queue, pipe, manager):
 
     # Create a shell
     server = True
+    readout = None
     netcat_shell = False
     netcat_prompt = '\n' + CLIENT_PROMPT
     while server:
@@ -164,13 +180,22 @@ def ctrl_poco(lock, queue, pipe, manager):
                 message = 'ERROR: use pocketcorr_shell.py for readout.'
                 message += netcat_prompt
                 messenger.sendto(message, addr)
-            elif manager['writing']:
-                message = 'ERROR: Cannot readout data while writing.'
+            elif readout is not None and readout.is_alive():
+                message = 'ERROR: A readout is already running.'
+                messenger.sendto(message, addr)
+            elif len(data) > 2 and not (data[2].isdigit() and
+                                        0 < int(data[2]) <= MAX_STREAMS):
+                message = 'ERROR: Invalid number of streams: ' + data[2]
                 messenger.sendto(message, addr)
-            elif ctrl_readout(manager['data_dir'], messenger, addr, ctrl_port):
-                messenger.sendto('Error reading data from server.', addr)
             else:
-                messenger.sendto('Done.', addr)
+                # The readout runs alongside the commands, so that the
+                # correlator can still be controlled during a long readout.
+                nstreams = len(data) > 2 and int(data[2]) or 1
+                readout_args = (manager['data_dir'], messenger, addr,
+                                ctrl_port, nstreams, manager)
+                readout = threading.Thread(target=ctrl_readout,
+                                           args=readout_args)
+                readout.start()
             continue
 
         # Exit the server if a shutdown command is received.
@@ -217,38 +242,105 @@ def ctrl_poco(lock, queue, pipe, manager):
         messenger.sendto(message, addr)
 
 
-def ctrl_readout(data_dir, messenger, udp_addr, ctrl_port):
+def ctrl_readout(data_dir, messenger, udp_addr, ctrl_port, nstreams=1,
+                 manager=None):
     """
     This function uses TCP to copy data files from the server. The UDP
-    socket is used for messages and progress updates.
+    socket is used for messages and progress updates, and the client is
+    told whether the readout worked when it is done.
+
+    Only files that have been closed are read out. They get their names
+    from the writer when they are renamed, and they don't change after
+    that, so this can run while the correlator writes more data. The
+    files being written are never read out, and the readout is capped
+    at the readout rate in the manager while the correlator is writing.
 
     I did a quick test and it takes longer to compress an 87 MB uv file
     using tar on a raspberry pi than it does to scp the same file off of
-    a raspberry pi, so this function does not compress data before
-    reading the data over the network.
+    a raspberry pi, but that isn't true on faster servers or slower
+    links. Each connection measures the link when it starts, and each
+    file is compressed while it is sent only if that gets it to the
+    client faster.
+
+    The client gets the manifest of all of the files in one message on
+    the first connection and replies with the components of them that
+    it doesn't already have, with the checksums of the blocks of them
+    that it has, which is the only time that the server waits for the
+    client. The checksums of the data are computed as it is sent and
+    kept for the next readout. The files are then put on a queue that
+    is shared by
+    ``nstreams`` TCP connections, so that one slow file doesn't hold up
+    the rest, and sent back to back. The readout gives up if the client
+    doesn't make all of the connections within ``READOUT_TIMEOUT``
+    seconds.
     """
     # Set up the TCP file transfer machine
     filedump = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     filedump.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     filedump.bind(('', ctrl_port))
-    filedump.listen(1)
+    filedump.listen(nstreams)
+    filedump.settimeout(READOUT_TIMEOUT)
     messenger.sendto('Preparing data transfer.', udp_addr)
-    tcp_conn, tcp_addr = filedump.accept()
-
-    fnames = sorted(glob.glob(os.path.join(data_dir, '*.uv')))
+    streams = []
+    try:
+        for i in range(nstreams):
+            tcp_conn = filedump.accept()[0]
+            tcp_conn.settimeout(None)
+            streams.append(tcp_conn)
+    except socket.timeout:
+        for tcp_conn in streams:
+            tcp_conn.close()
+        messenger.sendto('Error reading data from server.', udp_addr)
+        return
+    finally:
+        filedump.close()
+
+    fnames = []
+    for ext in set([writer.ext for writer in pocketcorr.WRITERS.values()]):
+        fnames += glob.glob(os.path.join(data_dir, '*.' + ext))
+    fnames.sort()
+    manifest = pocketcorr.get_manifest(fnames)
+    fnames = [fname for fname in fnames
+              if os.path.basename(fname) in manifest]
+    try:
+        request = tcp_send_manifest(streams[0], fnames, manifest)
+    except (socket.error, SyntaxError, ValueError):
+        request = None
+    if request is None:
+        for tcp_conn in streams:
+            tcp_conn.close()
+        messenger.sendto('Error reading data from server.', udp_addr)
+        return
 
-    # Send information about how many files there are and receive ready signal
-    sendrecv(tcp_conn, 'nfiles = ' + str(len(fnames)))
+    file_queue = Queue.Queue()
+    for fname in fnames:
+        wanted = request['files'].get(os.path.basename(fname))
+        if wanted:
+            file_queue.put((fname, manifest[os.path.basename(fname)], wanted))
 
     # Time to dump the UV files to the client
-    for fname in fnames:
-        if tcp_send_uv(tcp_conn, fname):
-            tcp_conn.close()
-            filedump.close()
-            return 1
-    tcp_conn.close()
-    filedump.close()
-    return 0
+    errors = []
+    threads = []
+    cache_file = os.path.join(data_dir, pocketcorr.MANIFEST_FILE)
+    cache = pocketcorr.ChecksumCache(cache_file)
+    limiter = pocketcorr.RateLimiter(lambda: get_readout_cap(manager))
+    for tcp_conn in streams:
+        thread = threading.Thread(target=tcp_send_queue,
+                                  args=(tcp_conn, file_queue,
+                                        request['link_rate'], errors, cache,
+                                        limiter))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    try:
+        cache.save()
+    except (IOError, OSError):
+        pass
+    if errors:
+        messenger.sendto('Error reading data from server.', udp_addr)
+    else:
+        messenger.sendto('Done.', udp_addr)
 
 def get_acclen(acc_len, nspec, int_time, samp_rate=200):
     """
@@ -268,16 +360,6 @@ def get_acclen(acc_len, nspec, int_time, samp_rate=200):
     else:
         return default
 
-def get_filesize(filename):
-    """
-    Get the number of bytes in a file.
-    """
-    filedata = open(filename, 'rb')
-    filedata.seek(0, 2)
-    nbytes = filedata.tell()
-    filedata.close()
-    return nbytes
-
 def get_interface(args):
     """
     This function gets the proper correlator interface.
@@ -291,6 +373,15 @@ def get_interface(args):
         roach = pocketcorr.POCO(args.ip, args.port)
     return roach
 
+def get_readout_cap(manager):
+    """
+    Get the number of bytes per second that a readout is capped at. This
+    is 0, for no cap, unless the correlator is writing data.
+    """
+    if manager is None or not manager['writing']:
+        return 0
+    return manager['readout_cap']
+
 def get_status(manager):
     """
     Create a status message.
@@ -302,6 +393,37 @@ def get_status(manager):
         status = 'FPGA is not programmed.'
     return status
 
+def recv_all(tcpsocket, nbytes):
+    """
+    Receive a message of a known length, or None if the connection was
+    closed.
+    """
+    message = ''
+    while len(message) < nbytes:
+        data = tcpsocket.recv(nbytes - len(message))
+        if not data:
+            return None
+        message += data
+    return message
+
+def recv_msg(tcpsocket):
+    """
+    Receive a readout message.
+
+    Return:
+
+    - The type and contents of the message, or (None, None) if the \
+            connection was closed.
+    """
+    header = recv_all(tcpsocket, MSG_SIZE)
+    if header is None:
+        return None, None
+    kind, nbytes = struct.unpack(MSG_FORMAT, header)
+    message = recv_all(tcpsocket, nbytes)
+    if message is None:
+        return None, None
+    return kind, message
+
 def run_poco(args, connection=None, queue=None, manager=None):
     """
     This function sets up the correlator, runs it, and collects data.
@@ -329,7 +451,6 @@ def run_poco(args, connection=None, queue=None, manager=None):
             rx_loop(roach, args)
         except KeyboardInterrupt:
             print
-            roach.uv_close()
         finally:
             rx_cleanup(roach, args.keep_running)
 
@@ -472,8 +593,20 @@ def rx_setup_attr(roach, args):
     """
     roach.check_connected()
     roach.set_verbose(args.verbose)
+    roach.set_hw_time(args.hw_time)
+    roach.set_writer(args.format)
     roach.get_model(args.rpoco)
     roach.set_attributes(args.calfile, args.samp_rate*1e6, args.nyquist)
+    if args.chan_range is not None:
+        start, stop = map(int, args.chan_range.split(','))
+        roach.set_channel_range(start, stop)
+    if args.rotate is not None:
+        mode, value = args.rotate.split(',')
+        roach.set_rotation(mode, float(value))
+    roach.set_averaging(args.average)
+    roach.set_channel_binning(args.bin_channels)
+    roach.set_compression(args.compact_level, args.delta)
+    roach.set_live_export(args.live, args.live_slots)
     if args.filename is not None:
         roach.set_filename(args.filename)
 
@@ -499,12 +632,11 @@ def rx_setup_bof(roach, args):
     else:
         roach.poco_recall()
 
-def sendrecv(tcpsocket, message):
+def send_msg(tcpsocket, kind, message):
     """
-    Send a message and block until a reply exists.
+    Send a readout message.
     """
-    tcpsocket.send(message)
-    return tcpsocket.recv(1024)
+    tcpsocket.sendall(struct.pack(MSG_FORMAT, kind, len(message)) + message)
 
 def str2int(number):
     """
@@ -520,50 +652,168 @@ def str2int(number):
 
     return int(number, base)
 
-def tcp_send_uv(tcpsocket, filename):
-    """
-    Send a UV file with a TCP socket.
+def tcp_send_manifest(tcpsocket, fnames, manifest):
     """
-    # Send filename information
-    basename = os.path.basename(filename)
+    Send the manifest of the files in a readout and get the parts of
+    them that the client needs. The manifest is followed by filler data
+    that the client times the link with.
 
-    # Get status from the client to determine whether to send the file
-    cli_reply = sendrecv(tcpsocket, basename)
-    if cli_reply == 'skip':
-        return 0
-    elif cli_reply == 'quit':
-        return 1
+    Input:
 
-    # Send the components of the UV file to the client
-    fullpaths = sorted(glob.glob(os.path.join(filename, '*')))
-    uvdata = ' '.join(map(os.path.basename, fullpaths))
-    if sendrecv(tcpsocket, uvdata) == 'quit':
-        return 1
+    - ``tcpsocket``: Socket connected to the client.
+    - ``fnames``: List of the files to send.
+    - ``manifest``: Dictionary of the manifest of each file.
 
-    # Send each part of the UV file to the client
-    bufsize = 64 << 20 # Read 64 MiB at a time
-    uvsize = 4096 + sum(map(get_filesize, fullpaths))
-    if sendrecv(tcpsocket, 'uvsize = ' + str(uvsize)) == 'quit':
-        return 1
-    for path in fullpaths:
-        # Send the length of the file to the client
-        nbytes = get_filesize(path)
-        if sendrecv(tcpsocket, 'nbytes = ' + str(nbytes)) == 'quit':
-            return 1
+    Return:
 
-        # Quickly read and send the data to the client socket
-        nchunks = nbytes / bufsize + bool(nbytes % bufsize)
-        filedata = open(path, 'rb')
+    - Dictionary with the rate that the client got the filler at and \
+            the list of (component, checksums) of the components that it \
+            needs from each file, with the checksums of the blocks of them \
+            that it has, or None if the client doesn't reply.
+    """
+    filler = os.urandom(pocketcorr.TRANSFER_PROBE)
+    message = {'files': [os.path.basename(fname) for fname in fnames],
+               'manifest': manifest}
+    send_msg(tcpsocket, 'M', repr(message))
+    send_msg(tcpsocket, 'P', filler)
+    kind, request = recv_msg(tcpsocket)
+    if kind != 'R':
+        return None
+    return ast.literal_eval(request)
+
+def tcp_send_queue(tcpsocket, file_queue, link_rate, errors, cache,
+                   limiter=None):
+    """
+    Send UV files from a queue shared with other TCP streams until the
+    queue is empty or the transfer fails. The socket is closed when
+    this function is done with it, which tells the client that there
+    are no files left.
+
+    Input:
+
+    - ``tcpsocket``: Socket connected to the client.
+    - ``file_queue``: Queue of the files to send, with their manifests \
+            and the components of them that the client wants.
+    - ``link_rate``: Bytes per second that the client gets data at.
+    - ``errors``: List to append the name of a failed file to.
+    - ``cache``: ``ChecksumCache`` of the data directory.
+    - ``limiter``: ``RateLimiter`` shared with the other streams.
+    """
+    try:
+        while True:
+            try:
+                fname, manifest, wanted = file_queue.get_nowait()
+            except Queue.Empty:
+                break
+            if tcp_send_uv(tcpsocket, fname, manifest, wanted, link_rate,
+                           cache, limiter):
+                errors.append(fname)
+                break
+    except socket.error:
+        errors.append(None)
+    tcpsocket.close()
+
+def tcp_send_uv(tcpsocket, filename, manifest, wanted, link_rate, cache,
+                limiter=None):
+    """
+    Send a UV file with a TCP socket. Only the blocks of the components
+    that don't match the checksums of the client's copy are sent, with
+    the rest of each component after its copy ends. The file starts with
+    a message with its name, the zlib level that it is compressed with,
+    which is the level that gets a sample of it across the link in the
+    least time, if any, and the (component, offset, nbytes) ranges that
+    follow. Files aren't compressed while the readout is capped, to
+    leave the CPU to the correlator. Each range is sent in frames, each
+    after its length as a little endian uint32, and then a message with
+    the checksums of its blocks.
+
+    The checksums of a component are computed as it is read to be sent,
+    unless they are in the cache. Only the blocks that the client has
+    are read before the data is sent, to check them. The checksums go in
+    the cache once all of them are known.
+    """
+    block = manifest['block']
+    components = manifest['components']
+    paths = {}
+    checksums = {}
+    ranges = []
+    for index, local in wanted:
+        if not 0 <= index < len(components) or index in paths:
+            return 1
+        name, size, mtime = components[index]
+        path = name and os.path.join(filename, name) or filename
+        nblocks = (size + block - 1) / block
         try:
-            for i in range(nchunks):
-                chunk = filedata.read(bufsize)
-                tcpsocket.send(chunk)
-            filedata.close()
-
-            if tcpsocket.recv(1024) == 'quit':
+            stat = os.stat(path)
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
                 return 1
-        except socket.error:
+            known = cache.get(path, size, mtime)
+            if known is None:
+                known = local and pocketcorr.get_checksums(path, block,
+                                                           len(local)) or []
+        except (IOError, OSError):
+            return 1
+        paths[index] = path
+        checksums[index] = known + [None] * (nblocks - len(known))
+
+        # Adjacent blocks are sent as one range.
+        for i in range(nblocks):
+            if i < len(local) and local[i] == known[i]:
+                continue
+            nbytes = min(block, size - i*block)
+            if ranges and ranges[-1][:2] == (index, i*block - ranges[-1][2]):
+                ranges[-1] = (index, ranges[-1][1], ranges[-1][2] + nbytes)
+            else:
+                ranges.append((index, i*block, nbytes))
+
+    # Choose how to compress the file from the start of the largest range.
+    level = 0
+    if ranges and (limiter is None or not limiter.get_rate()):
+        largest = max(range(len(ranges)), key=lambda i: ranges[i][2])
+        index, offset, nbytes = ranges[largest]
+        try:
+            with open(paths[index], 'rb') as f:
+                f.seek(offset)
+                sample = f.read(min(nbytes, pocketcorr.TRANSFER_SAMPLE))
+        except IOError:
             return 1
+        level = pocketcorr.get_transfer_level(sample, link_rate)
+    send_msg(tcpsocket, 'F',
+             repr((os.path.basename(filename), level, ranges)))
+
+    # The kernel copies the data to the client socket when it can, which is
+    # when the checksums of the data are already known.
+    try:
+        for index, offset, nbytes in ranges:
+            path = paths[index]
+            first = offset / block
+            last = (offset + nbytes + block - 1) / block
+            sums = None
+            if None in checksums[index][first:last]:
+                sums = []
+            if level:
+                pocketcorr.send_file(tcpsocket, path, offset, nbytes,
+                                     level=level, limiter=limiter,
+                                     checksums=sums, block=block)
+            else:
+                for start in range(offset, offset + nbytes, MSG_MAX_FRAME):
+                    count = min(MSG_MAX_FRAME, offset + nbytes - start)
+                    tcpsocket.sendall(struct.pack('<I', count))
+                    pocketcorr.send_file(tcpsocket, path, start, count,
+                                         limiter=limiter, checksums=sums,
+                                         block=block)
+            if sums is not None:
+                checksums[index][first:last] = sums
+            sums = checksums[index][first:last]
+            send_msg(tcpsocket, 'C', struct.pack('<%dI' % len(sums), *sums))
+    except (IOError, OSError):
+        return 1
+
+    # Keep the checksums of the components that are all known.
+    for index, sums in checksums.items():
+        if None not in sums:
+            name, size, mtime = components[index]
+            cache.put(paths[index], size, mtime, sums)
 
     # Exit with success
     return 0
@@ -583,6 +833,22 @@ if __name__ == '__main__':
                                        'rpoco8_r2, rpoco16)']))
     parser.add_argument('-C', '--channels',
                         help='Comma separated list of antennas to get data from.')
+    parser.add_argument('--channels-range',
+                        dest='chan_range',
+                        metavar='START,STOP',
+                        help=' '.join(['Only read and save the frequency',
+                                       'channels from START up to (but not',
+                                       'including) STOP.']))
+    parser.add_argument('--compact-level',
+                        type=int,
+                        default=pocketcorr.COMPACT_LEVEL,
+                        help=' '.join(['zlib level of the compact data files,',
+                                       'from 0 (off) to 9 (default: %d).' %
+                                       pocketcorr.COMPACT_LEVEL]))
+    parser.add_argument('--delta', action='store_true',
+                        help=' '.join(['Store the differences between',
+                                       'integrations in the compact data',
+                                       'files instead of the integrations.']))
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Debugging mode (ROACH data is simulated).')
     parser.add_argument('--server', action='store_true',
@@ -602,6 +868,23 @@ if __name__ == '__main__':
                         help=' '.join(['Amount of time to run the correlator',
                                        'for. Format: U,time. Valid units:',
                                        'D (days), H (hours), M (minutes)']))
+    parser.add_argument('-a', '--average',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help=' '.join(['Average N consecutive integrations in',
+                                       'software before writing them',
+                                       '(default: 1). The last average of a',
+                                       'run can have fewer integrations, and',
+                                       'is written with their integration',
+                                       'time.']))
+    parser.add_argument('-b', '--bin-channels',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help=' '.join(['Average every N adjacent frequency',
+                                       'channels before writing them',
+                                       '(default: 1).']))
     parser.add_argument('-c', '--calfile',
                         default='psa898_v003',
                         help='Antenna calibration file (default: psa898_v003).')
@@ -609,10 +892,41 @@ if __name__ == '__main__':
                         action="store_true",
                         help=' '.join(['Force restarting the bof process if',
                                        'it is already running.']))
+    parser.add_argument('--format',
+                        choices=sorted(pocketcorr.WRITERS),
+                        default='miriad',
+                        help=' '.join(['Format of the data files. Defaults to',
+                                       'Miriad UV files. The journal format',
+                                       'saves the raw BRAM data, which is',
+                                       'converted to data files later with',
+                                       'pocketcorr_convert.py.']))
+    parser.add_argument('--hw-time', action='store_true',
+                        help=' '.join(['Timestamp integrations with the FPGA',
+                                       'clock and accumulation counters.']))
+    parser.add_argument('--rotate',
+                        metavar='MODE,VALUE',
+                        help=' '.join(['Start a new data file every VALUE',
+                                       'integrations, bytes, seconds or hours',
+                                       'of LST. MODE is one of',
+                                       ', '.join(pocketcorr.ROTATE_MODES),
+                                       '(default: integrations,%d).' %
+                                       pocketcorr.ROTATE_INTEGS]))
     parser.add_argument('-k', '--keep-running',
                         action="store_true",
                         help=' '.join(['Keep the pocket correlator bof process',
                                        'running after this script exits.']))
+    parser.add_argument('--live',
+                        metavar='NAME',
+                        help=' '.join(['Publish the latest integrations in',
+                                       'shared memory under NAME for live',
+                                       'monitors (see plot_mean_corr.py).']))
+    parser.add_argument('--live-slots',
+                        metavar='N',
+                        type=int,
+                        default=pocketcorr.LIVE_SLOTS,
+                        help=' '.join(['Number of integrations kept in the',
+                                       'live export (default: %d).' %
+                                       pocketcorr.LIVE_SLOTS]))
     parser.add_argument('-n', '--nyquist-zone',
                         dest='nyquist',
                         metavar='zone',
@@ -625,11 +939,32 @@ if __name__ == '__main__':
                         default=7147,
                         type=int,
                         help='Port to use with the ROACH katcp wrapper.')
+    parser.add_argument('--readout-cap',
+                        metavar='MIB',
+                        type=float,
+                        default=pocketcorr.READOUT_CAP / float(1 << 20),
+                        help=' '.join(['Cap in MiB/s on readouts that run',
+                                       'while data is being written, so they',
+                                       'don\'t starve the correlator (default:',
+                                       '%g, 0 for no cap).' %
+                                       (pocketcorr.READOUT_CAP / 2.**20)]))
     parser.add_argument('-S', '--samp-rate',
                         dest='samp_rate',
                         default=200,
                         type=float,
                         help='The ADC sample rate that is being used in MHz.')
+    parser.add_argument('-R', '--ring-size',
+                        type=int,
+                        default=0,
+                        help=' '.join(['Number of integration buffers between',
+                                       'the readout and writer threads. The',
+                                       'default (0) reads and writes each',
+                                       'integration in turn.']))
+    parser.add_argument('--ring-block', action='store_true',
+                        help=' '.join(['Make the readout wait when every',
+                                       'integration buffer is waiting to be',
+                                       'written, instead of dropping',
+                                       'integrations.']))
     parser.add_argument('--snap-synth', action='store_true',
                         help='Use the onboard synth (SNAP boards only).')
     parser.add_argument('-s', '--fft-shift',
@@ -681,6 +1016,7 @@ if __name__ == '__main__':
         manager['progbof'] = False
         manager['writing'] = False
         manager['data_dir'] = './'
+        manager['readout_cap'] = int(args.readout_cap * (1 << 20))
 
         # Start the control thread
         ctrl_args = (lock, srv_queue, cmd_pipe, manager)
@@ -18,15 +18,32 @@
 ################################################################################
 
 import os
+import ast
 import sys
 import time
 import socket
+import struct
 import argparse
+import threading
+import zlib
 
 POCO_PORT = 1420
 TCP_RECV_SIZE = 64 << 10
 UDP_RECV_SIZE = 1024
 
+# Checksums of the files that have been read out are kept in this file in the
+# readout directory. This is the same as pocketcorr.MANIFEST_FILE.
+MANIFEST_FILE = '.poco_manifest'
+
+# Readout messages start with their type and the length of what follows. This
+# is the same as in pocketcorr_rx.py.
+MSG_FORMAT = '<cI'
+MSG_SIZE   = struct.calcsize(MSG_FORMAT)
+
+# A readout uses at most this many TCP connections. This is the same as in
+# pocketcorr_rx.py.
+MAX_STREAMS = 16
+
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -40,57 +57,116 @@ class bcolors:
 SHELL_PROMPT = bcolors.OKBLUE + 'poco> ' + bcolors.ENDC
 
 class POCOserver(socket._socketobject):
-    def client_readout(self, localdir, tcp_addr):
+    def client_readout(self, localdir, tcp_addr, nstreams=1):
         """
-        Read data to disk. I did a quick test and it takes longer to
-        compress an 87 MB uv file using tar on a raspberry pi than it
-        does to scp the same file off of a raspberry pi, so this
-        function does not compress data before readout.
+        Read data to disk. The first connection gets the manifest of the
+        files in one message and replies with the components of them
+        that are missing or have changed, with the checksums of the
+        blocks of them that it has, which is the only time that the
+        client talks back. The server then sends the blocks that don't
+        match back to back over ``nstreams`` TCP connections at once,
+        each taking the next file that the server has left to send. The
+        server compresses the files while they are sent when the link is
+        slow enough for that to be faster, and they are decompressed as
+        they come in and checked against the checksums that the server
+        sends after each part of them.
         """
         # Connect to the client. The UDP send on the server sends after the TCP
         # server has been made
-        tcp_cli = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         message, udp_addr = self.recvfrom(UDP_RECV_SIZE)
         if message[:5] == 'ERROR':
             print message
             return 1
-        tcp_cli.connect(tcp_addr)
-
-        # The server sends info about how many files there are as a string that
-        # can be exec'd (nfiles = <number>)
-        exec(recvsend(tcp_cli, 'ready')) # new variable nfiles
+        streams = []
+        for i in range(nstreams):
+            tcp_cli = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tcp_cli.connect(tcp_addr)
+            streams.append(tcp_cli)
+
+        # The server sends the manifest of the files, followed by some filler
+        # to time the link with, and gets back the parts of the files to send.
+        cache_file = os.path.join(localdir, MANIFEST_FILE)
+        cache = load_cache(cache_file)
+        buf = bytearray(TCP_RECV_SIZE)
+        files = {}
+        kind, message = recv_msg(streams[0])
+        start_time = time.time()
+        nprobe = kind == 'M' and recv_filler(streams[0], buf)
+        if nprobe:
+            link_rate = nprobe / max(time.time() - start_time, 1e-6)
+            message = ast.literal_eval(message)
+            for basename in message['files']:
+                uvfile = os.path.join(localdir, basename)
+                manifest = message['manifest'][basename]
+                wanted = get_wanted(uvfile, manifest, localdir, buf, cache)
+                if wanted is None:
+                    continue
+                paths, wanted = wanted
+                if wanted:
+                    files[basename] = (uvfile, manifest, paths, wanted)
+                else:
+                    print 'Up to date: ' + uvfile
+            request = {'link_rate': link_rate,
+                       'files': {k: v[3] for k, v in files.items()}}
+            send_msg(streams[0], 'R', repr(request))
+        else:
+            print 'ERROR: Connection to the server was lost.'
 
-        # Read each file
+        # Read each file. With one stream, the progress of each file is shown.
+        stats = {'nfiles': len(files), 'nstarted': 0, 'nbytes': 0}
+        lock = threading.Lock()
         try:
             start_time = time.time()
-            for i in range(nfiles):
-                message = 'Receiving UV file %d/%d:' % (i+1, nfiles)
-                print message,
-                if tcp_recv_uv(tcp_cli, localdir, TCP_RECV_SIZE):
-                    break
-            print 'Total time:', round(time.time() - start_time, 1) / 60, 'min'
+            if nstreams == 1:
+                recv_stream(streams[0], files, cache, stats, lock, True)
+            else:
+                threads = []
+                for tcp_cli in streams:
+                    thread = threading.Thread(target=recv_stream,
+                                              args=(tcp_cli, files, cache,
+                                                    stats, lock, False))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+
+                # Joining with a timeout lets Ctrl-C through.
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(0.1)
+            read_time = time.time() - start_time
+            total_bytes = stats['nbytes']
+            print 'Total time:', round(read_time, 1) / 60, 'min'
+            print 'Read', format_bytes(total_bytes), 'in total over',
+            print nstreams, 'stream' + 's' * (nstreams > 1),
+            print '(' + format_bytes(total_bytes / max(read_time, 1e-6)) + '/s)'
         except KeyboardInterrupt:
-            tcp_cli.send('quit')
             print
             print 'ERROR: Aborting file transfer.'
-        tcp_cli.close()
+        for tcp_cli in streams:
+            tcp_cli.close()
+        save_cache(cache_file, cache)
         return 0
 
     def exec_cmd(self, command, addr):
         """
         Send a command to the server and return the response.
         """
-        self.sendto(command, addr)
-
         if command[:7] == 'readout':
             cmd = command.split()
             if len(cmd) > 1:
                 local_dir = cmd[1]
             else:
                 local_dir = os.getcwd()
+            if len(cmd) > 2 and not (cmd[2].isdigit() and
+                                     0 < int(cmd[2]) <= MAX_STREAMS):
+                return 'ERROR: Invalid number of streams: ' + cmd[2]
+            nstreams = len(cmd) > 2 and int(cmd[2]) or 1
 
-            if self.client_readout(local_dir, addr):
+            self.sendto(command, addr)
+            if self.client_readout(local_dir, addr, nstreams):
                 return
+        else:
+            self.sendto(command, addr)
 
         try:
             message, _ = self.recvfrom(UDP_RECV_SIZE)
@@ -98,12 +174,141 @@ class POCOserver(socket._socketobject):
         except KeyboardInterrupt:
             print
 
+def finish_file(paths, manifest, cache, checksums):
+    """
+    Finish the components of a file that have been read out. They are
+    cut to their sizes on the server and get the modification times
+    that they have there, and their checksums are saved in the cache
+    with the modification times, so that they are known to be up to
+    date.
+    """
+    components = manifest['components']
+    for index, sums in checksums.items():
+        path, key = paths[index]
+        name, size, mtime = components[index]
+        with open(path, os.path.exists(path) and 'r+b' or 'wb') as f:
+            f.truncate(size)
+        os.utime(path, (mtime, mtime))
+        cache[key] = (size, os.stat(path).st_mtime, manifest['block'], sums,
+                      mtime)
+
+def format_bytes(nbytes):
+    """
+    Format a number of bytes with a binary unit prefix.
+    """
+    for unit in ['Bytes', 'KiB', 'MiB']:
+        if nbytes < 1024:
+            return str(round(nbytes, 1)) + ' ' + unit
+        nbytes /= 1024.
+    return str(round(nbytes, 1)) + ' GiB'
+
+def get_checksums(filename, block, buf):
+    """
+    Compute the CRC-32 of each block of a file, reading it through a
+    buffer.
+    """
+    checksums = []
+    crc = nblock = 0
+    view = memoryview(buf)
+    with open(filename, 'rb') as f:
+        while True:
+            count = f.readinto(view[:min(len(buf), block - nblock)])
+            if not count:
+                break
+            crc = zlib.crc32(buffer(buf, 0, count), crc)
+            nblock += count
+            if nblock == block:
+                checksums.append(crc & 0xffffffff)
+                crc = nblock = 0
+    if nblock:
+        checksums.append(crc & 0xffffffff)
+    return checksums
+
+def get_local_checksums(path, key, block, buf, cache):
+    """
+    Get the checksums of a file that has been read out before. They are
+    taken from the cache if the file hasn't changed since they were put
+    there.
+    """
+    if not os.path.isfile(path):
+        return []
+    stat = os.stat(path)
+    cached = cache.get(key)
+    if cached is not None and cached[:3] == (stat.st_size, stat.st_mtime,
+                                             block):
+        return cached[3]
+    return get_checksums(path, block, buf)
+
+def get_wanted(uvfile, manifest, output_dir, buf, cache):
+    """
+    Find the components of a file that are missing or have changed, with
+    the checksums of the blocks of the local copy of them, so that the
+    server only sends the blocks that don't match. The UV file directory
+    is created if it doesn't exist.
+
+    Input:
+
+    - ``uvfile``: Name of the local copy of the file.
+    - ``manifest``: Manifest of the file from the server.
+    - ``output_dir``: Directory to save the file in.
+    - ``buf``: Bytearray to read the local copy with.
+    - ``cache``: Dictionary of the checksums of the files that have \
+            been read out.
+
+    Return:
+
+    - The local paths of the components of the file with their keys in \
+            the cache, and the list of (component, checksums) of the \
+            components to read, or None if the file can't be read out.
+    """
+    if manifest['isdir'] != os.path.isdir(uvfile) and os.path.exists(uvfile):
+        print 'ERROR: conflicting file: ' + uvfile
+        return None
+    elif manifest['isdir'] and not os.path.exists(uvfile):
+        try:
+            os.mkdir(uvfile)
+        except OSError:
+            print 'ERROR: Cannot create uv file: ' + uvfile
+            return None
+
+    # A component is up to date if it hasn't changed on either side since it
+    # was read out.
+    block = manifest['block']
+    paths = []
+    wanted = []
+    for index, (name, size, mtime) in enumerate(manifest['components']):
+        path = name and os.path.join(uvfile, name) or uvfile
+        key = os.path.relpath(path, output_dir)
+        paths.append((path, key))
+        cached = cache.get(key)
+        if os.path.isfile(path) and cached is not None:
+            stat = os.stat(path)
+            if (cached[:3] == (stat.st_size, stat.st_mtime, block) and
+                    (cached[0],) + cached[4:] == (size, mtime)):
+                continue
+        nblocks = (size + block - 1) / block
+        local = get_local_checksums(path, key, block, buf, cache)
+        wanted.append((index, local[:nblocks]))
+    return paths, wanted
+
 def is_localhost(addr):
     """
     Determine if an IP is localhost.
     """
     return addr == '127.0.0.1' or addr == 'localhost'
 
+def load_cache(filename):
+    """
+    Load the checksums of the files in a readout directory.
+    """
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as f:
+            return ast.literal_eval(f.read())
+    except (IOError, SyntaxError, ValueError):
+        return {}
+
 def print_progress(step, total, prog_str='Percent complete:'):
     """
     Print the progress of some iteration through data. The step is the
@@ -124,104 +329,259 @@ def print_progress(step, total, prog_str='Percent complete:'):
     else:
         sys.stdout.flush()
 
-def recvsend(tcpsocket, reply, bufsize=1024):
+def recv_all(tcpsocket, nbytes):
     """
-    Recieve a message from the server and send a reply
+    Receive a message of a known length, or None if the connection was
+    lost.
     """
-    message = tcpsocket.recv(bufsize)
-    tcpsocket.send(reply)
+    message = ''
+    while len(message) < nbytes:
+        data = tcpsocket.recv(nbytes - len(message))
+        if not data:
+            return None
+        message += data
     return message
 
-def tcp_recv_uv(tcpsocket, output_dir, bufsize):
+def recv_filler(tcpsocket, buf):
     """
-    Copy a UV file using TCP.
+    Receive the filler that the server times the link with into a
+    buffer, returning its length, or None if it doesn't come.
     """
-    start_time = time.time()
+    header = recv_all(tcpsocket, MSG_SIZE)
+    if header is None:
+        return None
+    kind, nbytes = struct.unpack(MSG_FORMAT, header)
+    if kind != 'P':
+        return None
+    view = memoryview(buf)
+    nread = 0
+    while nread < nbytes:
+        nrecv = tcpsocket.recv_into(view, min(len(buf), nbytes - nread))
+        if not nrecv:
+            return None
+        nread += nrecv
+    return nbytes
+
+def recv_msg(tcpsocket):
+    """
+    Receive a readout message, returning its type and contents, or
+    (None, None) if the connection was closed.
+    """
+    header = recv_all(tcpsocket, MSG_SIZE)
+    if header is None:
+        return None, None
+    kind, nbytes = struct.unpack(MSG_FORMAT, header)
+    message = recv_all(tcpsocket, nbytes)
+    if message is None:
+        return None, None
+    return kind, message
+
+def recv_range(tcpsocket, nbytes, level, buf):
+    """
+    Receive part of a file. The data comes in frames that each start
+    with their length, and this yields it as it comes in, decompressing
+    the frames if the server compresses them. Uncompressed data is
+    yielded as a view of the buffer that it was received into, so it
+    must be used before the next part is received, and decompressed
+    data is yielded in chunks no bigger than the buffer.
+    """
+    nread = 0
+    view = memoryview(buf)
+    decompressor = level and zlib.decompressobj()
+    while nread < nbytes:
+        header = recv_all(tcpsocket, 4)
+        if header is None:
+            raise socket.error('Connection to the server was lost.')
+        nframe, = struct.unpack('<I', header)
+        while nframe:
+            nrecv = tcpsocket.recv_into(view, min(len(buf), nframe))
+            if not nrecv:
+                raise socket.error('Connection to the server was lost.')
+            nframe -= nrecv
+            data = buffer(buf, 0, nrecv)
+            if not decompressor:
+                nread += nrecv
+                yield data
+                continue
+            data = decompressor.decompress(data, len(buf))
+            while data:
+                nread += len(data)
+                yield data
+                data = decompressor.decompress(decompressor.unconsumed_tail,
+                                               len(buf))
+
+def recv_stream(tcpsocket, files, cache, stats, lock, progress=True):
+    """
+    Receive UV files over one TCP stream until the server closes it.
 
-    # Create the UV file directory
-    basename = tcpsocket.recv(1024)
-    uvfile = os.path.join(output_dir, basename)
-    print uvfile
-    if os.path.exists(uvfile):
-        if os.path.isdir(uvfile):
-            print 'Skipping ' + uvfile + ': file exists.'
-            tcpsocket.send('skip')
-            return 0
-        else:
-            print 'ERROR: conflicting file: ' + uvfile
-            tcpsocket.send('quit')
-            return 1
-    else:
-        try:
-            os.mkdir(uvfile)
-        except OSError:
-            print 'ERROR: Cannot create uv file: ' + uvfile
-            tcpsocket.send('quit')
-            return 1
-    tcpsocket.send('ready')
+    Input:
 
-    # This should be the same for every file, but I want this function
-    # to work without that assumption
-    uvnames = recvsend(tcpsocket, 'ready').split()
-    exec(recvsend(tcpsocket, 'ready')) # new variable uvsize
-    total_bytes_read = 4096 # Size of UV directory
-    last_read = 0
-    for name in uvnames:
-        # Get the number of data chunks to be read out
-        exec(recvsend(tcpsocket, 'ready')) # new variable nbytes
-        nchunks = nbytes / bufsize + bool(nbytes % bufsize)
-
-        # Write the file
-        filedata = ''
-        while len(filedata) != nbytes:
-            filedata += tcpsocket.recv(bufsize)
-            progress_len = total_bytes_read + len(filedata)
-            if progress_len - last_read > (1 << 20) or progress_len == uvsize:
-                print_progress(progress_len, uvsize)
-                last_read = progress_len
-        tcpsocket.send('next')
-
-        total_bytes_read += len(filedata)
-
-        filename = os.path.join(uvfile, name)
-        with open(filename, 'wb') as f:
-            f.write(filedata)
+    - ``tcpsocket``: Socket connected to the server.
+    - ``files``: Dictionary of the local copy, manifest, component \
+            paths and wanted components of each file, by name.
+    - ``cache``: Dictionary of the checksums of the files that have \
+            been read out, which is shared by all of the streams.
+    - ``stats``: Dictionary with the number of files to read, the number \
+            of files started and the number of bytes read, which is \
+            shared by all of the streams.
+    - ``lock``: Lock for the statistics and the output.
+    - ``progress``: Whether to show the progress of each file.
+    """
+    buf = bytearray(TCP_RECV_SIZE)
+    while True:
+        kind, message = recv_msg(tcpsocket)
+        if kind != 'F':
+            return
+        basename, level, ranges = ast.literal_eval(message)
+        if basename not in files:
+            print 'ERROR: Unexpected file from the server: ' + basename
+            return
+        uvfile, manifest, paths, wanted = files[basename]
+        with lock:
+            stats['nstarted'] += 1
+            if progress:
+                nstarted, nfiles = stats['nstarted'], stats['nfiles']
+                print 'Receiving UV file %d/%d:' % (nstarted, nfiles), uvfile
+
+        start_time = time.time()
+        nbytes = tcp_recv_uv(tcpsocket, uvfile, manifest, paths, wanted,
+                             ranges, level, buf, cache, progress)
+        if nbytes is None:
+            return
+        read_time = time.time() - start_time
+        with lock:
+            stats['nbytes'] += nbytes
+            if not progress:
+                print 'Read', basename + ':', format_bytes(nbytes), 'in',
+                print round(read_time, 1), 's',
+                print '(' + format_bytes(nbytes / max(read_time, 1e-6)) + '/s)'
+
+def save_cache(filename, cache):
+    """
+    Save the checksums of the files in a readout directory.
+    """
+    try:
+        with open(filename + '.tmp', 'w') as f:
+            f.write(repr(dict(cache)))
+        os.rename(filename + '.tmp', filename)
+    except (IOError, OSError):
+        print 'ERROR: Cannot save checksums: ' + filename
+
+def send_msg(tcpsocket, kind, message):
+    """
+    Send a readout message.
+    """
+    tcpsocket.sendall(struct.pack(MSG_FORMAT, kind, len(message)) + message)
 
-    read_time = time.time() - start_time
+def tcp_recv_uv(tcpsocket, uvfile, manifest, paths, wanted, ranges, level,
+                buf, cache, progress=True):
+    """
+    Copy a UV file using TCP. Only the blocks of the file that don't
+    match the checksums of the local copy are read, so an interrupted
+    readout resumes where it stopped. The data is received into a
+    reusable buffer and written straight to disk as it comes in, so the
+    memory used doesn't depend on the size of the file, and the blocks
+    of each range are checked against the checksums that the server
+    sends after it.
 
-    # Create size formatting
-    if uvsize < (1 << 10):
-        read_size = uvsize
-        size_unit = 'Bytes'
-    elif uvsize < (1 << 20):
-        read_size = uvsize / float(1 << 10)
-        size_unit = 'KiB'
-    elif uvsize < (1 << 30):
-        read_size = uvsize / float(1 << 20)
-        size_unit = 'MiB'
-    else:
-        read_size = uvsize / float(1 << 30)
-        size_unit = 'GiB'
-
-    # Create speed formatting
-    uvspeed = uvsize / read_time
-    if uvspeed < (1 << 10):
-        read_speed = uvspeed
-        speed_unit = 'Bytes/s'
-    elif uvspeed < (1 << 20):
-        read_speed = uvspeed / float(1 << 10)
-        speed_unit = 'KiB/s'
-    elif uvspeed < (1 << 30):
-        read_speed = uvspeed / float(1 << 20)
-        speed_unit = 'MiB/s'
+    Input:
+
+    - ``tcpsocket``: Socket connected to the server.
+    - ``uvfile``: Name of the local copy of the file.
+    - ``manifest``: Manifest of the file from the server.
+    - ``paths``: Local paths of the components of the file, with their \
+            keys in the cache.
+    - ``wanted``: List of (component, checksums) of the components to \
+            read, with the checksums of the blocks of the local copy.
+    - ``ranges``: List of (component, offset, nbytes) ranges that the \
+            server sends.
+    - ``level``: zlib level that the server compresses the file with.
+    - ``buf``: Bytearray to receive the data into.
+    - ``cache``: Dictionary of the checksums of the files that have \
+            been read out.
+    - ``progress``: Whether to show the progress of the file.
+
+    Return:
+
+    - Number of bytes received, or None if the transfer failed.
+    """
+    start_time = time.time()
+    block = manifest['block']
+    components = manifest['components']
+
+    # The blocks of the local copy that aren't sent match the server.
+    checksums = {}
+    for index, local in wanted:
+        size = components[index][1]
+        nblocks = (size + block - 1) / block
+        checksums[index] = local + [None] * (nblocks - len(local))
+
+    # Write the data to the files as it comes in, checking each range. A
+    # file with a bad block is still read to the end, but it isn't finished,
+    # so the block is read again by the next readout.
+    valid = True
+    total_bytes = sum([nbytes for _, _, nbytes in ranges])
+    total_bytes_read = 0
+    last_read = 0
+    for index, offset, nbytes in ranges:
+        if (index not in checksums or offset % block or nbytes <= 0 or
+                offset + nbytes > components[index][1]):
+            print 'ERROR: Unexpected range from the server: ' + uvfile
+            return None
+        path = paths[index][0]
+        sums = []
+        with open(path, os.path.exists(path) and 'r+b' or 'wb') as f:
+            f.seek(offset)
+            nread = crc = nblock = 0
+            try:
+                for data in recv_range(tcpsocket, nbytes, level, buf):
+                    f.write(data)
+                    start = 0
+                    while start < len(data):
+                        count = min(len(data) - start, block - nblock)
+                        crc = zlib.crc32(buffer(data, start, count), crc)
+                        start += count
+                        nblock += count
+                        nread += count
+                        if nread > nbytes:
+                            raise socket.error('Too much data for ' + path)
+                        if nblock == block or nread == nbytes:
+                            sums.append(crc & 0xffffffff)
+                            crc = nblock = 0
+                    nprogress = total_bytes_read + nread
+                    if not progress:
+                        continue
+                    if (nprogress - last_read > (1 << 20) or
+                            nprogress == total_bytes):
+                        print_progress(nprogress, total_bytes)
+                        last_read = nprogress
+                kind, message = recv_msg(tcpsocket)
+                if kind != 'C':
+                    raise socket.error('Connection to the server was lost.')
+            except (socket.error, zlib.error) as err:
+                print
+                print 'ERROR: ' + str(err)
+                return None
+        total_bytes_read += nread
+        first = offset / block
+        if (len(message) != 4 * len(sums) or
+                list(struct.unpack('<%dI' % len(sums), message)) != sums):
+            valid = False
+        checksums[index][first:first + len(sums)] = sums
+
+    # The local copy now matches the manifest.
+    if valid and not any(None in sums for sums in checksums.values()):
+        finish_file(paths, manifest, cache, checksums)
     else:
-        read_speed = uvspeed / float(1 << 30)
-        speed_unit = 'GiB/s'
+        print 'ERROR: Checksum mismatch: ' + uvfile
 
     # Print readout size/speed results.
-    print 'Read', round(read_size, 1), size_unit, 'in', round(read_time, 1),
-    print 's (' + str(round(read_speed, 1)), speed_unit
-    return 0
+    read_time = time.time() - start_time
+    if progress:
+        print 'Read', format_bytes(total_bytes), 'in', round(read_time, 1),
+        print 's (' + format_bytes(total_bytes / max(read_time, 1e-6)) + '/s)',
+        print level and '(zlib level %d)' % level or ''
+    return total_bytes
 
 if __name__ == '__main__':
     # Parse command-line options
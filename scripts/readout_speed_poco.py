@@ -64,7 +64,15 @@ if __name__ == '__main__':
     print
 
 
+    # The batched readout reads the same antennas as the per-pair readout.
+    if blread:
+        plan = roach.compile_plan([0, 1])
+    else:
+        plan = roach.plan
+    vis = roach.new_vis_buffer(plan)
+
     read_time = []
+    batch_time = []
     single_bram = []
     for i in range(nreads):
         # Read all antennas
@@ -99,10 +107,19 @@ if __name__ == '__main__':
         tend = time.time()
         read_time.append(tend - tstart)
 
+        # Read the same BRAM's again as one pipelined batch.
+        tstart = time.time()
+        roach.read_integration(plan, vis)
+        tend = time.time()
+        batch_time.append(tend - tstart)
+
         # Print results.
-        print 'Readout', str(i+1)+'/'+str(nreads) + ':', read_time[-1], 's'
+        print 'Readout', str(i+1)+'/'+str(nreads) + ':', read_time[-1], 's',
+        print '(batched: ' + str(batch_time[-1]) + ' s)'
 
     print
     print 'Total readout time:', np.mean(read_time)
     print 'BRAM readout time:', np.mean(single_bram)
+    print 'Batched readout time:', np.mean(batch_time)
+    print 'Batched readout speedup:', np.mean(read_time) / np.mean(batch_time)
     roach.progdev('')
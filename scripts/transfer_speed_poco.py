@@ -0,0 +1,111 @@
+#!/usr/bin/env python2
+
+################################################################################
+## This script compares ways of sending data files over TCP on loopback.
+## Copyright (C) 2014  Rachel Simone Domagalski: domagalski@berkeley.edu
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## ## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+import os
+import time
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import pocketcorr as pc
+
+def send_chunks(tcpsocket, filename):
+    """
+    Send a file by reading it into strings 64 MiB at a time, the way the
+    readout used to.
+    """
+    bufsize = 64 << 20
+    with open(filename, 'rb') as filedata:
+        while True:
+            chunk = filedata.read(bufsize)
+            if not chunk:
+                break
+            tcpsocket.sendall(chunk)
+
+def drain(tcpsocket, nbytes):
+    """
+    Receive and discard data from a socket.
+    """
+    buf = bytearray(64 << 10)
+    nread = 0
+    while nread < nbytes:
+        nrecv = tcpsocket.recv_into(buf)
+        if not nrecv:
+            break
+        nread += nrecv
+
+def get_cpu_time():
+    """
+    Get the CPU time used by this process in seconds.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+if __name__ == '__main__':
+    # Parse command-line options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='Size of the file to send in MiB (default: 256).')
+    parser.add_argument('-p', '--port', type=int, default=14200,
+                        help='Loopback port to use (default: 14200).')
+    args = parser.parse_args()
+
+    # The old path goes last, since it raises the peak memory of the process.
+    senders = [('sendfile', lambda s, f: pc.send_file(s, f)),
+               ('buffered', lambda s, f: pc.send_file(s, f, zero_copy=False)),
+               ('64 MiB chunks', send_chunks)]
+    if not pc.get_sendfile():
+        print 'sendfile is not available, so it falls back to the buffer.'
+
+    fd, filename = tempfile.mkstemp()
+    try:
+        nbytes = args.size << 20
+        with os.fdopen(fd, 'wb') as fileobj:
+            for i in range(args.size):
+                fileobj.write(os.urandom(1 << 20))
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', args.port))
+        server.listen(1)
+        for name, sender in senders:
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.connect(('127.0.0.1', args.port))
+            conn, _ = server.accept()
+            receiver = threading.Thread(target=drain, args=(client, nbytes))
+            receiver.start()
+
+            cpu_start = get_cpu_time()
+            tstart = time.time()
+            sender(conn, filename)
+            receiver.join()
+            send_time = time.time() - tstart
+            cpu_time = get_cpu_time() - cpu_start
+            conn.close()
+            client.close()
+
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            print '%-14s %8.1f MiB/s, CPU %.2f s,' % (name + ':',
+                                                     args.size / send_time,
+                                                     cpu_time),
+            print 'peak RSS %.1f MiB' % (maxrss / 1024.)
+        server.close()
+    finally:
+        os.remove(filename)
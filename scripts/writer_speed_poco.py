@@ -0,0 +1,73 @@
+#!/usr/bin/env python2
+
+################################################################################
+## This script compares the throughput of the data file writers.
+## Copyright (C) 2014  Rachel Simone Domagalski: domagalski@berkeley.edu
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## ## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import pocketcorr as pc
+
+if __name__ == '__main__':
+    # Parse command-line options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rpoco', default='rpoco8',
+                        help='Pocket correlator model (default: rpoco8).')
+    parser.add_argument('-c', '--calfile',
+                        default='psa898_v003',
+                        help='Antenna calibration file (default: psa898_v003).')
+    parser.add_argument('-n', '--num-integs', type=int, default=100,
+                        help='Number of integrations to write.')
+    parser.add_argument('-d', '--directory',
+                        help='Directory to write to (default: a temporary one).')
+    args = parser.parse_args()
+
+    # All writers get the same stream of fake integrations.
+    roach = pc.FakeROACH('')
+    roach.get_model(args.rpoco)
+    roach.set_attributes(args.calfile, 200e6, 2)
+    roach.start_bof()
+    plan = roach.plan
+    stream = [roach.read_integration(plan) for i in range(args.num_integs)]
+    raw_stream = []
+    for i in range(args.num_integs):
+        raw_stream.append(roach.new_raw_buffer(plan))
+        roach.read_raw(plan, raw_stream[-1])
+    jd_start = pc.get_jul_date()
+    nbytes = float(sum([vis.nbytes for vis in stream]))
+
+    writedir = args.directory or tempfile.mkdtemp()
+    try:
+        for fmt in sorted(pc.WRITERS):
+            roach.set_filename(os.path.join(writedir, fmt, 'poco'))
+            writer = pc.WRITERS[fmt](roach, plan)
+
+            tstart = time.time()
+            writer.open()
+            # Raw writers get the BRAM data instead of the visibilities.
+            for i, vis in enumerate(writer.raw and raw_stream or stream):
+                writer.write(jd_start + i * roach.int_time / 86400., vis)
+            writer.close()
+            write_time = time.time() - tstart
+
+            print fmt, 'writer:', nbytes / write_time / (1 << 20), 'MiB/s',
+            print '(' + str(args.num_integs / write_time), 'integrations/s)'
+    finally:
+        if args.directory is None:
+            shutil.rmtree(writedir)
@@ -18,11 +18,19 @@
 ################################################################################
 
 import os           as _os
+import ast          as _ast
+import errno        as _errno
 import sys          as _sys
-import aipy         as _aipy
 import time         as _time
+import ctypes       as _ctypes
+import tempfile     as _tempfile
+import katcp        as _katcp
+import zlib         as _zlib
 import numpy        as _np
+import shutil       as _shutil
 import struct       as _struct
+import threading    as _threading
+import collections  as _collections
 import numpy.random as _npr
 from SNAPsynth import LMX2581
 
@@ -35,6 +43,71 @@ TIME_FMT    = '%Y-%m-%d-%H:%M'
 
 EQ_ADDR_RANGE = 1 << 6
 
+# Polling starts POLL_MARGIN seconds before an accumulation is expected to
+# finish. The margin shrinks if more than POLL_MAX_FAST reads are needed.
+POLL_MARGIN     = 0.05
+POLL_MIN_MARGIN = 0.005
+POLL_MAX_FAST   = 50
+
+# A readout that waits for a free buffer in the integration ring checks that
+# the writer thread is still alive every RING_WAIT seconds.
+RING_WAIT = 1.
+
+# The LST is computed exactly every LST_STEP seconds over a window of
+# LST_WINDOW seconds and linearly interpolated in between.
+LST_STEP   = 600.
+LST_WINDOW = 21600.
+
+# Data files are rotated every ROTATE_INTEGS integrations by default. They
+# can also be rotated by the bytes of visibilities in a file, by the seconds
+# of data in a file or whenever the LST crosses a multiple of some hours.
+ROTATE_MODES  = ['integrations', 'bytes', 'seconds', 'lst']
+ROTATE_INTEGS = 300
+
+# Raw journals and compact files start with a header of HEADER_SIZE bytes.
+# Journals are memory mapped and grown by JOURNAL_CHUNK integrations at a
+# time. Compact files are compressed a block of COMPACT_CHUNK integrations
+# at a time, with zlib level COMPACT_LEVEL by default.
+HEADER_SIZE   = 4096
+JOURNAL_MAGIC = 'POCOJRNL'
+JOURNAL_CHUNK = 256
+COMPACT_MAGIC = 'POCOCMPT'
+COMPACT_CHUNK = 64
+COMPACT_LEVEL = 1
+
+# The latest LIVE_SLOTS integrations are published for live monitors by
+# default. The live export is a file in LIVE_DIR, which is in memory.
+LIVE_MAGIC = 'POCOLIVE'
+LIVE_SLOTS = 16
+LIVE_DIR   = '/dev/shm'
+
+# Files that can't be sent with sendfile are sent TCP_SEND_SIZE bytes at a time.
+TCP_SEND_SIZE = 1 << 20
+
+# Readouts check the data with a checksum for every MANIFEST_BLOCK bytes of a
+# file, which is computed as the data is sent. The server and client both keep
+# the checksums in MANIFEST_FILE, in the data directory, so that files that
+# haven't changed aren't read again.
+MANIFEST_BLOCK = 4 << 20
+MANIFEST_FILE  = '.poco_manifest'
+
+# Readouts time TRANSFER_PROBE bytes over each connection to measure the link.
+# Each file is compressed on the fly with the zlib level in TRANSFER_LEVELS
+# that gets a sample of TRANSFER_SAMPLE bytes of it across the link fastest,
+# or not at all if sending the raw data is faster.
+TRANSFER_PROBE  = 1 << 20
+TRANSFER_LEVELS = [1, 6]
+TRANSFER_SAMPLE = 256 << 10
+
+# Readouts while the correlator is writing data are capped at READOUT_CAP bytes
+# per second by default, so that they don't starve the BRAM readout.
+READOUT_CAP = 4 << 20
+
+# The numpy writer saves NUMPY_CHUNK integrations to disk at a time. Each
+# .npy header is padded to NPY_HEADER_SIZE bytes so it can be rewritten.
+NUMPY_CHUNK     = 16
+NPY_HEADER_SIZE = 256
+
 UV_VAR_TYPES = {
     'source':   'a', 'operator': 'a', 'version':  'a', 'telescop': 'a',
     'antpos':   'd', 'freq':     'd', 'inttime':  'r', 'nants':    'i',
@@ -46,6 +119,36 @@ UV_VAR_TYPES = {
     'ra':       'd', 'obsra':    'd', 'lst':      'd', 'pol':      'i',
 }
 
+# Header items of the UV files, which are stored outside of the visibilities.
+UV_ITEM_TYPES = {
+    'history':  'a', 'obstype':  'a', 'bandpass': 'c', 'nspect0':  'i',
+    'nchan0':   'i', 'ntau':     'i', 'nsols':    'i', 'nfeeds':   'i',
+    'ngains':   'i', 'freqs':    '?',
+}
+
+# Miriad data types: numpy type of the values and the type code in the
+# headers of the items. Items up to MIRIAD_CACHE_SIZE bytes are stored in
+# the header file of a data set. A variable that changes more than
+# MIRIAD_CHECK_THRESH times in a row is written without being compared.
+MIRIAD_TYPES = {'a': ('S1', 1), 'i': ('>i4', 2), 'r': ('>f4', 4),
+                'd': ('>f8', 5), 'c': ('>c8', 7), 'l': ('>i8', 8)}
+MIRIAD_CACHE_SIZE   = 64
+MIRIAD_CHECK_THRESH = 6
+MIRIAD_MASK_BITS    = 31
+
+# Miriad code of the xx polarization that the data is labelled with.
+MIRIAD_POL_XX = -5
+
+# A readout plan is compiled once per correlator model and antenna list so
+# that data collection only has to execute it. Each BRAM in the plan has one
+# output slot per FFT stage, which is None for baselines that are not saved.
+ReadoutPlan = _collections.namedtuple('ReadoutPlan',
+                                      ['devices', 'brams', 'baselines',
+                                       'channels'])
+BramPlan = _collections.namedtuple('BramPlan',
+                                   ['real_dev', 'imag_dev', 'nbytes', 'offset',
+                                    'read_imag', 'slots', 'conj'])
+
 class POCO(LMX2581):
     """
     Class for communicating with a ROACH board running a pocket
@@ -65,6 +168,7 @@ class POCO(LMX2581):
         self.model = None
         self.antennas = None
         self.nchan = None
+        self.chan_range = None
 
         # Display options
         self.verbose = False
@@ -73,6 +177,8 @@ class POCO(LMX2581):
         self.tmp_file = _os.path.join(self.writedir, 'TMP_FILE')
 
         # Set some null values for FPGA parameters.
+        self.calfile   = None
+        self.aa_cache  = None
         self.samp_rate = None
         self.acc_len   = None
         self.int_time  = None
@@ -83,12 +189,34 @@ class POCO(LMX2581):
 
         # Data collection parameters
         self.limit = None
+        self.stats = {}
+        self.writer_fmt = 'miriad'
+        self.rotation = ('integrations', ROTATE_INTEGS)
+        self.navg = 1
+        self.nbin = 1
+        self.compression = (COMPACT_LEVEL, False)
+        self.live = None
+        self.uv_templates = None
+
+        # Poll scheduling and statistics
+        self.clock = None
+        self.flip_time = None
+        self.poll_margin = POLL_MARGIN
+        self.poll_latency = None
+        self.poll_count = None
 
         # Placeholder for the optional multiprocessing mode.
         self.mp = False
         self.socket = None
         self.queue = None
 
+    @property
+    def aa(self):
+        """
+        Antenna array of the calibration file, loaded with ``load_aa``.
+        """
+        return self.load_aa()[0]
+
     def check_connected(self, timeout=10):
         """
         This function checks that the ROACH is actually connected. If
@@ -144,8 +272,100 @@ class POCO(LMX2581):
             return False, False
 
     def cleanup(self):
-        if _os.path.exists(self.tmp_file):
-            _os.system('rm -rf ' + self.tmp_file)
+        # The data files being written in rotation are named after TMP_FILE.
+        _os.system('rm -rf ' + self.tmp_file + '*')
+
+    def compile_plan(self, antenna_list=None):
+        """
+        This function compiles the readout plan for the correlator. The
+        plan holds everything about the BRAM's that doesn't change
+        between integrations: the device names and sizes, whether the
+        imaginary BRAM needs to be read, which second stage spectra need
+        to be conjugated and where each baseline goes in the output.
+
+        Input:
+
+        - ``antenna_list``: List of valid antennas.
+
+        Return:
+
+        - ``ReadoutPlan`` for the correlator.
+        """
+        devices = []
+        brams = []
+        baselines = []
+        for fst, snd in zip(self.fst, self.snd):
+            slots = []
+            for pair in (fst, snd):
+                if self.check_corr(pair, antenna_list):
+                    slots.append(len(baselines))
+                    baselines.append(tuple(sorted(pair)))
+                else:
+                    slots.append(None)
+            if slots == [None, None]:
+                continue
+
+            bram_devices = self.get_bram_devices(fst, self.chan_range)
+            devices += bram_devices
+            real_dev, nbytes, offset = bram_devices[0]
+            imag_dev = len(bram_devices) > 1 and bram_devices[1][0] or None
+            conj = (False, snd[0] > snd[1])
+            brams.append(BramPlan(real_dev, imag_dev, nbytes, offset,
+                                  imag_dev is not None, tuple(slots), conj))
+
+        return ReadoutPlan(tuple(devices), tuple(brams), tuple(baselines),
+                           self.chan_range)
+
+    def decode_brams(self, plan, vis, brams, raw_data):
+        """
+        This function decodes raw data from some of the BRAM's in a
+        readout plan into a visibility buffer. The big-endian BRAM data
+        is decoded straight into the rows of the buffer through views of
+        the raw strings, so the FFT stages are de-interleaved and
+        conjugated in place.
+
+        Input:
+
+        - ``plan``: Readout plan that the data was read with.
+        - ``vis``: Visibility buffer to fill.
+        - ``brams``: Indices of the entries of ``plan.brams`` to decode.
+        - ``raw_data``: Raw data of the devices of the BRAM's, in the \
+                order of ``plan.devices``. Data that couldn't be read is \
+                None.
+
+        Return:
+
+        - List of the indices of the BRAM's that couldn't be read.
+        """
+        failed = []
+        raw_data = iter(raw_data)
+        for i in brams:
+            bram = plan.brams[i]
+            real_raw = next(raw_data)
+            imag_raw = None
+            if bram.read_imag:
+                imag_raw = next(raw_data)
+            if real_raw is None or (bram.read_imag and imag_raw is None):
+                failed.append(i)
+                continue
+
+            # Each row of the BRAM holds one channel from every FFT stage.
+            shape = (vis.shape[1], len(bram.slots))
+            real_raw = _np.frombuffer(real_raw, '>i4').reshape(shape)
+            if bram.read_imag:
+                imag_raw = _np.frombuffer(imag_raw, '>i4').reshape(shape)
+
+            for stage, slot in enumerate(bram.slots):
+                if slot is None:
+                    continue
+                vis[slot].real = real_raw[:, stage]
+                if not bram.read_imag:
+                    vis[slot].imag = 0
+                elif bram.conj[stage]:
+                    _np.negative(imag_raw[:, stage], out=vis[slot].imag)
+                else:
+                    vis[slot].imag = imag_raw[:, stage]
+        return failed
 
     def get_ant_ext(self, ant_num):
         """
@@ -206,6 +426,65 @@ class POCO(LMX2581):
         # return the antenna index.
         return letter * demux + number
 
+    def get_band(self):
+        """
+        This function gets the frequency setup of the data that is
+        written to the UV files. Frequencies are in GHz. When channels
+        are binned, the frequency of a bin is the mean frequency of its
+        channels and channels left over at the end of the range are
+        dropped.
+
+        Return:
+
+        - ``(sdf, sfreq, nchan)``
+        """
+        start, stop = self.chan_range
+        sfreq = self.sfreq + (start + 0.5 * (self.nbin - 1)) * self.sdf
+        return (self.sdf * self.nbin, sfreq, (stop - start) / self.nbin)
+
+    def get_bram_devices(self, corr_pair, channels=None):
+        """
+        This function gets the names, sizes and offsets of the BRAM's
+        that need to be read to get the data for a cross-multiplication.
+        Auto correlations have no imaginary part, so only the real BRAM
+        is read for them. The data for every FFT stage of a channel is
+        stored together, so a range of channels is one block of bytes.
+
+        Input:
+
+        - ``corr_pair``: Tuple containing antenna numbers.
+        - ``channels``: Range of channels ``(start, stop)`` to read. \
+                Defaults to all of them.
+
+        Return:
+
+        - List of ``(device_name, nbytes, offset)`` tuples.
+        """
+        if channels is None:
+            channels = (0, self.nchan)
+        chan_size = self.bram_size / self.nchan
+        nbytes = (channels[1] - channels[0]) * chan_size
+        offset = channels[0] * chan_size
+
+        prefix = self.get_bram_prefix(corr_pair)
+        devices = [(prefix + 'real', nbytes, offset)]
+        if corr_pair[0] != corr_pair[1]:
+            devices.append((prefix + 'imag', nbytes, offset))
+        return devices
+
+    def get_bram_prefix(self, corr_pair):
+        """
+        This function gets the prefix of the xengine BRAM names for a
+        cross-multiplication.
+
+        Input:
+
+        - ``corr_pair``: Tuple containing antenna numbers.
+        """
+        prefix  = 'xengine%d_muxed_' % self.antennas
+        prefix += self.get_corr_name(corr_pair) + '_'
+        return prefix
+
     def get_corr_name(self, corr_pair):
         """
         This function generates a string identifying a
@@ -227,6 +506,19 @@ class POCO(LMX2581):
             sep = ''
         return sep.join(map(self.get_ant_ext, sorted(corr_pair)))
 
+    def get_dc_chans(self):
+        """
+        This function gets the indices of the channels at the edges of
+        the band that have a DC offset, relative to the channel range
+        that is being saved. When channels are binned, these are the
+        bins holding any of those channels.
+        """
+        start, stop = self.chan_range
+        stop = start + (stop - start) / self.nbin * self.nbin
+        dc_chans = [0, 1, self.nchan - 2, self.nchan - 1]
+        dc_chans = [c - start for c in dc_chans if start <= c < stop]
+        return sorted(set([c / self.nbin for c in dc_chans]))
+
     def get_model(self, poco):
         """
         This function determines which ROACH type is being used and
@@ -271,6 +563,7 @@ class POCO(LMX2581):
         # Set the bram size and number of channels
         self.bram_size = 4 << (powchan + 1 - is_demux2(self.poco))
         self.nchan = 1 << powchan
+        self.chan_range = (0, self.nchan)
 
         # Update the filename to reflect the POCO version.
         self.filename += str(self.antennas)
@@ -280,6 +573,7 @@ class POCO(LMX2581):
             self.pairs = self.get_xmult()
         else:
             self.fst, self.snd = self.get_xmult()
+        self.plan = self.compile_plan()
 
         # Raise error for not implimented yet
         if self.model == 2 and self.antennas > 16:
@@ -294,6 +588,84 @@ class POCO(LMX2581):
             message += ' board with %d ADC inputs.\n' % self.antennas
             self.log(message)
 
+    def get_status(self):
+        """
+        This function creates a status message for the correlator while
+        it is writing data to disk.
+        """
+        prefix = 'POCO%d: ' % self.antennas
+        msg  = prefix + 'Writing data to disk\n'
+        msg += prefix + 'Integration count: %d' % self.count
+        for stat in sorted(self.stats):
+            msg += '\n' + prefix + '%s integrations: %d' % (stat.capitalize(),
+                                                            self.stats[stat])
+        if self.poll_latency is not None:
+            msg += '\n' + prefix + 'Poll latency: %.1f ms' % (1e3 *
+                                                            self.poll_latency)
+            msg += '\n' + prefix + 'Polls per integration: %d' % self.poll_count
+        if self.clock is not None and self.clock.ready():
+            drift = self.clock.get_drift(self.int_time)
+            msg += '\n' + prefix + 'FPGA clock drift: %.2f ppm' % drift
+            msg += '\n' + prefix + 'FPGA clock jitter: %.2f ms' % (1e3 *
+                                                             self.clock.jitter)
+        return msg
+
+    def get_uv_header(self):
+        """
+        This function gets the header items and the variables that are
+        set when a Miriad UV file is opened, in the order that they are
+        written to the file.
+
+        Output:
+
+        - List of ``(name, value)`` pairs of the header.
+        """
+        if self.model is None:
+            raise RuntimeError('ROACH model not detected.')
+        rpoco = 'rpoco' + str(self.antennas)
+        nants = self.antennas
+        ants = _np.array([self.aa[i].pos for i in range(nants)]).transpose()
+        sdf, sfreq, nchan = self.get_band()
+        header = [('history', rpoco),
+                  ('obstype', 'mixed'),
+                  ('source', 'zenith'),
+                  ('operator', rpoco),
+                  ('telescop', rpoco),
+                  ('version', '0.1'),
+                  ('nants', nants),
+                  ('antpos', ants.flatten()),
+                  ('npol', 1),
+                  ('epoch', 2000.),
+                  ('nspect', 1),
+                  ('ischan', 1),
+                  ('veldop', 0.),
+                  ('vsource', 0.),
+                  ('longitu', self.aa.long),
+                  ('latitud', self.aa.lat),
+                  ('dec', self.aa.lat),
+                  ('obsdec', self.aa.lat),
+                  ('sfreq', sfreq),
+                  ('freq', sfreq),
+                  ('restfreq', sfreq),
+                  ('sdf', sdf),
+                  ('nchan', nchan),
+                  ('nschan', nchan),
+                  ('inttime', self.int_time * self.navg)]
+
+        if self.bandpass is None: # XXX why is this bram_size?
+            self.bandpass = _np.ones(self.bram_size, dtype=_np.complex)
+        ntau = 0
+        nfeeds = 1
+        header += [('bandpass', self.bandpass.flatten()),
+                   ('nspect0', self.antennas),
+                   ('nchan0', nchan),
+                   ('ntau', ntau),
+                   ('nsols', 0),
+                   ('nfeeds', nfeeds),
+                   ('ngains', nants * (ntau + nfeeds)),
+                   ('freqs', (nants,) + (nchan, sfreq, sdf) * nants)]
+        return header
+
     def get_xmult(self):
         """
         This function gets all of the cross-multiplication combos that
@@ -320,6 +692,24 @@ class POCO(LMX2581):
 
         return (fst, snd)
 
+    def load_aa(self):
+        """
+        This function loads the antenna array of the calibration file
+        for the current band the first time that it is needed, so aipy
+        is only imported by the parts of the correlator that use it.
+
+        Return:
+
+        - The antenna array and its ``LstCache``.
+        """
+        if self.aa_cache is None:
+            if self.calfile is None:
+                raise RuntimeError('Calibration file not set.')
+            import aipy
+            aa = aipy.cal.get_aa(self.calfile, *self.get_band())
+            self.aa_cache = (aa, LstCache(aa))
+        return self.aa_cache
+
     def log(self, message, send_pipe=False, status=0):
         """
         Simple logger. If the correlator is in multiprocessing mode,
@@ -336,6 +726,13 @@ class POCO(LMX2581):
         else:
             print message
 
+    @property
+    def lst_cache(self):
+        """
+        LST cache of the antenna array, loaded with ``load_aa``.
+        """
+        return self.load_aa()[1]
+
     def mp_init(self, connection, queue):
         """
         This function
@@ -349,6 +746,55 @@ class POCO(LMX2581):
         self.socket = connection
         self.queue = queue
 
+    def new_raw_buffer(self, plan=None):
+        """
+        This function allocates a buffer that can hold the raw BRAM
+        data of one integration of a readout plan.
+
+        Input:
+
+        - ``plan``: Readout plan that the buffer is for.
+        """
+        if plan is None:
+            plan = self.plan
+        return _np.zeros(sum([dev[1] for dev in plan.devices]), dtype=_np.uint8)
+
+    def new_uv(self, filename):
+        """
+        This function creates a new Miriad UV file with the header of
+        the correlator set.
+
+        Input:
+
+        - ``filename``: Name of the UV file.
+
+        Output:
+
+        - The ``aipy.miriad.UV`` object of the file.
+        """
+        import aipy
+        header = self.get_uv_header()
+        uv = aipy.miriad.UV(filename, status = 'new')
+        for v in UV_VAR_TYPES:
+            uv.add_var(v, UV_VAR_TYPES[v])
+        for name, value in header:
+            uv[name] = value
+        return uv
+
+    def new_vis_buffer(self, plan=None):
+        """
+        This function allocates a visibility buffer that can hold one
+        integration of a readout plan.
+
+        Input:
+
+        - ``plan``: Readout plan that the buffer is for.
+        """
+        if plan is None:
+            plan = self.plan
+        shape = (len(plan.baselines), plan.channels[1] - plan.channels[0])
+        return _np.zeros(shape, dtype=_np.complex64)
+
     def poco_init(self):
         """
         This function performs some initial procedures for the pocket
@@ -399,18 +845,147 @@ class POCO(LMX2581):
         This function waits until the integration count has been
         incrimented and returns the Julian date of the integration.
 
+        Instead of reading acc_num every millisecond for the whole
+        integration, the next accumulation boundary is predicted from
+        the last one that was seen, and the ROACH is only polled
+        quickly once the boundary is close. The margin before the
+        predicted boundary grows when polling starts too late and
+        shrinks when it starts too early.
+
         Return:
 
         - ``jd``: Julian date of the accumulation.
         """
+        # The accumulation is known to flip after the last read of the old
+        # number, which is this one until polling starts.
+        unchanged = _time.time()
         self.count = self.read_int('acc_num')
-        while self.read_int('acc_num') == self.count:
+        hw_time = self.clock is not None and self.clock.ready()
+        predicted = hw_time or self.flip_time is not None
+        if predicted:
+            now = _time.time()
+            if hw_time:
+                next_flip = self.clock.get_acc_time(self.count + 1)
+            else:
+                nint = _np.floor((now - self.flip_time) / self.int_time) + 1
+                next_flip = self.flip_time + nint * self.int_time
+            wake = next_flip - self.poll_margin
+            if wake > now:
+                _time.sleep(wake - now)
+
+        # Poll quickly until the accumulation number changes.
+        npolls = 1
+        while True:
+            polled = _time.time()
+            npolls += 1
+            acc_num = self.read_int('acc_num')
+            if acc_num != self.count:
+                break
+            unchanged = polled
             _time.sleep(0.001)
-        jd = get_jul_date(_time.time() - 0.5*self.int_time)
+        detected = _time.time()
+
+        # Timestamp the integration with the FPGA clock if it is being used.
+        if self.clock is not None:
+            clk = self.read_int('sys_clkcounter') & 0xffffffff
+            self.clock.update(clk, acc_num, 0.5 * (detected + _time.time()))
+        if self.clock is not None and self.clock.ready():
+            acc_time = self.clock.get_acc_time(acc_num)
+            jd = get_jul_date(acc_time - 0.5*self.clock.period)
+        else:
+            jd = get_jul_date(detected - 0.5*self.int_time)
+
+        # The accumulation flipped between the last two reads.
+        self.flip_time = 0.5 * (unchanged + detected)
+        self.poll_latency = detected - unchanged
+        self.poll_count = npolls
+        if predicted and npolls == 2:
+            self.poll_margin = min(2*self.poll_margin, 0.5*self.int_time)
+        elif predicted and npolls > POLL_MAX_FAST:
+            self.poll_margin = max(0.5*self.poll_margin, POLL_MIN_MARGIN)
+
         _time.sleep(0.001)
         self.count = self.read_int('acc_num')
         return jd
 
+    def read_batch(self, devices, strict=True):
+        """
+        This function reads a list of BRAM's from the ROACH as one
+        pipelined batch. Every KATCP read request is sent before any
+        of the replies are waited on, so reading a whole integration
+        costs about one network round trip instead of one per BRAM.
+
+        Input:
+
+        - ``devices``: List of ``(device_name, nbytes, offset)`` tuples.
+        - ``strict``: Raise an error if any BRAM can't be read. If this \
+                is False, the data for those BRAM's is None instead.
+
+        Return:
+
+        - List of raw data strings in the same order as ``devices``.
+        """
+        ndevices = len(devices)
+        if not ndevices:
+            return []
+
+        # The reply callbacks are run from the KATCP client thread.
+        replies = [None] * ndevices
+        pending = [ndevices]
+        pending_lock = _threading.Lock()
+        finished = _threading.Event()
+        def reply_cb(reply, index):
+            replies[index] = reply
+            with pending_lock:
+                pending[0] -= 1
+                if not pending[0]:
+                    finished.set()
+
+        # Send every request before waiting on any of them.
+        for i, (device, nbytes, offset) in enumerate(devices):
+            request = _katcp.Message.request('read', device, str(offset),
+                                             str(nbytes))
+            self.callback_request(request, reply_cb=reply_cb, user_data=(i,))
+
+        if not finished.wait(self._timeout) and strict:
+            raise RuntimeError('Timed out during batched BRAM readout.')
+
+        raw_data = []
+        for (device, _, _), reply in zip(devices, replies):
+            if reply is None or reply.arguments[0] != _katcp.Message.OK:
+                if strict:
+                    raise RuntimeError('Cannot read BRAM: ' + device)
+                raw_data.append(None)
+            else:
+                raw_data.append(reply.arguments[1])
+        return raw_data
+
+    def read_brams(self, plan, vis, brams):
+        """
+        This function reads some of the BRAM's in a readout plan in a
+        single batch and decodes the ones that could be read into a
+        visibility buffer.
+
+        Input:
+
+        - ``plan``: Readout plan to use.
+        - ``vis``: Visibility buffer to fill.
+        - ``brams``: Indices of the entries of ``plan.brams`` to read.
+
+        Return:
+
+        - List of the indices of the BRAM's that couldn't be read.
+        """
+        devices = []
+        for i in brams:
+            bram = plan.brams[i]
+            devices.append((bram.real_dev, bram.nbytes, bram.offset))
+            if bram.read_imag:
+                devices.append((bram.imag_dev,) + devices[-1][1:])
+
+        raw_data = self.read_batch(devices, strict=False)
+        return self.decode_brams(plan, vis, brams, raw_data)
+
     def read_corr(self, corr_pair):
         """
         This function reads out cross-multiplied data from a specific
@@ -425,26 +1000,90 @@ class POCO(LMX2581):
 
         - Data in the structure np.array([stage1, stage2])
         """
-        # Generate the device names
-        prefix   = 'xengine%d_muxed_' % self.antennas
-        prefix  += self.get_corr_name(corr_pair) + '_'
-        real_dev = prefix + 'real'
-        imag_dev = prefix + 'imag'
-
         # Read the BRAM's
-        real_raw = self.read(real_dev, self.bram_size)
-        if corr_pair[0] != corr_pair[1]:
-            imag_raw = self.read(imag_dev, self.bram_size)
-        else:
-            imag_raw = '\x00' * self.bram_size
+        raw_data = [self.read(*dev) for dev in self.get_bram_devices(corr_pair)]
+        return self.unpack_corr(*raw_data)
 
-        # Convert the strings to numeric data
-        cx_data      = _np.zeros(self.nchan << 1, dtype=_np.complex64)
-        cx_data.real = _np.fromstring(real_raw, '>i4')
-        cx_data.imag = _np.fromstring(imag_raw, '>i4')
+    def read_integration(self, plan=None, vis=None):
+        """
+        This function executes a readout plan, reading all of the
+        xengine BRAM's needed for one integration in a single batch
+        and decoding them into a visibility buffer.
 
-        # The data needs to be reshaped to account for the two FFT stages
-        return cx_data.reshape((self.nchan, 2)).transpose()
+        Input:
+
+        - ``plan``: Readout plan to use. Defaults to the plan compiled \
+                for the correlator model.
+        - ``vis``: Preallocated visibility buffer to fill, with \
+                dimensions ``(nbaselines, nchan)`` and dtype \
+                ``complex64``. A new buffer is made if this is None.
+
+        Return:
+
+        - ``vis``: Visibilities, in the baseline order of the plan.
+        """
+        if plan is None:
+            plan = self.plan
+        if vis is None:
+            vis = self.new_vis_buffer(plan)
+
+        if self.read_brams(plan, vis, range(len(plan.brams))):
+            raise RuntimeError('Cannot read integration.')
+        return vis
+
+    def read_raw(self, plan, raw):
+        """
+        This function reads the BRAM's of a readout plan without decoding
+        them. The raw data of the devices is copied into a buffer one
+        after another. Like ``read_retry``, devices that can't be read are
+        read again for as long as the accumulation number hasn't changed.
+
+        Input:
+
+        - ``plan``: Readout plan to use.
+        - ``raw``: Raw data buffer to fill.
+
+        Return:
+
+        - Number of times devices had to be read again, or None if the \
+                accumulation window passed before the whole integration \
+                could be read.
+        """
+        offsets = _np.cumsum([0] + [dev[1] for dev in plan.devices])
+        def read_devices(pending):
+            devices = [plan.devices[i] for i in pending]
+            failed = []
+            for i, raw_data in zip(pending, self.read_batch(devices, False)):
+                if raw_data is None:
+                    failed.append(i)
+                else:
+                    raw[offsets[i]:offsets[i+1]] = _np.frombuffer(raw_data,
+                                                                 _np.uint8)
+            return failed
+
+        return self.retry_reads(read_devices, range(len(plan.devices)))
+
+    def read_retry(self, plan, vis):
+        """
+        This function reads an integration like ``read_integration``.
+        If some of the BRAM's can't be read, only those are read again,
+        for as long as the accumulation number hasn't changed since the
+        last poll. Once it changes, the BRAM's hold the next integration
+        and the partly read one is given up on.
+
+        Input:
+
+        - ``plan``: Readout plan to use.
+        - ``vis``: Visibility buffer to fill.
+
+        Return:
+
+        - Number of times BRAM's had to be read again, or None if the \
+                accumulation window passed before the whole integration \
+                could be read.
+        """
+        read_brams = lambda brams: self.read_brams(plan, vis, brams)
+        return self.retry_reads(read_brams, range(len(plan.brams)))
 
     def reconnect(self):
         """
@@ -459,75 +1098,169 @@ class POCO(LMX2581):
             except:
                 _time.sleep(0.1)
 
-    def retrieve_data(self, antenna_list=None):
+    def retrieve_data(self, antenna_list=None, nbuffers=0, block=False):
         """
         This function retrieves data off of the ROACH and writes it to
-        uv files.
+        uv files. By default, each integration is written to disk
+        before the next one is read. If ``nbuffers`` is set, a writer
+        thread drains a ring of integration buffers instead, so slow
+        disk writes don't delay the readout. When the ring is full,
+        integrations are dropped rather than making the readout wait,
+        unless ``block`` is set.
+        Data files are rotated with the policy set by ``set_rotation``.
+        Integrations are averaged in software first if ``set_averaging``
+        was used, and channels are binned if ``set_channel_binning`` was.
+        The latest integrations are published for live monitors if
+        ``set_live_export`` was used.
+
+        Input:
+
+        - ``antenna_list``: List of antennas to save data from.
+        - ``nbuffers``: Number of integration buffers in the ring.
+        - ``block``: Make the readout wait for the writer thread when \
+                the ring is full. The integrations that go by while it \
+                waits are counted as late instead of dropped.
         """
         ants  = self.antennas
-        start = self.count
         if antenna_list is not None and self.model == 2:
             antenna_list = map(self.get_ant_ind, antenna_list)
+        plan = self.compile_plan(antenna_list)
+        self.stats = {'late': 0, 'dropped': 0, 'recovered': 0, 'lost': 0}
+
+        writer = RotatingWriter(self, plan)
+        if self.navg > 1:
+            writer = AveragingWriter(self, plan, writer)
+        if self.live is not None:
+            writer = LiveWriter(self, plan, writer)
+        if self.nbin > 1:
+            writer = BinningWriter(self, plan, writer)
+        writer.open()
+
+        # Writers of raw data get the BRAM data without decoding it.
+        if writer.raw:
+            new_buffer, read = self.new_raw_buffer, self.read_raw
+        else:
+            new_buffer, read = self.new_vis_buffer, self.read_retry
+
+        # Set up the writer thread.
+        if nbuffers:
+            vis = new_buffer(plan)
+            ring = IntegrationRing(nbuffers, vis.shape, vis.dtype)
+            write_thread = _threading.Thread(target=self.write_loop,
+                                             args=(writer, ring))
+            write_thread.daemon = True
+            write_thread.start()
+        else:
+            ring = None
+            vis = new_buffer(plan)
 
-        self.uv_open()
-        while True:
-            jd = self.poll()
-            if not self.mp:
-                print 'POCO%d: Integration count: %d' % (ants, self.count)
+        try:
+            while True:
+                last_count = self.count
+                jd = self.poll()
+                if not self.mp:
+                    print 'POCO%d: Integration count: %d' % (ants, self.count)
+
+                # Integrations that were missed while the last one was saved.
+                if self.count - last_count > 1:
+                    self.stats['late'] += self.count - last_count - 1
+
+                # Get a buffer to read into, waiting for one if asked to.
+                if ring is not None:
+                    slot = None
+                    while slot is None:
+                        if not write_thread.is_alive():
+                            msg = 'The writer thread has stopped.'
+                            raise RuntimeError(msg)
+                        slot = ring.acquire(RING_WAIT if block else 0)
+                        if not block:
+                            break
+                    if slot is None:
+                        self.stats['dropped'] += 1
+                        self.log('WARNING: Buffers full. Dropping integration.')
+                    else:
+                        vis = ring.vis[slot]
+
+                # Read all BRAM's in one batch, re-reading any that fail
+                # while the integration is still in them, then save it.
+                if ring is None or slot is not None:
+                    try:
+                        retries = read(plan, vis)
+                        msg = 'WARNING: Integration ended during readout. '
+                    except RuntimeError:
+                        retries = None
+                        msg = 'WARNING: Cannot connect. '
+                    if retries is None:
+                        if ring is not None:
+                            ring.release(slot)
+                        self.stats['lost'] += 1
+                        self.log(msg + 'Skipping integration.')
+                        self.reconnect()
+                        continue
+                    elif retries:
+                        self.stats['recovered'] += 1
+                    if ring is None:
+                        writer.write(jd, vis, self.count)
+                    else:
+                        ring.commit(slot, jd, self.count)
+
+                # Check for a quit signal from the controller if in server mode
+                if self.mp and self.socket.poll():
+                    cmd = self.socket.recv()
+                    if cmd == 'stop':
+                        self.log('Received stop command from user.')
+                        self.socket.send((0, 'Stopping data collection.'))
+                        break
+                    elif cmd == 'status':
+                        self.log('Received status command from user.')
+                        self.socket.send((0, self.get_status()))
+                    elif cmd == 'kill-server':
+                        msg = 'Cannot shut down. Data writing in progress.'
+                        self.socket.send((1, msg))
+                    else:
+                        msg = 'The correlator is already running.'
+                        self.socket.send((1, msg))
+                        if not isinstance(cmd, str):
+                            cmd = ' '.join(cmd)
+                        self.log('POCO: Received invalid command: ' + cmd)
+
+                # Check if there is time for more integrations
+                if self.limit is not None and self.count + 1 > self.limit:
+                    self.log('Time limit reached.')
+                    break
+        finally:
+            # Everything that was read out needs to be written before closing.
+            if ring is not None:
+                ring.close()
+                write_thread.join()
+            writer.close()
+
+    def retry_reads(self, read, pending):
+        """
+        This function reads parts of an integration, and reads the parts
+        that failed again for as long as the accumulation number hasn't
+        changed since the last poll. Once it changes, the BRAM's hold the
+        next integration and the partly read one is given up on.
 
-            # Read and save data from all BRAM's
-            try:
-                for fst, snd in zip(self.fst, self.snd):
-                    fst_in_list = self.check_corr(fst, antenna_list)
-                    snd_in_list = self.check_corr(snd, antenna_list)
-                    if fst_in_list or snd_in_list:
-                        corr_data = self.read_corr(fst)
-                    if fst_in_list:
-                        self.uv_update(fst, corr_data[0], jd)
-                    if snd_in_list:
-                        if snd[0] > snd[1]:
-                            self.uv_update(snd, _np.conj(corr_data[1]), jd)
-                        else:
-                            self.uv_update(snd, corr_data[1], jd)
-            except RuntimeError:
-                self.log('WARNING: Cannot connect. Skipping integration.')
-                self.reconnect()
-                continue
+        Input:
 
-            # Check for a quit signal from the controller if in server mode
-            if self.mp and self.socket.poll():
-                cmd = self.socket.recv()
-                if cmd == 'stop':
-                    self.log('Received stop command from user.')
-                    self.socket.send((0, 'Stopping data collection.'))
-                    self.uv_close()
-                    return
-                elif cmd == 'status':
-                    self.log('Received status command from user.')
-                    msg = 'POCO%d: Writing data to disk\n' % ants
-                    msg += 'POCO%d: Integration count: %d' % (ants, self.count)
-                    self.socket.send((0, msg))
-                elif cmd == 'kill-server':
-                    msg = 'Cannot shut down. Data writing in progress.'
-                    self.socket.send((1, msg))
-                else:
-                    self.socket.send((1, 'The correlator is already running.'))
-                    if not isinstance(cmd, str):
-                        cmd = ' '.join(cmd)
-                    self.log('POCO: Received invalid command: ' + cmd)
-
-            # Check if there is time for more integrations
-            if self.limit is not None and self.count + 1 > self.limit:
-                self.log('Time limit reached.')
-                self.uv_close()
-                return
+        - ``read``: Function that reads a list of parts and returns the \
+                list of the ones that couldn't be read.
+        - ``pending``: List of the parts to read.
+
+        Return:
 
-            # Make a new UV file every 300 integrations
-            if (self.count - start) % 300 == 0:
-                self.log('Closing UV file.')
-                self.uv_close()
-                self.log('Reopening a new UV file.')
-                self.uv_open()
+        - Number of times parts had to be read again, or None if the \
+                accumulation window passed before every part could be read.
+        """
+        failed = read(pending)
+        retries = 0
+        while failed:
+            if self.read_int('acc_num') != self.count:
+                return None
+            failed = read(failed)
+            retries += 1
+        return retries
 
     def set_attributes(self, calfile, samp_rate, nyquist_zone, bandpass=None):
         """
@@ -562,12 +1295,96 @@ class POCO(LMX2581):
             sdf *= -1
 
         # Get basic attributes of the observation and the correlator
-        self.aa = _aipy.cal.get_aa(calfile, sdf, sfreq, self.nchan)
         self.sdf = sdf
         self.sfreq = sfreq
+        self.calfile = calfile
         self.bandpass = bandpass
         self.samp_rate = samp_rate
         self.nyquist = nyquist_zone
+        self.aa_cache = None
+
+    def set_averaging(self, navg):
+        """
+        This function sets how many integrations are averaged together
+        in software before they are written. This cuts down the size of
+        the data files without changing the accumulation length on the
+        FPGA. The formats that save the raw BRAM data can't be averaged,
+        so the format has to be set with ``set_writer`` first.
+
+        Input:
+
+        - ``navg``: Number of consecutive integrations to average.
+        """
+        if navg < 1:
+            raise ValueError('Invalid number of integrations to average.')
+        if navg > 1 and WRITERS[self.writer_fmt].raw:
+            raise ValueError('Raw BRAM data can\'t be averaged.')
+        self.navg = int(navg)
+        if self.navg > 1:
+            self.log('Averaging %d integrations per record.' % self.navg)
+
+    def set_channel_binning(self, nbin):
+        """
+        This function sets how many adjacent frequency channels are
+        averaged into each channel of the data files. The frequency
+        setup of the UV files is changed to match. The formats that save
+        the raw BRAM data can't be binned, so the format has to be set
+        with ``set_writer`` first.
+
+        Input:
+
+        - ``nbin``: Number of channels per bin.
+        """
+        if self.model is None:
+            raise RuntimeError('ROACH model not detected.')
+        start, stop = self.chan_range
+        if not 1 <= nbin <= stop - start:
+            raise ValueError('Invalid number of channels per bin.')
+        if nbin > 1 and WRITERS[self.writer_fmt].raw:
+            raise ValueError('Raw BRAM data can\'t be binned.')
+
+        # The flags of the UV files depend on the binning but not the plan.
+        self.nbin = int(nbin)
+        self.aa_cache = None
+        self.uv_templates = None
+        if self.nbin > 1:
+            self.log('Binning %d channels per channel.' % self.nbin)
+
+    def set_channel_range(self, start, stop):
+        """
+        This function selects a sub-band of frequency channels to save.
+        Only the part of each BRAM holding those channels is read from
+        the ROACH, and the UV files are written with the frequency
+        setup of the sub-band.
+
+        Input:
+
+        - ``start``: First channel to save.
+        - ``stop``: One past the last channel to save.
+        """
+        if self.model is None:
+            raise RuntimeError('ROACH model not detected.')
+        if not 0 <= start < stop <= self.nchan:
+            raise ValueError('Invalid channel range.')
+
+        self.chan_range = (start, stop)
+        self.plan = self.compile_plan()
+        self.aa_cache = None
+        self.log('Saving channels %d to %d.' % (start, stop - 1))
+
+    def set_compression(self, level, delta=False):
+        """
+        This function sets how the compact data files are compressed.
+
+        Input:
+
+        - ``level``: zlib compression level, from 0 (no compression) to 9.
+        - ``delta``: Whether to store the difference of each integration \
+                from the one before it instead of the integration.
+        """
+        if not 0 <= level <= 9:
+            raise ValueError('Invalid compression level.')
+        self.compression = (int(level), bool(delta))
 
     def set_eq_coeff(self, eq_coeff):
         """
@@ -628,6 +1445,62 @@ class POCO(LMX2581):
         else:
             return 0
 
+    def set_hw_time(self, state):
+        """
+        This function sets whether integrations are timestamped using
+        the FPGA counters (sys_clkcounter and acc_num) instead of the
+        host time when an accumulation is noticed. The FPGA clock is
+        anchored to the host time once, and its rate is estimated from
+        every integration after that.
+
+        Input:
+
+        - ``state``: True to use the FPGA counters for timestamps.
+        """
+        if state:
+            self.clock = FpgaClock()
+            self.log('Using FPGA counters for integration timestamps.')
+        else:
+            self.clock = None
+
+    def set_live_export(self, name, nslots=LIVE_SLOTS):
+        """
+        This function publishes the latest integrations in shared memory
+        while data is retrieved, so that local monitors can look at them
+        with ``LiveReader`` without waiting for the data files.
+
+        Input:
+
+        - ``name``: Name of the live export, or None to turn it off.
+        - ``nslots``: Number of integrations to keep.
+        """
+        if name is None:
+            self.live = None
+            return
+        if nslots < 1:
+            raise ValueError('Invalid number of live integrations.')
+        self.live = (name, int(nslots))
+        self.log('Publishing live data to ' + get_live_path(name) + '.')
+
+    def set_rotation(self, mode, value):
+        """
+        This function sets when a new data file is started.
+
+        Input:
+
+        - ``mode``: What the files are rotated by. One of ROTATE_MODES: \
+                'integrations' for a number of integrations, 'bytes' for \
+                the bytes of visibilities in a file, 'seconds' for the \
+                time spanned by a file or 'lst' to start a new file when \
+                the LST crosses a multiple of ``value`` hours.
+        - ``value``: Size of the data files in the units of the mode.
+        """
+        if mode not in ROTATE_MODES:
+            raise ValueError('Invalid rotation mode: ' + str(mode))
+        if value <= 0:
+            raise ValueError('The rotation value must be positive.')
+        self.rotation = (mode, value)
+
     def set_verbose(self, state):
         """
         This function sets the verbosity of the output.
@@ -636,6 +1509,26 @@ class POCO(LMX2581):
         if self.verbose:
             self.log('Enabling verbose output.')
 
+    def set_writer(self, fmt):
+        """
+        This function sets the format of the data files.
+
+        Input:
+
+        - ``fmt``: Name of a writer in ``WRITERS``. Either 'miriad' for \
+                Miriad UV files written with aipy, 'miriad-numpy' for \
+                Miriad UV files written with numpy, 'numpy' for raw \
+                numpy arrays, 'compact' for compressed integers or \
+                'journal' for raw journals.
+        """
+        if fmt not in WRITERS:
+            raise ValueError('Invalid data file format: ' + str(fmt))
+        if WRITERS[fmt].raw and self.navg > 1:
+            raise ValueError('Raw BRAM data can\'t be averaged.')
+        if WRITERS[fmt].raw and self.nbin > 1:
+            raise ValueError('Raw BRAM data can\'t be binned.')
+        self.writer_fmt = fmt
+
     def scheduler(self,
                   n_integ=None,
                   start=None,
@@ -842,94 +1735,109 @@ class POCO(LMX2581):
         # Return whether the bof file was started or configured
         return prog_bof or configure
 
-    def uv_close(self):
-        """
-        This function closes the current UV file and renames it to a
-        unique filename based on the Julian date.
+    def unpack_corr(self, real_raw, imag_raw=None):
         """
-        # Check if a uv file has been opened before moving it.
-        try:
-            del self.uv
-        except AttributeError:
-            return
+        This function converts raw BRAM data into complex spectra for
+        the two FFT stages. Auto correlations have no imaginary BRAM.
 
-        ants = self.antennas
-        filename = '.'.join([self.filename, str(get_jul_date()), 'uv'])
-        self.log('POCO%d: Closing UV file and renaming to %s.' % (ants, filename))
-        _os.rename(self.tmp_file, filename)
+        Input:
 
-    def uv_open(self):
-        """
-        This function opens a Miriad UV file for writing.
-        """
-        if self.model is None:
-            raise RuntimeError('ROACH model not detected.')
-        uv = _aipy.miriad.UV(self.tmp_file, status = 'new')
-        for v in UV_VAR_TYPES:
-            uv.add_var(v, UV_VAR_TYPES[v])
-        rpoco = 'rpoco' + str(self.antennas)
-        uv['history'] = rpoco
-        uv['obstype'] = 'mixed'
-        uv['source'] = 'zenith'
-        uv['operator'] = rpoco
-        uv['telescop'] = rpoco
-        uv['version'] = '0.1'
-        uv['nants'] = self.antennas
-        ants = _np.array([self.aa[i].pos for i in range(uv['nants'])]).transpose()
-        uv['antpos'] = ants.flatten()
-        uv['npol'] = 1
-        uv['epoch'] = 2000.
-        uv['nspect'] = 1
-        uv['ischan'] = 1
-        uv['veldop'] = uv['vsource'] = 0.
-        uv['longitu'] = self.aa.long
-        uv['latitud'] = uv['dec'] = uv['obsdec'] = self.aa.lat
-        uv['sfreq'] = uv['freq'] = uv['restfreq'] = self.sfreq
-        uv['sdf'] = self.sdf
-        uv['nchan'] = uv['nschan'] = self.nchan
-        uv['inttime'] = self.int_time
+        - ``real_raw``: Raw data from the real BRAM.
+        - ``imag_raw``: Raw data from the imaginary BRAM.
 
-        if self.bandpass is None: # XXX why is this bram_size?
-            self.bandpass = _np.ones(self.bram_size, dtype=_np.complex)
-        uv['bandpass']= self.bandpass.flatten()
-        uv['nspect0'] = self.antennas
-        uv['nchan0'] = self.nchan
-        uv['ntau'] = uv['nsols'] = 0
-        uv['nfeeds'] = 1
-        uv['ngains'] = uv['nants']*(uv['ntau'] + uv['nfeeds'])
-        uv['freqs'] = (uv['nants'],) + (self.nchan, self.sfreq, self.sdf) * uv['nants']
-        self.uv = uv
+        Return:
+
+        - Data in the structure np.array([stage1, stage2])
+        """
+        # Convert the strings to numeric data
+        cx_data      = _np.zeros(self.nchan << 1, dtype=_np.complex64)
+        cx_data.real = _np.fromstring(real_raw, '>i4')
+        if imag_raw is not None:
+            cx_data.imag = _np.fromstring(imag_raw, '>i4')
+
+        # The data needs to be reshaped to account for the two FFT stages
+        return cx_data.reshape((self.nchan, 2)).transpose()
+
+    def unpack_integration(self, plan, raw, vis=None):
+        """
+        This function decodes the raw BRAM data of an integration that
+        was read with ``read_raw``.
 
-    def uv_update(self, pair, data, jd):
+        Input:
+
+        - ``plan``: Readout plan that the data was read with.
+        - ``raw``: Raw data of the devices of the plan, one after another.
+        - ``vis``: Preallocated visibility buffer to fill. A new buffer \
+                is made if this is None.
+
+        Return:
+
+        - ``vis``: Visibilities, in the baseline order of the plan.
+        """
+        if vis is None:
+            vis = self.new_vis_buffer(plan)
+        offsets = _np.cumsum([0] + [dev[1] for dev in plan.devices])
+        raw_data = [raw[start:stop]
+                    for start, stop in zip(offsets[:-1], offsets[1:])]
+        self.decode_brams(plan, vis, range(len(plan.brams)), raw_data)
+        return vis
+
+    def uv_write_integration(self, uv, jd, vis, plan=None):
         """
-        This function updates the uv file for a given baseline.
+        This function writes every baseline of one integration to the
+        uv file. The time-dependent variables are set once for the
+        whole integration and the preambles and flags are reused from
+        templates made for the readout plan, so the loop over the
+        baselines does nothing but write.
 
         Input:
 
-        - ``pair``: Pair of indices identifying the cross-correlation.
-        - ``data``: Numeric data for a cross-correlation.
+        - ``uv``: UV file to write to, made with ``new_uv``.
         - ``jd``: Julian date of the observation.
+        - ``vis``: Visibility buffer holding the integration.
+        - ``plan``: Readout plan that the integration was read with. \
+                Defaults to the plan compiled for the correlator model.
         """
-        i, j = sorted(pair)
-        uvw = _np.array([i,j,0], dtype=_np.double)
-        preamble = (uvw, jd, (i,j))
+        if plan is None:
+            plan = self.plan
+        if self.uv_templates is None or self.uv_templates[0] is not plan:
+            preambles = []
+            for pair in plan.baselines:
+                i, j = sorted(pair)
+                preambles.append((_np.array([i,j,0], dtype=_np.double), (i,j)))
+            flags = _np.zeros(vis.shape[1], dtype=_np.int)
+            flags[self.get_dc_chans()] = 1
+            self.uv_templates = (plan, preambles, flags)
+        _, preambles, flags = self.uv_templates
 
         # to get rid of the dc offset. causes plots to be "quantized"
-        data[-2] = 0
-        data[-1] = 0
-        data[0] = 0
-        data[1] = 0
-
-        self.uv['ra'] = self.uv['obsra'] = self.uv['lst'] = self.aa.sidereal_time()
-        self.uv['pol'] = _aipy.miriad.str2pol['xx']
-        flags = _np.zeros(data.shape, dtype = _np.int)
-        flags[-2] = 1.
-        flags[-1] = 1.
-        flags[0] = 1.
-        flags[1] = 1.
-
-        # Write to the UV file (what a helpful comment right there...)
-        self.uv.write(preamble, data, flags=flags)
+        vis[:, flags.astype(bool)] = 0
+
+        lst = self.lst_cache.get_lst(jd)
+        uv['ra'] = uv['obsra'] = uv['lst'] = lst
+        uv['pol'] = MIRIAD_POL_XX
+        for (uvw, ij), data in zip(preambles, vis):
+            uv.write((uvw, jd, ij), data, flags=flags)
+
+    def write_loop(self, writer, ring):
+        """
+        This function is run by the writer thread. It saves every
+        integration in the ring to disk until the ring is closed and
+        there is nothing left in it.
+
+        Input:
+
+        - ``writer``: Writer for the data files.
+        - ``ring``: ``IntegrationRing`` that is filled by the readout.
+        """
+        while True:
+            slot = ring.get()
+            if slot is None:
+                return
+            try:
+                writer.write(ring.jd[slot], ring.vis[slot], ring.count[slot])
+            finally:
+                ring.release(slot)
 
     def write_testvec(self, ant_num, vector):
         """
@@ -958,8 +1866,6 @@ class POCOdemux2(POCO):
     # start_bof
     # poco_init
     # poco_recall
-    # read_corr
-    # retrieve_data
     def get_xmult(self):
         """
         This function gets all of the cross-multiplication combos that
@@ -1027,156 +1933,1679 @@ class POCOdemux2(POCO):
         self.write_int('acc_length', self.acc_len)
         self.log('Integration time: ' + str(self.int_time) + ' s')
 
-        # The first integration is all junk.
-        while self.count < 1:
-            self.poll()
+        # The first integration is all junk.
+        while self.count < 1:
+            self.poll()
+
+    def poco_recall(self):
+        """
+        If the bof process is alredy running, this function retrieves
+        the sync selection and the integration counter from the
+        correlator.
+        """
+        self.count = self.read_int('acc_num')
+        self.acc_len = self.read_int('acc_length')
+        self.fft_shift = self.read_int('pfb_ctrl')
+        self.insel = self.read_int('input_source_sel')
+        self.int_time  = self.acc_len / self.samp_rate
+
+    def compile_plan(self, antenna_list=None):
+        """
+        This function compiles the readout plan for the correlator. The
+        plan holds everything about the BRAM's that doesn't change
+        between integrations: the device names and sizes, whether the
+        imaginary BRAM needs to be read and where each baseline goes in
+        the output. There is only one FFT stage per BRAM.
+
+        Input:
+
+        - ``antenna_list``: List of valid antennas.
+
+        Return:
+
+        - ``ReadoutPlan`` for the correlator.
+        """
+        devices = []
+        brams = []
+        baselines = []
+        for pair in self.pairs:
+            if not self.check_corr(pair, antenna_list):
+                continue
+            bram_devices = self.get_bram_devices(pair, self.chan_range)
+            devices += bram_devices
+            real_dev, nbytes, offset = bram_devices[0]
+            imag_dev = len(bram_devices) > 1 and bram_devices[1][0] or None
+            brams.append(BramPlan(real_dev, imag_dev, nbytes, offset,
+                                  imag_dev is not None, (len(baselines),),
+                                  (False,)))
+            baselines.append(pair)
+
+        return ReadoutPlan(tuple(devices), tuple(brams), tuple(baselines),
+                           self.chan_range)
+
+    def get_bram_prefix(self, corr_pair):
+        """
+        This function gets the prefix of the xengine BRAM names for a
+        cross-multiplication.
+
+        Input:
+
+        - ``corr_pair``: Tuple containing antenna numbers.
+        """
+        prefix  = 'xengine%d_' % self.antennas
+        prefix += self.get_corr_name(corr_pair) + '_'
+        return prefix
+
+    def start_bof(self, acc_len, eq_coeff, fft_shift, insel, force_restart):
+        """
+        This function starts the bof file on the ROACH. This docstring
+        only gives a brief overview of the parameters, and more
+        comprehensive explanations can be found elsewhere within the
+        documentation.
+
+        Input:
+
+        - ``acc_len``: Integration/dump time. This can be converted \
+                to a time in seconds as \
+                :math:`t = \\dfrac{acc\_len}{f_{samp}}`.
+        - ``eq_coeff``: Equalization coefficient for the ROACH.
+        - ``fft_shift``: Integer telling which stages in the pocket \
+                correlator's FFT block to shift.
+        - ``insel``: Selects which input to use.
+        - ``force_restart``: This function forces the pocket \
+                correlator to be restarted, as opposed to letting \
+                it continue running if it was.
+
+        Return:
+
+        - ``prog_bof``: True if the ROACH was reprogrammed with the bof file. \
+                False if the bof file was already running.
+        """
+        # Start the bof process if it isn't running already.
+        prog_bof, configure = [not b for b in self.check_running()]
+        poco_bof = self.boffile
+
+        if force_restart:
+            self.log('WARNING: Forcing a restart of the bof process.')
+            self.progdev('')
+            prog_bof = True
+
+        # The ROACH2 has different initialization prcedures than the ROACH.
+        if prog_bof:
+            prog_cmd = ['adc16_init.rb', '-d', '2', self.host, poco_bof]
+            if _os.system(' '.join(prog_cmd)):
+                raise RuntimeError('ERROR: Cannot initialize ADC.')
+        else:
+            self.log('Bof process already running on FPGA.')
+        if self.verbose:
+            self.log('bof process: ' + poco_bof + '\n')
+
+        # Write FPGA parameters to the ROACH and save them.
+        if prog_bof or configure:
+            self.log('Configuring pocket correlator.')
+            self.acc_len   = acc_len
+            self.eq_coeff  = eq_coeff
+            self.fft_shift = fft_shift
+            self.insel     = insel
+            self.int_time  = self.acc_len / self.samp_rate
+            if self.verbose:
+                message = '%-20s:\t%d\n' % ('acc_length', self.acc_len)
+                message += '%-20s:\t%d\n' % ('pfb_ctrl', self.fft_shift)
+                message += '%-20s:\t%d\n\n' % ('input_source_sel', self.insel)
+            self.write_int('pfb_ctrl', self.fft_shift)
+            self.write_int('input_source_sel', self.insel)
+
+        # Return whether the bof file was started or configured
+        return prog_bof or configure
+
+    def unpack_corr(self, real_raw, imag_raw=None):
+        """
+        This function converts raw BRAM data into a complex spectrum.
+        Auto correlations have no imaginary BRAM.
+
+        Input:
+
+        - ``real_raw``: Raw data from the real BRAM.
+        - ``imag_raw``: Raw data from the imaginary BRAM.
+        """
+        cx_data      = _np.zeros(self.nchan, dtype=_np.complex64)
+        cx_data.real = _np.fromstring(real_raw, '>i4')
+        if imag_raw is not None:
+            cx_data.imag = _np.fromstring(imag_raw, '>i4')
+        return cx_data
+
+class IntegrationRing(object):
+    """
+    Bounded ring of integration buffers that is shared by a readout
+    thread and a writer thread. The readout takes free slots and fills
+    them, and the writer saves filled slots in order and frees them.
+    """
+    def __init__(self, nslots, shape, dtype=_np.complex64):
+        """
+        Allocate the buffers of the ring.
+
+        Input:
+
+        - ``nslots``: Number of integrations that the ring can hold.
+        - ``shape``: Shape of the visibility buffer of an integration.
+        - ``dtype``: Data type of the buffers.
+        """
+        self.vis = _np.zeros((nslots,) + shape, dtype=dtype)
+        self.jd = [None] * nslots
+        self.count = [None] * nslots
+        self.free = _collections.deque(range(nslots))
+        self.full = _collections.deque()
+        self.closed = False
+        self.cond = _threading.Condition()
+
+    def acquire(self, timeout=0):
+        """
+        Get a free slot to read an integration into.
+
+        Input:
+
+        - ``timeout``: Seconds to wait for a slot to be freed if every \
+                slot is waiting to be written. By default, this never \
+                blocks. If this is None, it waits until a slot is free.
+
+        Return:
+
+        - Free slot, or None if no slot was freed in time.
+        """
+        with self.cond:
+            if timeout is None:
+                while not self.free:
+                    self.cond.wait()
+            elif timeout > 0:
+                deadline = _time.time() + timeout
+                while not self.free and _time.time() < deadline:
+                    self.cond.wait(deadline - _time.time())
+            if self.free:
+                return self.free.popleft()
+            return None
+
+    def close(self):
+        """
+        Tell the writer that no more integrations are coming.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def commit(self, slot, jd, count):
+        """
+        Hand a filled slot over to the writer.
+
+        Input:
+
+        - ``slot``: Slot that the integration was read into.
+        - ``jd``: Julian date of the integration.
+        - ``count``: Integration count of the integration.
+        """
+        with self.cond:
+            self.jd[slot] = jd
+            self.count[slot] = count
+            self.full.append(slot)
+            self.cond.notify_all()
+
+    def get(self):
+        """
+        Wait for the next filled slot. This returns None once the ring
+        has been closed and every filled slot has been written.
+        """
+        with self.cond:
+            while not self.full and not self.closed:
+                self.cond.wait()
+            if self.full:
+                return self.full.popleft()
+            return None
+
+    def release(self, slot):
+        """
+        Return a slot to the pool of free slots.
+
+        Input:
+
+        - ``slot``: Slot that is no longer needed.
+        """
+        with self.cond:
+            self.free.append(slot)
+            self.cond.notify_all()
+
+class FpgaClock(object):
+    """
+    Model of the FPGA clock for timestamping integrations. The 32-bit
+    sys_clkcounter is unwrapped and anchored once to the host time.
+    Two linear fits are kept up to date: the clock counter against the
+    host time, which gives the clock rate and how much it drifts from
+    the host clock, and the clock counter against acc_num, which gives
+    the number of clocks per accumulation. Once both fits are known,
+    the time of any accumulation can be computed from the counters
+    alone, so the host doesn't have to poll closely to get it.
+    """
+    def __init__(self):
+        self.anchor = None
+        self.last = None
+        self.clock_fit = LinearFit()
+        self.acc_fit = LinearFit()
+
+    def get_acc_time(self, acc_num):
+        """
+        Get the host time at which an accumulation finishes.
+
+        Input:
+
+        - ``acc_num``: Accumulation number.
+        """
+        clk0, acc0, _ = self.anchor
+        return self.get_time(clk0 + self.acc_fit.get_y(acc_num - acc0))
+
+    def get_time(self, clk):
+        """
+        Get the host time of an unwrapped clock count.
+
+        Input:
+
+        - ``clk``: Unwrapped clock count.
+        """
+        clk0, _, host0 = self.anchor
+        return host0 + self.clock_fit.get_x(clk - clk0)
+
+    def get_drift(self, int_time):
+        """
+        Get the difference between the measured length of an
+        accumulation and its nominal length in parts per million.
+
+        Input:
+
+        - ``int_time``: Nominal integration time in seconds.
+        """
+        return 1e6 * (self.period / int_time - 1)
+
+    @property
+    def jitter(self):
+        """
+        RMS difference in seconds between the host times of the clock
+        reads and the clock model.
+        """
+        return self.clock_fit.residual / self.clock_fit.slope
+
+    @property
+    def period(self):
+        """
+        Measured length of an accumulation in host seconds.
+        """
+        return self.acc_fit.slope / self.clock_fit.slope
+
+    def ready(self):
+        """
+        Check if there are enough measurements to use the clock.
+        """
+        return self.acc_fit.n > 1 and self.clock_fit.n > 1
+
+    def update(self, clk, acc_num, host_time):
+        """
+        Add a measurement of the FPGA counters to the clock model.
+
+        Input:
+
+        - ``clk``: Value of sys_clkcounter.
+        - ``acc_num``: Value of acc_num.
+        - ``host_time``: Host time that ``clk`` was read at.
+        """
+        if self.anchor is None:
+            self.anchor = (clk, acc_num, host_time)
+            self.last = (clk, clk, host_time)
+            self.clock_fit.update(0, 0)
+            self.acc_fit.update(0, 0)
+            return
+
+        # The counter can wrap more than once between reads if the
+        # integrations are long, so the host time is used to count wraps.
+        raw_last, unwrapped, host_last = self.last
+        delta = (clk - raw_last) & 0xffffffff
+        if self.clock_fit.n > 1:
+            expected = (host_time - host_last) * self.clock_fit.slope
+            delta += int(round((expected - delta) / float(1 << 32))) << 32
+        unwrapped += delta
+        self.last = (clk, unwrapped, host_time)
+
+        clk0, acc0, host0 = self.anchor
+        self.clock_fit.update(host_time - host0, unwrapped - clk0)
+        self.acc_fit.update(acc_num - acc0, unwrapped - clk0)
+
+class LstCache(object):
+    """
+    Fast local sidereal time lookup. Computing the LST with the antenna
+    array is slow, especially on ARM boards, so the LST is computed at
+    a grid of Julian dates covering a window of time and the LST of any
+    Julian date in that window is linearly interpolated from the grid.
+    When a Julian date falls outside of the window, the grid is remade
+    starting from there, so each refresh costs a fixed number of exact
+    LST computations.
+
+    Input:
+
+    - ``aa``: Antenna array made from the calibration file, with the \
+            longitude of the observatory.
+    - ``step``: Time between LST computations in seconds.
+    - ``window``: Length of the time window in seconds.
+    """
+    def __init__(self, aa, step=LST_STEP, window=LST_WINDOW):
+        self.aa = aa
+        self.step = step / 86400.
+        self.nsteps = int(_np.ceil(window / step))
+        self.jd0 = None
+        self.lst = None
+        self.refreshes = 0
+
+    def get_lst(self, jd):
+        """
+        Get the local sidereal time of a Julian date in radians.
+
+        Input:
+
+        - ``jd``: Julian date.
+        """
+        index = (jd - self.jd0) / self.step if self.jd0 is not None else -1
+        if not 0 <= index < self.nsteps:
+            self.refresh(jd)
+            index = (jd - self.jd0) / self.step
+
+        i = int(index)
+        lst = self.lst[i] + (index - i) * (self.lst[i+1] - self.lst[i])
+        return lst % (2 * _np.pi)
+
+    def get_exact_lst(self, jd):
+        """
+        Compute the local sidereal time of a Julian date in radians
+        with the antenna array.
+
+        Input:
+
+        - ``jd``: Julian date.
+        """
+        self.aa.set_jultime(jd)
+        return float(self.aa.sidereal_time())
+
+    def refresh(self, jd):
+        """
+        Remake the LST grid with a window starting a step before a
+        Julian date, so that slightly earlier dates are still covered.
+
+        Input:
+
+        - ``jd``: Julian date.
+        """
+        self.jd0 = jd - self.step
+        jds = self.jd0 + self.step * _np.arange(self.nsteps + 1)
+        self.lst = _np.unwrap([self.get_exact_lst(t) for t in jds]).tolist()
+        self.refreshes += 1
+
+class LinearFit(object):
+    """
+    Running least squares fit of a line y = slope * x + intercept. The
+    means and co-moments are updated in a numerically stable way, so
+    the fit doesn't lose precision as the number of points grows.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.cxx = 0.0
+        self.cxy = 0.0
+        self.cyy = 0.0
+
+    def get_x(self, y):
+        """
+        Invert the fit.
+        """
+        return (y - self.intercept) / self.slope
+
+    def get_y(self, x):
+        """
+        Evaluate the fit.
+        """
+        return self.slope * x + self.intercept
+
+    @property
+    def intercept(self):
+        return self.mean_y - self.slope * self.mean_x
+
+    @property
+    def residual(self):
+        return _np.sqrt(max(self.cyy - self.cxy**2 / self.cxx, 0) / self.n)
+
+    @property
+    def slope(self):
+        return self.cxy / self.cxx
+
+    def update(self, x, y):
+        """
+        Add a point to the fit.
+        """
+        self.n += 1
+        dx = x - self.mean_x
+        dy = y - self.mean_y
+        self.mean_x += dx / float(self.n)
+        self.mean_y += dy / float(self.n)
+        self.cxx += dx * (x - self.mean_x)
+        self.cxy += dx * (y - self.mean_y)
+        self.cyy += dy * (y - self.mean_y)
+
+class ChecksumCache(object):
+    """
+    Checksums of the blocks of the data files, kept in a file between
+    readouts. The checksums of a file are only used while it has the
+    size and modification time that it had when they were computed.
+    The cache can be shared by threads.
+
+    Input:
+
+    - ``filename``: File to keep the checksums in, or None to not keep \
+            them.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = _threading.Lock()
+        self.checksums = {}
+        if filename is not None and _os.path.exists(filename):
+            try:
+                with open(filename) as fileobj:
+                    self.checksums = _ast.literal_eval(fileobj.read())
+            except (SyntaxError, ValueError):
+                pass
+
+    def get(self, path, size, mtime):
+        """
+        Get the checksums of a file, or None if they aren't known for
+        its size and modification time.
+        """
+        with self.lock:
+            cached = self.checksums.get(path)
+        if cached is None or cached[:2] != (size, mtime):
+            return None
+        return cached[2]
+
+    def put(self, path, size, mtime, checksums):
+        """
+        Keep the checksums of a file with its size and modification time.
+        """
+        with self.lock:
+            self.checksums[path] = (size, mtime, checksums)
+
+    def save(self):
+        """
+        Save the checksums to the file, forgetting the files that are
+        gone.
+        """
+        if self.filename is None:
+            return
+        with self.lock:
+            checksums = {k: v for k, v in self.checksums.items()
+                         if _os.path.exists(k)}
+        with open(self.filename + '.tmp', 'w') as fileobj:
+            fileobj.write(repr(checksums))
+        _os.rename(self.filename + '.tmp', self.filename)
+
+class RateLimiter(object):
+    """
+    Limit the rate that threads send data at together. Each send books
+    the next slot of time on the link that is long enough for it at the
+    rate, and waits for its slot to start. A rate of 0 doesn't limit
+    anything. The rate can be a function that returns it, which is
+    called on every send, so the rate follows it while the threads are
+    sending.
+    """
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.lock = _threading.Lock()
+        self.next_time = _time.time()
+
+    def get_rate(self):
+        """
+        Get the rate in bytes per second that the data is sent at.
+        """
+        if callable(self.rate):
+            return self.rate()
+        return self.rate
+
+    def wait(self, nbytes):
+        """
+        Wait until there is room at the rate to send some data.
+        """
+        rate = self.get_rate()
+        if not rate:
+            return
+        with self.lock:
+            now = _time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + nbytes / float(rate)
+        if start > now:
+            _time.sleep(start - now)
+
+class Writer(object):
+    """
+    Base class for the data file writers that ``retrieve_data`` saves
+    integrations with. A writer writes into a temporary file and renames
+    it to a file named by the Julian date when it is closed.
+
+    Input:
+
+    - ``roach``: POCO object that the data is read from.
+    - ``plan``: Readout plan that the integrations are read with.
+    - ``tmp_file``: Temporary name of the data file. Defaults to the \
+            temporary file of the correlator.
+
+    Writers with ``raw`` set are given the raw BRAM data read with
+    ``read_raw`` instead of decoded visibilities.
+
+    Writers of data files implement:
+
+    - ``open()``: Start a new data file.
+    - ``write(jd, vis, count=None, inttime=None)``: Write one \
+            integration, given its Julian date, visibility buffer, \
+            accumulation number and integration time, if it isn't the \
+            one in the header.
+    - ``finish()``: Finish writing the data file, and return whether \
+            a data file was open.
+
+    Writers that pass the integrations on to another writer, like
+    ``RotatingWriter`` and ``AveragingWriter``, don't have a data file
+    of their own. They implement ``open``, ``write`` and ``close()``
+    instead, passing each on to the writer that they wrap. They name
+    no file when they are closed and they can't be discarded.
+    """
+    ext = None
+    raw = False
+
+    def __init__(self, roach, plan, tmp_file=None):
+        self.roach = roach
+        self.plan = plan
+        self.tmp_file = tmp_file or roach.tmp_file
+
+    def close(self, filename=None):
+        """
+        Finish writing the data file and rename it.
+
+        Input:
+
+        - ``filename``: New name of the data file. By default, the file \
+                is named after the correlator and the Julian date.
+        """
+        if not self.finish():
+            return
+
+        # Files closed close together get a sequence number to tell them
+        # apart, since the Julian date only resolves about a tenth of a second.
+        roach = self.roach
+        if filename is None:
+            jd = '%.6f' % get_jul_date()
+            filename = '.'.join([roach.filename, jd, self.ext])
+            seq = 0
+            while _os.path.exists(filename):
+                seq += 1
+                filename = '.'.join([roach.filename, jd, str(seq), self.ext])
+        roach.log('POCO%d: Closing data file and renaming to %s.' %
+                  (roach.antennas, filename))
+        _os.rename(self.tmp_file, filename)
+
+    def discard(self):
+        """
+        Finish writing the data file and delete it.
+        """
+        if not self.finish():
+            return
+        if _os.path.isdir(self.tmp_file):
+            _shutil.rmtree(self.tmp_file)
+        else:
+            _os.remove(self.tmp_file)
+
+class AipyWriter(Writer):
+    """
+    Writer for Miriad UV files using aipy.
+    """
+    ext = 'uv'
+
+    def finish(self):
+        # The UV file is closed when the aipy object is deleted.
+        try:
+            del self.uv
+        except AttributeError:
+            return False
+        return True
+
+    def open(self):
+        self.uv = self.roach.new_uv(self.tmp_file)
+        self.header_inttime = dict(self.roach.get_uv_header())['inttime']
+        self.inttime = self.header_inttime
+
+    def write(self, jd, vis, count=None, inttime=None):
+        # The integration time is a variable that only changes when an
+        # integration isn't as long as the header says.
+        if inttime is None:
+            inttime = self.header_inttime
+        if inttime != self.inttime:
+            self.uv['inttime'] = inttime
+            self.inttime = inttime
+        self.roach.uv_write_integration(self.uv, jd, vis, self.plan)
+
+class MiriadWriter(Writer):
+    """
+    Writer for Miriad UV files that doesn't use aipy. The records of
+    the variables are built the same way that the Miriad library
+    writes them, so the files are read by aipy and Miriad like the
+    ones written by ``AipyWriter``, but each integration is written to
+    the visibility and flag files with a single write each.
+    """
+    ext = 'uv'
+
+    def add_var(self, name, vtype):
+        """
+        Add a variable to the variable table of the data set.
+
+        Input:
+
+        - ``name``: Name of the variable.
+        - ``vtype``: Miriad type of the variable.
+
+        Output:
+
+        - The new variable.
+        """
+        # The data is aligned to its size and the record to 8 bytes.
+        index = len(self.variables)
+        size = _np.dtype(MIRIAD_TYPES[vtype][0]).itemsize
+        hdr = chr(index) + '\0\1\0' + '\0' * (max(4, size) - 4)
+        var = {'index': index, 'type': vtype, 'length': 0, 'hdr': hdr,
+               'pad': '', 'value': None, 'callno': 0, 'nocheck': False}
+        self.variables[name] = var
+        return var
+
+    def finish(self):
+        try:
+            self.vis_file
+        except AttributeError:
+            return False
+
+        # The last word of the flag mask is padded with bad channels.
+        if len(self.mask_bits):
+            pad = _np.zeros(MIRIAD_MASK_BITS, dtype=bool)
+            self.mask_file.write(self.pack_mask(pad)[0])
+        self.vis_file.close()
+        self.mask_file.close()
+        del self.vis_file
+
+        # Like the Miriad library, a small flag mask is kept in the header
+        # and no mask is made if there are no records.
+        mask_path = self.mask_file.name
+        if not self.ncorr:
+            _os.remove(mask_path)
+        elif _os.path.getsize(mask_path) <= MIRIAD_CACHE_SIZE:
+            with open(mask_path, 'rb') as f:
+                self.items['flags'] = f.read()
+            _os.remove(mask_path)
+
+        # Items that the Miriad library writes when a data set is closed.
+        vartable = ['%s %s\n' % (v['type'], name)
+                    for name, v in self.variables.items()]
+        self.put_item('vartable', ''.join(vartable), 'a')
+        self.put_item('nwcorr', 0, 'l')
+        self.put_item('ncorr', self.ncorr, 'l')
+        self.put_item('vislen', self.offset + len(self.pad), 'l')
+        self.write_items()
+        return True
+
+    def open(self):
+        roach = self.roach
+        header = roach.get_uv_header()
+        _os.mkdir(self.tmp_file)
+        self.vis_file = open(_os.path.join(self.tmp_file, 'visdata'), 'wb')
+        self.mask_file = open(_os.path.join(self.tmp_file, 'flags'), 'wb')
+        self.mask_file.write('\0\0\0' + chr(MIRIAD_TYPES['i'][1]))
+        self.mask_bits = _np.zeros(0, dtype=bool)
+        self.mask_words = {}
+        self.ncorr = 0
+        self.offset = 0
+        self.pad = ''
+
+        # The flags and baseline numbers are the same for every integration.
+        nchan = roach.get_band()[2]
+        good = _np.ones(nchan, dtype=bool)
+        good[roach.get_dc_chans()] = False
+        self.dc_chans = _np.logical_not(good)
+        self.mask_template = _np.tile(good, len(self.plan.baselines))
+        self.preambles = []
+        for pair in self.plan.baselines:
+            i, j = sorted(pair)
+            if i + 1 < 256 and j + 1 < 256:
+                bl = ((i + 1) << 8) | (j + 1)
+            else:
+                bl = (i + 1) * 2048 + (j + 1 + 65536)
+            coord = (float(i), float(j), 0.)
+            self.preambles.append((coord, encode_miriad('d', coord),
+                                   bl, encode_miriad('r', bl)))
+        self.coord = self.time = self.baseline = None
+
+        self.items = _collections.OrderedDict()
+        self.variables = _collections.OrderedDict()
+        self.add_var('corr', 'r')['nocheck'] = True
+        records = []
+        for name, value in header:
+            if name in UV_ITEM_TYPES:
+                self.put_item(name, value)
+            else:
+                data = encode_miriad(UV_VAR_TYPES[name], value)
+                self.put_var(name, data, records)
+        self.write_records(records)
+        self.header_inttime = dict(header)['inttime']
+        self.inttime = self.header_inttime
+
+        # The Miriad library sets the type of observation from the records
+        # when the data set is closed. Every integration has all of the
+        # baselines of the plan, so it's set now in case there are none.
+        autos = [i == j for i, j in self.plan.baselines]
+        if all(autos):
+            obstype = 'autocorrelation'
+        elif any(autos):
+            obstype = 'mixed-auto-cross'
+        else:
+            obstype = 'crosscorrelation'
+        self.items['obstype'] = '\0\0\0\1' + obstype
+
+    def pack_mask(self, bits):
+        """
+        Pack flags that are appended to the flag mask into words of
+        MIRIAD_MASK_BITS bits, with the bits set for good data.
+
+        Input:
+
+        - ``bits``: Boolean array of the flags, which is True for good data.
+
+        Output:
+
+        - The packed words of the mask and the flags that are left over.
+        """
+        bits = _np.concatenate([self.mask_bits, bits])
+        nwords = len(bits) / MIRIAD_MASK_BITS
+        nbits = nwords * MIRIAD_MASK_BITS
+        words = bits[:nbits].reshape((nwords, MIRIAD_MASK_BITS))
+        words = words.dot(1 << _np.arange(MIRIAD_MASK_BITS))
+        return words.astype('>i4').tostring(), bits[nbits:]
+
+    def put_item(self, name, value, itype=None):
+        """
+        Set the contents of a header item of the data set.
+
+        Input:
+
+        - ``name``: Name of the item.
+        - ``value``: Value of the item.
+        - ``itype``: Miriad type of the item. Defaults to the type in \
+                UV_ITEM_TYPES.
+        """
+        if itype is None:
+            itype = UV_ITEM_TYPES[name]
+        if itype == 'a':
+            item = str(value)
+        elif itype == '?':
+            # Number of antennas followed by the channels of each window.
+            nwin = (len(value) - 1) / 3
+            item = _struct.pack('>i4x' + 'i4xdd' * nwin, *value)
+        else:
+            dtype, code = MIRIAD_TYPES[itype]
+            size = _np.dtype(dtype).itemsize
+            item = ('\0\0\0' + chr(code)).ljust(max(4, size), '\0')
+            item += encode_miriad(itype, value)
+        self.items[name] = item
+
+    def put_var(self, name, data, records):
+        """
+        Set the value of a variable. The records that the Miriad library
+        would write for the new value are added to a list of records.
+
+        Input:
+
+        - ``name``: Name of the variable.
+        - ``data``: Value of the variable encoded with ``encode_miriad``.
+        - ``records``: List of records for the visibility file.
+        """
+        var = self.variables.get(name)
+        if var is None:
+            var = self.add_var(name, UV_VAR_TYPES[name])
+
+        # The length is written whenever it changes.
+        changed = var['nocheck']
+        if var['length'] != len(data):
+            changed = True
+            var['length'] = len(data)
+            var['pad'] = '\0' * (-(len(var['hdr']) + len(data)) % 8)
+            records.append(_struct.pack('>B3xi', var['index'], len(data)))
+        if not changed:
+            changed = data != var['value']
+        if not changed:
+            var['callno'] = 0
+            return
+
+        records += [var['hdr'], data, var['pad']]
+        if var['callno'] > MIRIAD_CHECK_THRESH:
+            var['nocheck'] = True
+        elif not var['nocheck']:
+            var['value'] = data
+        var['callno'] += 1
+
+    def write(self, jd, vis, count=None, inttime=None):
+        # to get rid of the dc offset. causes plots to be "quantized"
+        vis[:, self.dc_chans] = 0
+
+        records = []
+        if inttime is None:
+            inttime = self.header_inttime
+        if inttime != self.inttime:
+            self.put_var('inttime', encode_miriad('r', inttime), records)
+            self.inttime = inttime
+        lst = encode_miriad('d', self.roach.lst_cache.get_lst(jd))
+        self.put_var('ra', lst, records)
+        self.put_var('obsra', lst, records)
+        self.put_var('lst', lst, records)
+        self.put_var('pol', encode_miriad('i', MIRIAD_POL_XX), records)
+        if 'coord' not in self.variables:
+            for name, vtype in [('coord', 'd'), ('time', 'd'),
+                                ('baseline', 'r')]:
+                self.add_var(name, vtype)['nocheck'] = True
+
+        # The preamble variables are only written when they change.
+        nchan = vis.shape[1]
+        corr = self.variables['corr']
+        data = vis.astype('>c8')
+        eor = '\0\0\2\0'
+        for (coord, coord_data, bl, bl_data), corr_data in \
+                zip(self.preambles, data):
+            if corr['length'] != 8 * nchan:
+                self.put_var('nchan', encode_miriad('i', nchan), records)
+            self.put_var('corr', corr_data.tostring(), records)
+            if coord != self.coord:
+                self.put_var('coord', coord_data, records)
+                self.coord = coord
+            if jd != self.time:
+                self.put_var('time', encode_miriad('d', jd), records)
+                self.time = jd
+            if bl != self.baseline:
+                self.put_var('baseline', bl_data, records)
+                self.baseline = bl
+            records.append(eor)
+            records.append('\0' * 4)
+
+        # Like the Miriad library, the padding of the last record is only
+        # written to the file with the next record.
+        self.write_records(records[:-1])
+        self.pad = records[-1]
+
+        # The flags of an integration only depend on where the flags of the
+        # last one stopped in the mask, so they are packed once per offset.
+        key = len(self.mask_bits)
+        if key not in self.mask_words:
+            self.mask_words[key] = self.pack_mask(self.mask_template)
+        words, self.mask_bits = self.mask_words[key]
+        self.mask_file.write(words)
+        self.ncorr += len(self.mask_template)
+
+    def write_items(self):
+        """
+        Write the header items of the data set. Small items are stored in
+        the header file in the reverse order of when they were created and
+        the others are stored in files of their own.
+        """
+        header = []
+        for name, item in self.items.items():
+            if len(item) > MIRIAD_CACHE_SIZE or name == 'history':
+                with open(_os.path.join(self.tmp_file, name), 'wb') as f:
+                    f.write(item)
+            else:
+                header.insert(0, name.ljust(15, '\0') + chr(len(item)) + item)
+
+        # Items in the header file are aligned to 16 bytes.
+        header = [h + '\0' * (-len(h) % 16) for h in header[:-1]] + header[-1:]
+        with open(_os.path.join(self.tmp_file, 'header'), 'wb') as f:
+            f.write(''.join(header))
+
+    def write_records(self, records):
+        """
+        Write records to the visibility file.
+
+        Input:
+
+        - ``records``: List of records for the visibility file.
+        """
+        records = ''.join(records)
+        self.vis_file.write(self.pad)
+        self.vis_file.write(records)
+        self.offset += len(self.pad) + len(records)
+        self.pad = ''
+
+class NumpyWriter(Writer):
+    """
+    Writer that saves the visibilities as raw numpy arrays. Each data
+    file is a directory holding the visibilities in an array with the
+    dimensions ``(ntimes, nbaselines, nchan)``, the Julian dates and
+    integration times of the integrations, the baselines, the
+    frequencies in GHz and the flags of the channels. Integrations are
+    buffered and appended to the arrays a block of NUMPY_CHUNK
+    integrations at a time.
+    """
+    ext = 'vis'
+
+    def finish(self):
+        try:
+            self.vis_file
+        except AttributeError:
+            return False
+        self.flush()
+        self.vis_file.close()
+        self.jd_file.close()
+        self.inttime_file.close()
+        del self.vis_file
+        return True
+
+    def flush(self):
+        """
+        Append the buffered integrations to the arrays on disk.
+        """
+        if self.nbuffered:
+            self.vis_file.append(self.vis[:self.nbuffered])
+            self.jd_file.append(self.jd[:self.nbuffered])
+            self.inttime_file.append(self.inttime[:self.nbuffered])
+            self.nbuffered = 0
+
+    def open(self):
+        roach = self.roach
+        _os.mkdir(self.tmp_file)
+        path = lambda name: _os.path.join(self.tmp_file, name + '.npy')
+
+        sdf, sfreq, nchan = roach.get_band()
+        flags = _np.zeros(nchan, dtype=bool)
+        flags[roach.get_dc_chans()] = True
+        _np.save(path('baselines'), _np.array(self.plan.baselines))
+        _np.save(path('freqs'), sfreq + sdf * _np.arange(nchan))
+        _np.save(path('flags'), flags)
+
+        shape = (len(self.plan.baselines), nchan)
+        self.vis = _np.zeros((NUMPY_CHUNK,) + shape, dtype=_np.complex64)
+        self.jd = _np.zeros(NUMPY_CHUNK)
+        self.inttime = _np.zeros(NUMPY_CHUNK)
+        self.header_inttime = roach.int_time * roach.navg
+        self.nbuffered = 0
+        self.vis_file = NpyAppender(path('vis'), shape, _np.complex64)
+        self.jd_file = NpyAppender(path('jd'), (), _np.float64)
+        self.inttime_file = NpyAppender(path('inttime'), (), _np.float64)
+
+    def write(self, jd, vis, count=None, inttime=None):
+        if inttime is None:
+            inttime = self.header_inttime
+        self.vis[self.nbuffered] = vis
+        self.jd[self.nbuffered] = jd
+        self.inttime[self.nbuffered] = inttime
+        self.nbuffered += 1
+        if self.nbuffered == NUMPY_CHUNK:
+            self.flush()
+
+class CompactWriter(Writer):
+    """
+    Writer for compact archival files. The visibilities are stored as
+    pairs of 32-bit integers, the way the BRAM's hold them, and the DC
+    channels are only recorded once per file in a mask. The writer is
+    given the raw BRAM data, which is byte-swapped straight into the
+    integers of each baseline, so no precision is lost. Integrations are
+    buffered and written a block of COMPACT_CHUNK at a time, with the
+    data of each baseline across time in its own stream. The streams
+    can hold the differences between consecutive integrations and are
+    compressed with zlib, as set by ``set_compression``. The files are
+    read with ``read_compact``.
+    """
+    ext = 'pcz'
+    raw = True
+
+    def finish(self):
+        try:
+            self.fileobj
+        except AttributeError:
+            return False
+        self.flush()
+        self.fileobj.seek(0)
+        self.fileobj.write(pack_header(COMPACT_MAGIC, self.header))
+        self.fileobj.close()
+        del self.fileobj
+        return True
+
+    def flush(self):
+        """
+        Compress the buffered integrations and write them as a block.
+        """
+        nbuffered = self.nbuffered
+        if not nbuffered:
+            return
+        data = self.data[:, :nbuffered]
+        if self.delta:
+            data = data.copy()
+            data[:, 1:] -= self.data[:, :nbuffered-1]
+        # The bytes of the integers are grouped by significance, so that the
+        # mostly constant high bytes compress well.
+        if self.level:
+            streams = []
+            for stream in data:
+                stream = stream.view(_np.uint8).reshape(-1, 4).T.tostring()
+                streams.append(_zlib.compress(stream, self.level))
+        else:
+            streams = [stream.tostring() for stream in data]
+
+        self.fileobj.write(_struct.pack('<I', nbuffered))
+        self.fileobj.write(self.jd[:nbuffered].astype('<f8').tostring())
+        self.fileobj.write(_struct.pack('<%dI' % len(streams),
+                                        *map(len, streams)))
+        self.fileobj.write(''.join(streams))
+        self.header['nintegs'] += nbuffered
+        self.nbuffered = 0
+
+    def open(self):
+        roach = self.roach
+        sdf, sfreq, nchan = roach.get_band()
+        self.dc_chans = roach.get_dc_chans()
+        self.level, self.delta = roach.compression
+        self.header = {'poco': roach.poco,
+                       'baselines': list(self.plan.baselines),
+                       'sdf': sdf,
+                       'sfreq': sfreq,
+                       'nchan': nchan,
+                       'inttime': roach.int_time,
+                       'flags': self.dc_chans,
+                       'level': self.level,
+                       'delta': self.delta,
+                       'nintegs': 0}
+
+        # Where each integer of a baseline is in the raw data. Each row of
+        # a BRAM holds one channel from every FFT stage.
+        nbl = len(self.plan.baselines)
+        self.index = _np.zeros((nbl, nchan, 2), dtype=_np.intp)
+        self.conj = []
+        self.real_only = []
+        offsets = _np.cumsum([0] + [dev[1] / 4 for dev in self.plan.devices])
+        dev = 0
+        for bram in self.plan.brams:
+            real_start = offsets[dev]
+            imag_start = bram.read_imag and offsets[dev + 1]
+            dev += 1 + bram.read_imag
+            nstages = len(bram.slots)
+            for stage, slot in enumerate(bram.slots):
+                if slot is None:
+                    continue
+                rows = nstages * _np.arange(nchan) + stage
+                self.index[slot, :, 0] = real_start + rows
+                if not bram.read_imag:
+                    self.real_only.append(slot)
+                    continue
+                self.index[slot, :, 1] = imag_start + rows
+                if bram.conj[stage]:
+                    self.conj.append(slot)
+        self.conj = _np.array(self.conj, dtype=_np.intp)
+        self.real_only = _np.array(self.real_only, dtype=_np.intp)
+
+        self.data = _np.zeros((nbl, COMPACT_CHUNK, nchan, 2), dtype='<i4')
+        self.jd = _np.zeros(COMPACT_CHUNK)
+        self.nbuffered = 0
+        self.fileobj = open(self.tmp_file, 'wb')
+        self.fileobj.write(pack_header(COMPACT_MAGIC, self.header))
+
+    def write(self, jd, vis, count=None, inttime=None):
+        data = self.data[:, self.nbuffered]
+        data[...] = vis.view('>i4')[self.index]
+        data[self.real_only, :, 1] = 0
+        data[self.conj, :, 1] *= -1
+        data[:, self.dc_chans] = 0
+        self.jd[self.nbuffered] = jd
+        self.nbuffered += 1
+        if self.nbuffered == COMPACT_CHUNK:
+            self.flush()
+
+class JournalWriter(Writer):
+    """
+    Writer that saves the raw BRAM data of the integrations without
+    decoding it, so that as little work as possible is done while the
+    data is being taken. The journal starts with a header holding the
+    setup of the correlator, followed by one record per integration
+    with the accumulation number, the Julian date, the correlator model
+    and the raw data. The file is memory mapped and grown a block of
+    JOURNAL_CHUNK records at a time. Journals are turned into data files
+    of the other formats with ``convert_journal``.
+    """
+    ext = 'journal'
+    raw = True
+
+    def finish(self):
+        try:
+            self.records
+        except AttributeError:
+            return False
+        del self.records
+        self.write_header(self.nrecords)
+        self.fileobj.truncate(HEADER_SIZE
+                              + self.nrecords * self.dtype.itemsize)
+        self.fileobj.close()
+        return True
+
+    def grow(self):
+        """
+        Extend the journal by JOURNAL_CHUNK records and map the new end.
+        """
+        self.maxrecords += JOURNAL_CHUNK
+        self.fileobj.truncate(HEADER_SIZE
+                              + self.maxrecords * self.dtype.itemsize)
+        self.records = _np.memmap(self.fileobj, self.dtype, 'r+',
+                                  HEADER_SIZE, (self.maxrecords,))
+
+    def open(self):
+        payload = sum([dev[1] for dev in self.plan.devices])
+        self.dtype = journal_dtype(payload)
+        self.fileobj = open(self.tmp_file, 'w+b')
+        self.nrecords = 0
+        self.maxrecords = 0
+        self.write_header(None)
+        self.grow()
+
+    def write(self, jd, vis, count=None, inttime=None):
+        if self.nrecords == self.maxrecords:
+            self.records.flush()
+            self.grow()
+        if count is None:
+            count = -1
+        self.records[self.nrecords] = (count, jd, self.roach.model, vis)
+        self.nrecords += 1
+
+    def write_header(self, nrecords):
+        """
+        Write the header of the journal.
+
+        Input:
+
+        - ``nrecords``: Number of records in the journal, or None while \
+                the journal is still being written.
+        """
+        roach = self.roach
+        header = {'poco': roach.poco,
+                  'calfile': roach.calfile,
+                  'samp_rate': roach.samp_rate,
+                  'nyquist': roach.nyquist,
+                  'int_time': roach.int_time,
+                  'acc_len': roach.acc_len,
+                  'chan_range': roach.chan_range,
+                  'baselines': list(self.plan.baselines),
+                  'payload': self.dtype['payload'].shape[0],
+                  'nrecords': nrecords}
+        self.fileobj.seek(0)
+        self.fileobj.write(pack_header(JOURNAL_MAGIC, header))
+        self.fileobj.flush()
+
+class NpyAppender(object):
+    """
+    Numpy .npy file that arrays are appended to along the first axis.
+    The header is padded to a fixed size so that it can be rewritten
+    with the final length of the array when the file is closed.
+
+    Input:
+
+    - ``filename``: Name of the .npy file.
+    - ``shape``: Shape of each entry of the array.
+    - ``dtype``: Data type of the array.
+    """
+    def __init__(self, filename, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = _np.dtype(dtype)
+        self.length = 0
+        self.fileobj = open(filename, 'wb')
+        self.write_header()
+
+    def append(self, data):
+        """
+        Append entries to the end of the array.
+
+        Input:
+
+        - ``data``: Array with dimensions ``(n,) + shape``.
+        """
+        _np.ascontiguousarray(data, dtype=self.dtype).tofile(self.fileobj)
+        self.length += len(data)
+
+    def close(self):
+        """
+        Write the final header and close the file.
+        """
+        self.write_header()
+        self.fileobj.close()
+
+    def write_header(self):
+        """
+        Write the header for the current length of the array.
+        """
+        header = {'descr': _np.lib.format.dtype_to_descr(self.dtype),
+                  'fortran_order': False,
+                  'shape': (self.length,) + self.shape}
+        magic = '\x93NUMPY\x01\x00'
+        header_len = NPY_HEADER_SIZE - len(magic) - 2
+        header = repr(header).ljust(header_len - 1) + '\n'
+
+        self.fileobj.seek(0)
+        self.fileobj.write(magic + _struct.pack('<H', header_len) + header)
+        self.fileobj.seek(0, 2)
+
+WRITERS = {'compact': CompactWriter,
+           'journal': JournalWriter,
+           'miriad': AipyWriter,
+           'miriad-numpy': MiriadWriter,
+           'numpy': NumpyWriter}
+
+class RotatingWriter(Writer):
+    """
+    Writer that starts a new data file whenever the rotation policy of
+    the correlator says so. Files are written with the writer for the
+    data format of the correlator. The next file is opened in the
+    background while the current one is written, and a finished file is
+    closed in the background, so a rotation is only a swap of the two
+    files between integrations.
+
+    Input:
+
+    - ``roach``: POCO object that the data is read from.
+    - ``plan``: Readout plan that the integrations are read with.
+    """
+    def __init__(self, roach, plan):
+        Writer.__init__(self, roach, plan)
+        self.writer_class = WRITERS[roach.writer_fmt]
+        self.ext = self.writer_class.ext
+        self.raw = self.writer_class.raw
+        self.mode, self.limit = roach.rotation
+        self.nfiles = 0
+        self.current = None
+        self.next = None
+        self.thread = None
+        self.error = None
+
+    def close(self):
+        if self.current is None:
+            return
+        try:
+            self.wait()
+        finally:
+            self.current.close()
+            self.next.discard()
+            self.current = self.next = None
+
+    def get_lst_bin(self, jd):
+        """
+        Get the number of the block of ``limit`` hours of LST that a
+        Julian date is in.
+
+        Input:
 
-    def poco_recall(self):
+        - ``jd``: Julian date.
+
+        Output:
+
+        - Number of the LST block.
         """
-        If the bof process is alredy running, this function retrieves
-        the sync selection and the integration counter from the
-        correlator.
+        lst_hours = self.roach.lst_cache.get_lst(jd) * 12 / _np.pi
+        return int(lst_hours / self.limit)
+
+    def new_writer(self):
         """
-        self.count = self.read_int('acc_num')
-        self.acc_len = self.read_int('acc_length')
-        self.fft_shift = self.read_int('pfb_ctrl')
-        self.insel = self.read_int('input_source_sel')
-        self.int_time  = self.acc_len / self.samp_rate
+        Make the writer for a new data file. The data files alternate
+        between two temporary files named after the one of the correlator.
 
-    def read_corr(self, corr_pair):
+        Output:
+
+        - The writer, which hasn't been opened yet.
         """
-        This function reads out cross-multiplied data from a specific
-        BRAM on the ROACH and returns data from the two FFT stages.
+        tmp_file = self.roach.tmp_file + str(self.nfiles % 2)
+        self.nfiles += 1
+        return self.writer_class(self.roach, self.plan, tmp_file)
+
+    def open(self):
+        self.current = self.new_writer()
+        self.current.open()
+        self.start_file()
+        self.next = self.new_writer()
+        self.run_background(self.next.open)
+
+    def rotate(self):
+        """
+        Swap the current data file with the one that was opened ahead of
+        time. The old one is closed and the file after the new one is
+        opened in the background.
+        """
+        self.wait()
+        self.roach.log('Starting a new data file.')
+        old, self.current = self.current, self.next
+        self.start_file()
+        self.next = self.new_writer()
+        self.run_background(old.close, self.next.open)
+
+    def rotation_due(self, jd, vis):
+        """
+        Check if an integration belongs in a new data file.
 
         Input:
 
-        - ``corr_pair``: Tuple telling which two antennas being \
-                cross-correlated need to be read from the ROACH.
+        - ``jd``: Julian date of the integration.
+        - ``vis``: Visibility buffer holding the integration.
 
-        Return:
+        Output:
 
-        - Data in the structure np.array([stage1, stage2])
+        - Whether the data files need to be rotated before writing.
         """
-        # Generate the device names
-        prefix   = 'xengine%d_' % self.antennas
-        prefix  += self.get_corr_name(corr_pair) + '_'
-        real_dev = prefix + 'real'
-        imag_dev = prefix + 'imag'
-
-        # Read the BRAM's
-        real_raw = self.read(real_dev, self.bram_size)
-        if corr_pair[0] != corr_pair[1]:
-            imag_raw = self.read(imag_dev, self.bram_size)
+        if self.nintegs == 0:
+            return False
+        elif self.mode == 'integrations':
+            return self.nintegs >= self.limit
+        elif self.mode == 'bytes':
+            return self.nbytes + vis.nbytes > self.limit
+        elif self.mode == 'seconds':
+            return (jd - self.start_jd) * 86400 >= self.limit
         else:
-            imag_raw = '\x00' * self.bram_size
+            return self.get_lst_bin(jd) != self.get_lst_bin(self.start_jd)
 
-        # Convert the strings to numeric data
-        cx_data      = _np.zeros(self.nchan, dtype=_np.complex64)
-        cx_data.real = _np.fromstring(real_raw, '>i4')
-        cx_data.imag = _np.fromstring(imag_raw, '>i4')
-        return cx_data
+    def run_background(self, *functions):
+        """
+        Run functions one after another in a background thread. Errors
+        are raised the next time that the thread is waited for.
+
+        Input:
 
-    def retrieve_data(self, antenna_list=None):
+        - ``functions``: Functions to run, without arguments.
         """
-        This function retrieves data off of the ROACH and writes it to
-        uv files.
+        def target():
+            try:
+                for function in functions:
+                    function()
+            except Exception as error:
+                self.error = error
+        self.thread = _threading.Thread(target=target)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start_file(self):
         """
-        ants  = self.antennas
-        start = self.count
-        if antenna_list is not None and self.model == 2:
-            antenna_list = map(self.get_ant_ind, antenna_list)
-        while True:
-            jd = self.poll()
-            if self.mp:
-                self.queue.put(('num', self.count))
-            else:
-                print 'POCO%d: Integration count: %d' % (ants, self.count)
+        Reset the size of the current data file.
+        """
+        self.nintegs = 0
+        self.nbytes = 0
+        self.start_jd = None
 
-            # Read and save data from all BRAM's
-            try:
-                for pair in self.pairs:
-                    if self.check_corr(pair, antenna_list):
-                        corr_data = self.read_corr(pair)
-                        self.uv_update(pair, corr_data, jd)
-            except RuntimeError:
-                self.log('WARNING: Cannot reach the ROACH. Skipping integration.')
-                self.reconnect()
-                continue
+    def wait(self):
+        """
+        Wait for the background thread to finish opening and closing files.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, jd, vis, count=None, inttime=None):
+        if self.rotation_due(jd, vis):
+            self.rotate()
+        if self.nintegs == 0:
+            self.start_jd = jd
+        self.current.write(jd, vis, count, inttime)
+        self.nintegs += 1
+        self.nbytes += vis.nbytes
+
+class AveragingWriter(Writer):
+    """
+    Writer that averages consecutive integrations before passing them to
+    another writer. The integrations are summed in double precision and
+    each average is written with the Julian date of the middle of the
+    integrations. The integration time of the correlator is scaled by
+    the number of integrations averaged when the UV header is written.
+    The integrations that don't make up a whole average when the writer
+    is closed are averaged anyway, and written with the integration
+    time of the integrations in the average.
 
-            # Check if there is time for more integrations
-            if self.limit is not None and self.count + 1 > self.limit:
-                self.log('Time limit reached.')
-                self.uv_close()
-                return
+    Input:
+
+    - ``roach``: POCO object that the data is read from.
+    - ``plan``: Readout plan that the integrations are read with.
+    - ``writer``: Writer that the averages are written with.
+    """
+    def __init__(self, roach, plan, writer):
+        Writer.__init__(self, roach, plan)
+        if writer.raw:
+            raise ValueError('Raw BRAM data can\'t be averaged.')
+        self.writer = writer
+        self.ext = writer.ext
+        self.navg = roach.navg
+        shape = (len(plan.baselines), roach.get_band()[2])
+        self.sum = _np.zeros(shape, dtype=_np.complex128)
+        self.avg = _np.zeros(shape, dtype=_np.complex64)
+        self.nsummed = 0
+
+    def close(self):
+        if self.nsummed:
+            self.flush()
+        self.writer.close()
+
+    def flush(self):
+        """
+        Write the average of the integrations summed so far.
+        """
+        inttime = None
+        if self.nsummed != self.navg:
+            inttime = self.roach.int_time * self.nsummed
+        self.sum /= self.nsummed
+        self.avg[...] = self.sum
+        jd = 0.5 * (self.first_jd + self.last_jd)
+        self.writer.write(jd, self.avg, self.count, inttime)
+        self.sum[...] = 0
+        self.nsummed = 0
+
+    def open(self):
+        self.writer.open()
+
+    def write(self, jd, vis, count=None, inttime=None):
+        if not self.nsummed:
+            self.first_jd = jd
+        self.sum += vis
+        self.last_jd = jd
+        self.count = count
+        self.nsummed += 1
+        if self.nsummed == self.navg:
+            self.flush()
+
+class BinningWriter(Writer):
+    """
+    Writer that averages adjacent frequency channels before passing the
+    integrations to another writer. All of the baselines are binned at
+    once. The frequency setup that the data files are written with comes
+    from ``get_band``, which accounts for the binning.
 
-            # Make a new UV file every 300 integrations
-            if (self.count - start) % 300 == 0:
-                self.log('Closing UV file.')
-                self.uv_close()
-                self.log('Reopening a new UV file.')
-                self.uv_open()
+    Input:
 
-    def start_bof(self, acc_len, eq_coeff, fft_shift, insel, force_restart):
+    - ``roach``: POCO object that the data is read from.
+    - ``plan``: Readout plan that the integrations are read with.
+    - ``writer``: Writer that the binned integrations are written with.
+    """
+    def __init__(self, roach, plan, writer):
+        Writer.__init__(self, roach, plan)
+        if writer.raw:
+            raise ValueError('Raw BRAM data can\'t be binned.')
+        self.writer = writer
+        self.ext = writer.ext
+        self.nbin = roach.nbin
+        shape = (len(plan.baselines), roach.get_band()[2])
+        self.binned = _np.zeros(shape, dtype=_np.complex64)
+
+    def close(self):
+        self.writer.close()
+
+    def open(self):
+        self.writer.open()
+
+    def write(self, jd, vis, count=None, inttime=None):
+        nbl, nchan = self.binned.shape
+        bins = vis[:, :nchan * self.nbin].reshape(nbl, nchan, self.nbin)
+        _np.sum(bins, axis=2, out=self.binned)
+        self.binned *= 1. / self.nbin
+        self.writer.write(jd, self.binned, count, inttime)
+
+class LiveWriter(Writer):
+    """
+    Writer that publishes the latest integrations in shared memory before
+    passing them to another writer. The live export is a header followed
+    by a ring of ``nslots`` integrations, the Julian dates and sequence
+    numbers of the slots and the number of integrations published. A
+    slot's sequence number is cleared while it is rewritten, so readers
+    can tell if an integration changed while they copied it. Raw BRAM
+    data is decoded before it is published.
+
+    Input:
+
+    - ``roach``: POCO object that the data is read from.
+    - ``plan``: Readout plan that the integrations are read with.
+    - ``writer``: Writer that the integrations are written with.
+    """
+    def __init__(self, roach, plan, writer):
+        Writer.__init__(self, roach, plan)
+        self.writer = writer
+        self.ext = writer.ext
+        self.raw = writer.raw
+        self.path = get_live_path(roach.live[0])
+        self.nslots = roach.live[1]
+        if self.raw:
+            self.vis = roach.new_vis_buffer(plan)
+
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            del self.live
+            if _os.path.exists(self.path):
+                _os.remove(self.path)
+
+    def open(self):
+        roach = self.roach
+        sdf, sfreq, nchan = roach.get_band()
+        self.dc_chans = roach.get_dc_chans()
+        header = {'poco': 'rpoco' + str(roach.antennas),
+                  'baselines': list(self.plan.baselines),
+                  'sdf': sdf,
+                  'sfreq': sfreq,
+                  'nchan': nchan,
+                  'inttime': roach.int_time,
+                  'acc_len': roach.acc_len,
+                  'fft_size': 2 * roach.nchan,
+                  'flags': self.dc_chans,
+                  'nslots': self.nslots}
+        dtype = live_dtype(self.nslots, len(self.plan.baselines), nchan)
+
+        # Readers never see a live export that is only partly made.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fileobj:
+            fileobj.write(pack_header(LIVE_MAGIC, header))
+            fileobj.truncate(HEADER_SIZE + dtype.itemsize)
+        self.live = _np.memmap(tmp_path, dtype, 'r+', HEADER_SIZE, (1,))
+        _os.rename(tmp_path, self.path)
+        self.writer.open()
+
+    def write(self, jd, vis, count=None, inttime=None):
+        live = self.live
+        seq = live['seq'][0]
+        slot = seq % self.nslots
+        live['slot_seq'][0, slot] = -1
+        if self.raw:
+            live['vis'][0, slot] = self.roach.unpack_integration(self.plan,
+                                                                 vis, self.vis)
+        else:
+            live['vis'][0, slot] = vis
+        live['vis'][0, slot, :, self.dc_chans] = 0
+        live['jd'][0, slot] = jd
+        live['slot_seq'][0, slot] = seq
+        live['seq'][0] = seq + 1
+        self.writer.write(jd, vis, count, inttime)
+
+class LiveReader(object):
+    """
+    Reader for the integrations that ``retrieve_data`` publishes in shared
+    memory. The ring is mapped read-only, so ``vis`` and ``jd`` are
+    views of the shared memory. A live export that is made again by a
+    new run of ``retrieve_data`` needs a new reader.
+
+    Input:
+
+    - ``name``: Name of the live export.
+    """
+    def __init__(self, name):
+        path = get_live_path(name)
+        with open(path, 'rb') as fileobj:
+            self.header = unpack_header(LIVE_MAGIC, fileobj.read(HEADER_SIZE))
+        if self.header is None:
+            raise ValueError('Not a live export: ' + path)
+        self.nslots = self.header['nslots']
+        dtype = live_dtype(self.nslots,
+                           len(self.header['baselines']),
+                           self.header['nchan'])
+        self.live = _np.memmap(path, dtype, 'r', HEADER_SIZE, (1,))
+        self.vis = self.live['vis'][0]
+        self.jd = self.live['jd'][0]
+
+    def get_count(self):
         """
-        This function starts the bof file on the ROACH. This docstring
-        only gives a brief overview of the parameters, and more
-        comprehensive explanations can be found elsewhere within the
-        documentation.
+        Get the number of integrations that have been published.
+        """
+        return int(self.live['seq'][0])
+
+    def get_latest(self, nintegs=1):
+        """
+        Copy the latest integrations out of shared memory. Integrations
+        that were overwritten while they were copied are left out.
 
         Input:
 
-        - ``acc_len``: Integration/dump time. This can be converted \
-                to a time in seconds as \
-                :math:`t = \\dfrac{acc\_len}{f_{samp}}`.
-        - ``eq_coeff``: Equalization coefficient for the ROACH.
-        - ``fft_shift``: Integer telling which stages in the pocket \
-                correlator's FFT block to shift.
-        - ``insel``: Selects which input to use.
-        - ``force_restart``: This function forces the pocket \
-                correlator to be restarted, as opposed to letting \
-                it continue running if it was.
+        - ``nintegs``: Number of integrations to get.
 
         Return:
 
-        - ``prog_bof``: True if the ROACH was reprogrammed with the bof file. \
-                False if the bof file was already running.
+        - ``jd``: Julian dates of the integrations, oldest first.
+        - ``vis``: Visibilities with dimensions \
+                ``(nintegs, nbaselines, nchan)``.
         """
-        # Start the bof process if it isn't running already.
-        prog_bof, configure = [not b for b in self.check_running()]
-        poco_bof = self.boffile
+        count = self.get_count()
+        nintegs = min(nintegs, count, self.nslots)
+        seqs = _np.arange(count - nintegs, count)
+        slots = seqs % self.nslots
+        jd = self.jd[slots]
+        vis = self.vis[slots]
+        valid = self.live['slot_seq'][0, slots] == seqs
+        return jd[valid], vis[valid]
+
+    def wait(self, count, timeout=None, interval=0.1):
+        """
+        Wait until more than some number of integrations have been
+        published.
 
-        if force_restart:
-            self.log('WARNING: Forcing a restart of the bof process.')
-            self.progdev('')
-            prog_bof = True
+        Input:
 
-        # The ROACH2 has different initialization prcedures than the ROACH.
-        if prog_bof:
-            prog_cmd = ['adc16_init.rb', '-d', '2', self.host, poco_bof]
-            if _os.system(' '.join(prog_cmd)):
-                raise RuntimeError('ERROR: Cannot initialize ADC.')
-        else:
-            self.log('Bof process already running on FPGA.')
-        if self.verbose:
-            self.log('bof process: ' + poco_bof + '\n')
+        - ``count``: Number of integrations that have been seen.
+        - ``timeout``: Maximum number of seconds to wait.
+        - ``interval``: Seconds between checks of the shared memory.
 
-        # Write FPGA parameters to the ROACH and save them.
-        if prog_bof or configure:
-            self.log('Configuring pocket correlator.')
-            self.acc_len   = acc_len
-            self.eq_coeff  = eq_coeff
-            self.fft_shift = fft_shift
-            self.insel     = insel
-            self.int_time  = self.acc_len / self.samp_rate
-            if self.verbose:
-                message = '%-20s:\t%d\n' % ('acc_length', self.acc_len)
-                message += '%-20s:\t%d\n' % ('pfb_ctrl', self.fft_shift)
-                message += '%-20s:\t%d\n\n' % ('input_source_sel', self.insel)
-            self.write_int('pfb_ctrl', self.fft_shift)
-            self.write_int('input_source_sel', self.insel)
+        Return:
 
-        # Return whether the bof file was started or configured
-        return prog_bof or configure
+        - Number of integrations published, or None on a timeout.
+        """
+        start = _time.time()
+        while self.get_count() <= count:
+            if timeout is not None and _time.time() - start > timeout:
+                return None
+            _time.sleep(interval)
+        return self.get_count()
 
 # Debugging class
 class FakeROACH(POCO):
@@ -1204,6 +3633,19 @@ class FakeROACH(POCO):
     def progdev(self, *args, **kwargs):
         return 'ok'
 
+    def read_batch(self, devices, strict=True):
+        """
+        Generate fake raw BRAM data for a batch of devices.
+        """
+        raw_data = []
+        for _, nbytes, _ in devices:
+            lendat = nbytes / 4
+            window = 10 * _np.abs(2*_np.sin(_np.pi * _np.arange(lendat) / lendat))
+            bram = 100 * (_npr.randn(lendat) + window)
+            bram[100:200] += 2000
+            raw_data.append(bram.astype('>i4').tostring())
+        return raw_data
+
     def read_corr(self, corr_pair):
         """
         Generate fake data to store in the UV file.
@@ -1236,6 +3678,89 @@ class FakeROACH(POCO):
         self.count     = 0
         return True
 
+class FakeROACHdemux2(FakeROACH, POCOdemux2):
+    """
+    Simulated ROACH board for offline testing of the correlators that
+    demultiplex by two.
+    """
+    pass
+
+def convert_journal(filename, fmt='miriad', outfile=None):
+    """
+    This function converts a raw journal into a data file of another
+    format. The correlator is set up from the header of the journal, so
+    no ROACH is needed.
+
+    Input:
+
+    - ``filename``: Name of the journal.
+    - ``fmt``: Name of a writer in ``WRITERS`` to convert to.
+    - ``outfile``: Name of the converted file. By default, the file is \
+            named after the journal with the extension of the format.
+
+    Return:
+
+    - Name of the converted file.
+    """
+    if fmt not in WRITERS or WRITERS[fmt] is JournalWriter:
+        raise ValueError('Invalid data file format: ' + str(fmt))
+    header, records = read_journal(filename)
+
+    # Set up a simulated correlator the same way as when the data was taken.
+    if is_demux2(header['poco']):
+        roach = FakeROACHdemux2('')
+    else:
+        roach = FakeROACH('')
+    roach.get_model(header['poco'])
+    roach.set_attributes(header['calfile'],
+                         header['samp_rate'],
+                         header['nyquist'])
+    roach.acc_len = header['acc_len']
+    roach.int_time = header['int_time']
+    roach.set_channel_range(*header['chan_range'])
+    antennas = sorted(set(sum(header['baselines'], ())))
+    plan = roach.compile_plan(antennas)
+    if list(plan.baselines) != header['baselines']:
+        raise ValueError('Journal does not match the correlator model.')
+    if _np.any(records['model'] != roach.model):
+        raise ValueError('Journal does not match the correlator model.')
+
+    if outfile is None:
+        outfile = '.'.join([_os.path.splitext(filename)[0], WRITERS[fmt].ext])
+    writer = WRITERS[fmt](roach, plan, outfile + '.converting')
+    writer.open()
+    try:
+        vis = roach.new_vis_buffer(plan)
+        for record in records:
+            if writer.raw:
+                vis = record['payload']
+            else:
+                roach.unpack_integration(plan, record['payload'], vis)
+            writer.write(record['jd'], vis, record['acc_num'])
+    except:
+        writer.discard()
+        raise
+    writer.close(outfile)
+    return outfile
+
+def encode_miriad(vtype, value):
+    """
+    This function encodes the value of a Miriad variable or header item
+    the way that it is stored in the files of a data set.
+
+    Input:
+
+    - ``vtype``: Miriad type of the value.
+    - ``value``: The value to encode.
+
+    Output:
+
+    - String with the big-endian bytes of the value.
+    """
+    if vtype == 'a':
+        return value + '\0'
+    return _np.asarray(value, dtype=MIRIAD_TYPES[vtype][0]).tostring()
+
 def get_ant_index(model, index):
     """
     This function returns the numerical index of an antenna based on
@@ -1283,6 +3808,33 @@ def get_ant_index(model, index):
     else:
         raise ValueError('Antenna number out of range.')
 
+def get_checksums(filename, block=MANIFEST_BLOCK, nblocks=None):
+    """
+    This function computes the CRC-32 of each block of a file. The file
+    is read through a buffer of one block, so the memory used doesn't
+    depend on the size of the file.
+
+    Input:
+
+    - ``filename``: Name of the file.
+    - ``block``: Number of bytes in each block.
+    - ``nblocks``: Number of blocks to read from the start of the file. \
+            Defaults to all of them.
+
+    Return:
+
+    - List of the checksums of the blocks.
+    """
+    checksums = []
+    buf = bytearray(block)
+    with open(filename, 'rb') as fileobj:
+        while nblocks is None or len(checksums) < nblocks:
+            count = fileobj.readinto(buf)
+            if not count:
+                return checksums
+            checksums.append(_zlib.crc32(buffer(buf, 0, count)) & 0xffffffff)
+        return checksums
+
 def get_jul_date(unixtime=None):
     """
     This function computes the Julian date based on unix time.
@@ -1300,6 +3852,63 @@ def get_jul_date(unixtime=None):
         unixtime = _time.time()
     return unixtime / 86400.0 + 2440587.5
 
+def get_live_path(name):
+    """
+    This function gets the file that a live export is kept in. It is
+    in LIVE_DIR if the system has it, and in the temporary directory if
+    it doesn't.
+
+    Input:
+
+    - ``name``: Name of the live export.
+    """
+    livedir = LIVE_DIR
+    if not _os.path.isdir(livedir):
+        livedir = _tempfile.gettempdir()
+    return _os.path.join(livedir, name)
+
+def get_manifest(filenames):
+    """
+    This function makes the manifest that a readout uses to decide what
+    parts of the data files the client needs. A file is made of the
+    files in it if it is a directory and of itself if it isn't. Each of
+    these components has its name, size and modification time in the
+    manifest, so making it doesn't read the data. The checksums of the
+    blocks of MANIFEST_BLOCK bytes of the components are computed when
+    they are sent.
+
+    Input:
+
+    - ``filenames``: List of data files.
+
+    Return:
+
+    - Dictionary of the manifest of each file, by basename. Each \
+            manifest has ``isdir``, ``block`` and ``components``, which is \
+            a list of (name, size, mtime) tuples. The name of the \
+            component of a file that isn't a directory is empty.
+    """
+    # Files that are deleted while the manifest is made are left out of it.
+    manifest = {}
+    for filename in filenames:
+        isdir = _os.path.isdir(filename)
+        try:
+            components = []
+            names = ['']
+            if isdir:
+                names = [name for name in sorted(_os.listdir(filename))
+                         if _os.path.isfile(_os.path.join(filename, name))]
+            for name in names:
+                path = name and _os.path.join(filename, name) or filename
+                stat = _os.stat(path)
+                components.append((name, stat.st_size, stat.st_mtime))
+        except OSError:
+            continue
+        manifest[_os.path.basename(filename)] = {'isdir': isdir,
+                                                 'block': MANIFEST_BLOCK,
+                                                 'components': components}
+    return manifest
+
 def get_model_uv(infiles):
     """
     This function gets the poco model from UV files.
@@ -1308,7 +3917,8 @@ def get_model_uv(infiles):
 
     - ``infiles``: The UV files to use to detect the poco model.
     """
-    models = list(set([_aipy.miriad.UV(f)['operator'][:-1] for f in infiles]))
+    import aipy
+    models = list(set([aipy.miriad.UV(f)['operator'][:-1] for f in infiles]))
     if len(models) > 1:
         raise ValueError('Input UV files are from different ROACH models.')
 
@@ -1337,6 +3947,75 @@ def get_seconds(date=None, fmt=TIME_FMT):
     else:
         return _time.mktime(_time.strptime(date, fmt))
 
+def get_sendfile():
+    """
+    This function gets a function that copies data from a file to a
+    socket in the kernel, like ``os.sendfile`` in Python 3. In Python 2,
+    ``sendfile64`` is called from the C library.
+
+    Return:
+
+    - Function taking ``(out_fd, in_fd, offset, count)`` and returning \
+            the number of bytes sent, or None if sendfile isn't available.
+    """
+    try:
+        return get_sendfile.sendfile
+    except AttributeError:
+        pass
+
+    sendfile = getattr(_os, 'sendfile', None)
+    if sendfile is None:
+        try:
+            libc_sendfile = _ctypes.CDLL(None, use_errno=True).sendfile64
+        except (OSError, AttributeError):
+            libc_sendfile = None
+    if sendfile is None and libc_sendfile is not None:
+        libc_sendfile.argtypes = [_ctypes.c_int, _ctypes.c_int,
+                                  _ctypes.POINTER(_ctypes.c_int64),
+                                  _ctypes.c_size_t]
+        libc_sendfile.restype = _ctypes.c_ssize_t
+
+        def sendfile(out_fd, in_fd, offset, count):
+            offset = _ctypes.c_int64(offset)
+            nbytes = libc_sendfile(out_fd, in_fd, _ctypes.byref(offset), count)
+            if nbytes < 0:
+                errno = _ctypes.get_errno()
+                raise OSError(errno, _os.strerror(errno))
+            return nbytes
+
+    get_sendfile.sendfile = sendfile
+    return sendfile
+
+def get_transfer_level(sample, link_rate, levels=TRANSFER_LEVELS):
+    """
+    This function picks the zlib level to send a file over a link with.
+    The sample of the file is compressed at each level to measure how
+    fast the CPU compresses it and how much smaller it gets. Since the
+    data is compressed while it is sent, the rate that the file gets
+    across the link is the slower of the two.
+
+    Input:
+
+    - ``sample``: Sample of the data in the file.
+    - ``link_rate``: Bytes per second that the link sends raw data at.
+    - ``levels``: zlib levels to try.
+
+    Return:
+
+    - Best zlib level, or 0 if it is faster not to compress the file.
+    """
+    best_level = 0
+    best_time = 1. / link_rate
+    for level in levels:
+        start = _time.time()
+        ratio = len(_zlib.compress(sample, level)) / float(len(sample))
+        cpu_time = (_time.time() - start) / len(sample)
+        transfer_time = max(cpu_time, ratio / link_rate)
+        if transfer_time < best_time:
+            best_level = level
+            best_time = transfer_time
+    return best_level
+
 def is_demux2(poco):
     """
     This function detects if a poco model needs demux2 ADC settings.
@@ -1347,6 +4026,35 @@ def is_demux2(poco):
     """
     return poco == 'spoco6'
 
+def journal_dtype(payload):
+    """
+    This function gets the data type of the records of a raw journal.
+
+    Input:
+
+    - ``payload``: Number of bytes of raw BRAM data per integration.
+    """
+    return _np.dtype([('acc_num', '<i8'),
+                      ('jd', '<f8'),
+                      ('model', '<i8'),
+                      ('payload', _np.uint8, (payload,))])
+
+def live_dtype(nslots, nbaselines, nchan):
+    """
+    This function gets the data type of the shared memory of a live
+    export, after its header.
+
+    Input:
+
+    - ``nslots``: Number of integrations in the ring.
+    - ``nbaselines``: Number of baselines per integration.
+    - ``nchan``: Number of channels per baseline.
+    """
+    return _np.dtype([('seq', '<i8'),
+                      ('slot_seq', '<i8', (nslots,)),
+                      ('jd', '<f8', (nslots,)),
+                      ('vis', '<c8', (nslots, nbaselines, nchan))])
+
 def mode_list2int(modelist):
     """
     list is [board, board version, demux, antennas]
@@ -1383,6 +4091,216 @@ def mode_int2list(mode):
 
     return modelist
 
+def pack_header(magic, header):
+    """
+    This function packs the header of a raw journal or a compact file.
+    The header is a dictionary that is saved as its repr after a magic
+    string and its length, padded to HEADER_SIZE bytes.
+
+    Input:
+
+    - ``magic``: Magic string identifying the type of file.
+    - ``header``: Dictionary of plain Python values.
+
+    Return:
+
+    - Packed header.
+    """
+    header = repr(header)
+    header_len = HEADER_SIZE - len(magic) - 2
+    if len(header) > header_len:
+        raise ValueError('File header is too long.')
+    return magic + _struct.pack('<H', len(header)) + header.ljust(header_len,
+                                                                  '\0')
+
+def read_compact(filename):
+    """
+    This function reads a compact file written by ``CompactWriter``.
+
+    Input:
+
+    - ``filename``: Name of the compact file.
+
+    Return:
+
+    - ``header``: Dictionary holding the setup of the data, with the \
+            flagged channels under 'flags'.
+    - ``jd``: Julian dates of the integrations.
+    - ``vis``: Visibilities with dimensions ``(ntimes, nbaselines, nchan)``, \
+            in double precision so that the integers are exact.
+    """
+    with open(filename, 'rb') as fileobj:
+        header = unpack_header(COMPACT_MAGIC, fileobj.read(HEADER_SIZE))
+        if header is None:
+            raise ValueError('Not a compact file: ' + filename)
+        nbl = len(header['baselines'])
+        nchan = header['nchan']
+
+        jd = []
+        vis = []
+        while True:
+            nintegs = fileobj.read(4)
+            if len(nintegs) < 4:
+                break
+            nintegs, = _struct.unpack('<I', nintegs)
+            jd.append(_np.fromstring(fileobj.read(8 * nintegs), '<f8'))
+            lengths = _struct.unpack('<%dI' % nbl, fileobj.read(4 * nbl))
+
+            block = _np.zeros((nintegs, nbl, nchan), dtype=_np.complex128)
+            for i, length in enumerate(lengths):
+                stream = fileobj.read(length)
+                if header['level']:
+                    stream = _np.fromstring(_zlib.decompress(stream), _np.uint8)
+                    data = stream.reshape(4, -1).T.copy().view('<i4')
+                else:
+                    data = _np.fromstring(stream, '<i4')
+                data = data.reshape(nintegs, nchan, 2)
+                if header['delta']:
+                    data = _np.cumsum(data, axis=0, dtype='<i4')
+                block[:, i].real = data[..., 0]
+                block[:, i].imag = data[..., 1]
+            vis.append(block)
+
+    if not vis:
+        return header, _np.zeros(0), _np.zeros((0, nbl, nchan), _np.complex128)
+    return header, _np.concatenate(jd), _np.concatenate(vis)
+
+def read_journal(filename):
+    """
+    This function reads a raw journal written by ``JournalWriter``. A
+    journal that wasn't closed is read up to the last integration that
+    was written.
+
+    Input:
+
+    - ``filename``: Name of the journal.
+
+    Return:
+
+    - ``header``: Dictionary holding the setup of the correlator.
+    - ``records``: Memory mapped array of the records of the journal.
+    """
+    with open(filename, 'rb') as fileobj:
+        header = unpack_header(JOURNAL_MAGIC, fileobj.read(HEADER_SIZE))
+    if header is None:
+        raise ValueError('Not a raw journal: ' + filename)
+
+    dtype = journal_dtype(header['payload'])
+    nrecords = header['nrecords']
+    if nrecords is None:
+        size = _os.path.getsize(filename) - HEADER_SIZE
+        nrecords = size // dtype.itemsize
+    if not nrecords:
+        return header, _np.zeros(0, dtype)
+    records = _np.memmap(filename, dtype, 'r', HEADER_SIZE, (nrecords,))
+
+    # The journal is preallocated, so unwritten records are all zeros.
+    if header['nrecords'] is None:
+        records = records[:_np.count_nonzero(records['jd'])]
+    return header, records
+
+def send_file(tcpsocket, filename, offset=0, nbytes=None, zero_copy=True,
+              level=0, limiter=None, checksums=None, block=MANIFEST_BLOCK):
+    """
+    This function sends part of a file over a TCP socket. The data is
+    copied from the file to the socket by the kernel with sendfile when
+    possible. Otherwise, it is sent through a buffer of TCP_SEND_SIZE
+    bytes, so the memory used doesn't depend on the size of the file.
+    Partial sends are finished in both cases.
+
+    If the data is compressed, each buffer of it is sent as a frame of
+    zlib data after its length as a little endian uint32. The frames
+    are flushed from the same compressor, so the part of the file can
+    be decompressed one frame at a time with a single decompressor.
+
+    With a rate limiter, the data is sent TCP_SEND_SIZE bytes at a time
+    in both cases, and each send waits for its turn at the rate.
+
+    The CRC-32 of each block of the data can be computed as it is sent,
+    which sends it through the buffer. The blocks start at the offset,
+    so it has to be at the start of a block of the file for them to be
+    the blocks of the file.
+
+    Input:
+
+    - ``tcpsocket``: Socket to send the data with.
+    - ``filename``: Name of the file to send.
+    - ``offset``: Byte of the file to start at.
+    - ``nbytes``: Number of bytes to send. Defaults to the rest of the \
+            file.
+    - ``zero_copy``: Whether to use sendfile if it is available.
+    - ``level``: zlib level to compress the data with, or 0 to send it \
+            as it is.
+    - ``limiter``: ``RateLimiter`` to send the data with.
+    - ``checksums``: List to append the checksum of each block of the \
+            data to, if any.
+    - ``block``: Number of bytes in each block.
+
+    Return:
+
+    - Number of bytes of the file sent.
+    """
+    with open(filename, 'rb') as fileobj:
+        if nbytes is None:
+            nbytes = _os.fstat(fileobj.fileno()).st_size - offset
+        sendfile = (zero_copy and not level and checksums is None and
+                    get_sendfile())
+        nsent = 0
+        if sendfile:
+            while nsent < nbytes:
+                count = nbytes - nsent
+                if limiter is not None:
+                    count = min(count, TCP_SEND_SIZE)
+                    limiter.wait(count)
+
+                # Interrupted and partial sends are finished without waiting
+                # at the rate again.
+                end = nsent + count
+                while nsent < end:
+                    try:
+                        count = sendfile(tcpsocket.fileno(), fileobj.fileno(),
+                                         offset + nsent, end - nsent)
+                    except OSError as err:
+                        if err.errno == _errno.EINTR:
+                            continue
+                        raise
+                    if not count:
+                        raise IOError('File ended before it was sent: ' +
+                                      filename)
+                    nsent += count
+            return nsent
+
+        fileobj.seek(offset)
+        buf = bytearray(min(TCP_SEND_SIZE, nbytes))
+        view = memoryview(buf)
+        compressor = level and _zlib.compressobj(level)
+        crc = nblock = 0
+        while nsent < nbytes:
+            count = min(len(buf), nbytes - nsent)
+            if checksums is not None:
+                count = min(count, block - nblock)
+            count = fileobj.readinto(view[:count])
+            if not count:
+                raise IOError('File ended before it was sent: ' + filename)
+            if checksums is not None:
+                crc = _zlib.crc32(buffer(buf, 0, count), crc)
+                nblock += count
+                if nblock == block or nsent + count == nbytes:
+                    checksums.append(crc & 0xffffffff)
+                    crc = nblock = 0
+            if compressor:
+                frame = compressor.compress(buffer(buf, 0, count))
+                frame += compressor.flush(_zlib.Z_SYNC_FLUSH)
+                if limiter is not None:
+                    limiter.wait(len(frame) + 4)
+                tcpsocket.sendall(_struct.pack('<I', len(frame)) + frame)
+            else:
+                if limiter is not None:
+                    limiter.wait(count)
+                tcpsocket.sendall(view[:count])
+            nsent += count
+        return nsent
+
 def spec_list(infiles, ant_i, ant_j, verbose=False):
     """
     Originally in plot_mean_corr.py
@@ -1394,8 +4312,9 @@ def spec_list(infiles, ant_i, ant_j, verbose=False):
     nfiles = len(infiles)
 
     # Read spectra from the UV files into numpy arrays
+    import aipy
     for num, infile in enumerate(map(_os.path.abspath, infiles)):
-        uv = _aipy.miriad.UV(infile)
+        uv = aipy.miriad.UV(infile)
         uv.select('antennae', ant_i, ant_j)
         nchan = uv['nchan']
         if last_nchan > 0  and nchan != last_nchan:
@@ -1449,3 +4368,22 @@ def print_progress(step,
             print
         else:
             _sys.stdout.flush()
+
+def unpack_header(magic, data):
+    """
+    This function unpacks a header packed with ``pack_header``.
+
+    Input:
+
+    - ``magic``: Magic string identifying the type of file.
+    - ``data``: First HEADER_SIZE bytes of the file.
+
+    Return:
+
+    - Dictionary of the header, or None if the magic string is wrong.
+    """
+    if not data.startswith(magic):
+        return None
+    start = len(magic)
+    header_len, = _struct.unpack('<H', data[start:start+2])
+    return _ast.literal_eval(data[start+2:start+2+header_len])
@@ -1,11 +1,81 @@
 #!/usr/bin/env python2
 
+import os
+import ast
+import imp
+import itertools
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+import numpy as np
 import pocketcorr as pc
 
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'scripts')
+
+class FlakyROACH(pc.FakeROACH):
+    """
+    Fake ROACH whose first BRAM fails to be read a number of times, and
+    whose accumulation number can be made to move on.
+    """
+    nfailures = 0
+    acc_num = 0
+
+    def read_batch(self, devices, strict=True):
+        self.batches.append(devices)
+        raw_data = pc.FakeROACH.read_batch(self, devices, strict)
+        if self.nfailures:
+            self.nfailures -= 1
+            raw_data[0] = None
+        return raw_data
+
+    def read_int(self, bram):
+        return self.acc_num
+
+class ClockROACH(pc.POCO):
+    """
+    ROACH whose counters follow a simulated clock. The clock stands in
+    for the time module while the ROACH is polled, and every read takes
+    a little time on it.
+    """
+    def __init__(self, int_time, clk_rate=200e6):
+        pc.POCO.__init__(self, 'localhost')
+        self.int_time = int_time
+        self.clk_rate = clk_rate
+        self.now = 1000.
+
+    def read_int(self, name):
+        self.now += 0.0002
+        if name == 'sys_clkcounter':
+            return int(self.now * self.clk_rate) & 0xffffffff
+        return int(self.now / self.int_time)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def time(self):
+        return self.now
+
 class TestPOCO(unittest.TestCase):
     def setUp(self):
         self.poco = pc.POCO('localhost')
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_fake_roach(self, cls=pc.FakeROACH):
+        roach = cls('')
+        roach.get_model('rpoco8')
+        roach.set_attributes('psa898_v003', 200e6, 2)
+        roach.start_bof()
+        roach.set_filename(os.path.join(self.tmpdir, 'poco'))
+        return roach
 
     def test_ant_ext(self):
         for ant in [4, 8, 16]:
@@ -107,12 +177,730 @@ class TestPOCO(unittest.TestCase):
             for p1, p2 in zip(fst, snd):
                 self.assertEqual((mapping[p1[0]], mapping[p1[1]]), p2)
 
+    def test_compile_plan(self):
+        for roach in ['rpoco8', 'rpoco16', 'spoco12']:
+            self.poco.get_model(roach)
+            plan = self.poco.plan
+            fst, snd = self.poco.get_xmult()
+            xlist = [tuple(sorted(x)) for x in fst + snd]
+            self.assertEqual(sorted(plan.baselines), sorted(xlist))
+            self.assertEqual(len(plan.brams), len(fst))
+
+            # Every baseline has exactly one slot, and the device list has
+            # the imaginary BRAM for cross-correlations only.
+            slots = [s for b in plan.brams for s in b.slots]
+            self.assertEqual(sorted(slots), range(len(plan.baselines)))
+            for bram, (p1, p2) in zip(plan.brams, zip(fst, snd)):
+                self.assertEqual(bram.read_imag, p1[0] != p1[1])
+                self.assertEqual(bram.conj, (False, p2[0] > p2[1]))
+            nread = sum([1 + b.read_imag for b in plan.brams])
+            self.assertEqual(len(plan.devices), nread)
+
+        # Filtering antennas leaves out the baselines that aren't needed.
+        self.poco.get_model('rpoco8')
+        plan = self.poco.compile_plan([0, 1])
+        self.assertEqual(sorted(plan.baselines), [(0, 0), (0, 1), (1, 1)])
+
+    def test_channel_range(self):
+        self.poco.get_model('rpoco8')
+        self.poco.set_attributes('psa898_v003', 200e6, 2)
+        sdf, sfreq, nchan = self.poco.get_band()
+        with self.assertRaises(ValueError):
+            self.poco.set_channel_range(100, 100)
+        with self.assertRaises(ValueError):
+            self.poco.set_channel_range(0, nchan + 1)
+
+        # Only the part of each BRAM with the channels is read.
+        self.poco.set_channel_range(100, 300)
+        chan_size = self.poco.bram_size / nchan
+        for _, nbytes, offset in self.poco.plan.devices:
+            self.assertEqual(nbytes, 200 * chan_size)
+            self.assertEqual(offset, 100 * chan_size)
+        self.assertEqual(self.poco.get_band(), (sdf, sfreq + 100 * sdf, 200))
+        self.assertEqual(self.poco.get_dc_chans(), [])
+
+    def test_channel_binning(self):
+        roach = self.get_fake_roach()
+        sdf, sfreq, nchan = roach.get_band()
+        with self.assertRaises(ValueError):
+            roach.set_channel_binning(0)
+
+        # Raw BRAM data can't be binned, whichever is set first.
+        roach.set_writer('journal')
+        with self.assertRaises(ValueError):
+            roach.set_channel_binning(4)
+        roach.set_writer('miriad')
+        roach.set_channel_binning(4)
+        with self.assertRaises(ValueError):
+            roach.set_writer('compact')
+
+        # Changing the binning makes new UV flags for the same plan.
+        roach.uv_templates = (roach.plan, [], np.zeros(roach.nchan))
+        roach.set_channel_binning(1)
+        self.assertIsNone(roach.uv_templates)
+
+        # Bins with a DC channel in them are flagged.
+        roach.set_channel_range(1, 31)
+        roach.set_channel_binning(4)
+        self.assertEqual(roach.get_band(), (4 * sdf, sfreq + 2.5 * sdf, 7))
+        self.assertEqual(roach.get_dc_chans(), [0])
+        self.assertEqual(dict(roach.get_uv_header())['nchan'], 7)
+
+        vis = roach.read_integration()
+        numpy_writer = pc.NumpyWriter(roach, roach.plan)
+        writer = pc.BinningWriter(roach, roach.plan, numpy_writer)
+        writer.open()
+        writer.write(2457000.1, vis)
+        writer.close()
+
+        outfile = os.path.join(self.tmpdir, os.listdir(self.tmpdir)[0])
+        binned = np.load(os.path.join(outfile, 'vis.npy'))[0]
+        mean = np.mean(vis[:, :28].reshape(len(vis), 7, 4), axis=2)
+        self.assertTrue(np.allclose(binned, mean))
+        freqs = np.load(os.path.join(outfile, 'freqs.npy'))
+        bin_freqs = sfreq + sdf * (2.5 + 4 * np.arange(7))
+        self.assertTrue(np.allclose(freqs, bin_freqs))
+        flags = np.load(os.path.join(outfile, 'flags.npy'))
+        self.assertEqual(list(np.flatnonzero(flags)), [0])
+
+    def test_integration_ring(self):
+        ring = pc.IntegrationRing(2, (3, 4))
+        slots = [ring.acquire(), ring.acquire()]
+        self.assertEqual(sorted(slots), [0, 1])
+
+        # A full ring drops by default, and blocks until a slot is freed
+        # when asked to.
+        self.assertIsNone(ring.acquire())
+        start = time.time()
+        self.assertIsNone(ring.acquire(0.05))
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        threading.Timer(0.05, ring.release, (slots[1],)).start()
+        self.assertEqual(ring.acquire(None), slots[1])
+
+    def test_write_loop(self):
+        class ListWriter(object):
+            def __init__(self, fail=False):
+                self.written = []
+                self.fail = fail
+
+            def write(self, jd, vis, count=None):
+                if self.fail:
+                    raise IOError('Disk full.')
+                self.written.append((jd, count))
+
+        # Integrations committed before the ring is closed are all written
+        # before the writer thread returns.
+        ring = pc.IntegrationRing(3, (3, 4))
+        for i in range(2):
+            ring.commit(ring.acquire(), 2457000.1 + i, i)
+        ring.close()
+        writer = ListWriter()
+        self.poco.write_loop(writer, ring)
+        self.assertEqual(writer.written, [(2457000.1, 0), (2457001.1, 1)])
+        self.assertEqual(len(ring.free), 3)
+
+        # A writer that fails stops the thread but frees its slot.
+        ring = pc.IntegrationRing(1, (3, 4))
+        ring.commit(ring.acquire(), 2457000.1, 0)
+        with self.assertRaises(IOError):
+            self.poco.write_loop(ListWriter(True), ring)
+        self.assertEqual(ring.acquire(), 0)
+
+    def test_read_retry(self):
+        roach = self.get_fake_roach(FlakyROACH)
+        plan = roach.plan
+        vis = roach.new_vis_buffer(plan)
+        raw = roach.new_raw_buffer(plan)
+        first_bram = plan.brams[0]
+        first_devices = [(first_bram.real_dev, first_bram.nbytes,
+                          first_bram.offset)]
+        if first_bram.read_imag:
+            first_devices.append((first_bram.imag_dev,) +
+                                 first_devices[0][1:])
+
+        # Only what failed is read again while the integration is current.
+        retries = [(roach.read_retry, vis, first_devices),
+                   (roach.read_raw, raw, list(plan.devices[:1]))]
+        for read, buf, retried in retries:
+            roach.batches = []
+            roach.nfailures = 2
+            self.assertEqual(read(plan, buf), 2)
+            self.assertEqual(len(roach.batches), 3)
+            self.assertEqual(roach.batches[1:], [retried, retried])
+
+        # Once the accumulation number moves on, the integration is lost.
+        roach.acc_num = roach.count + 1
+        for read, buf in [(roach.read_retry, vis), (roach.read_raw, raw)]:
+            roach.batches = []
+            roach.nfailures = 1
+            self.assertIsNone(read(plan, buf))
+            self.assertEqual(len(roach.batches), 1)
+
+    def test_poll(self):
+        roach = ClockROACH(1.)
+        def check_flip(flip):
+            half = 0.5 * roach.poll_latency
+            self.assertLessEqual(abs(roach.flip_time - flip), half)
+
+        pc._time = roach
+        try:
+            # Without a prediction, the ROACH is polled until it flips.
+            roach.now = 1000.3
+            roach.poll()
+            self.assertGreater(roach.poll_count, pc.POLL_MAX_FAST)
+            self.assertEqual(roach.poll_margin, pc.POLL_MARGIN)
+            self.assertLess(roach.poll_latency, 0.002)
+            check_flip(1001.)
+
+            # Polling that starts too early shrinks the margin.
+            roach.poll_margin = 0.2
+            roach.poll()
+            self.assertGreater(roach.poll_count, pc.POLL_MAX_FAST)
+            self.assertEqual(roach.poll_margin, 0.1)
+            self.assertLess(roach.poll_latency, 0.002)
+            check_flip(1002.)
+
+            # Polling that starts too late grows the margin, and the flip is
+            # only known to be after the read before the wait.
+            roach.now = 1002.5
+            roach.flip_time += 0.03
+            roach.poll_margin = pc.POLL_MIN_MARGIN
+            roach.poll()
+            self.assertEqual(roach.poll_count, 2)
+            self.assertEqual(roach.poll_margin, 2 * pc.POLL_MIN_MARGIN)
+            self.assertGreater(roach.poll_latency, 0.5)
+            check_flip(1003.)
+        finally:
+            pc._time = time
+
+    def test_fpga_clock(self):
+        # Clocks 20 ppm fast, with a counter that wraps every 16 accumulations
+        # and host times that jitter by 0.1 ms.
+        clk_rate = 200e6 * (1 + 20e-6)
+        acc_len = 1 << 28
+        clk_start = (1 << 32) - 1000
+        random = np.random.RandomState(0)
+        def get_host_time(acc_num):
+            return 1000. + (acc_num - 5) * acc_len / clk_rate
+
+        clock = pc.FpgaClock()
+        acc_nums = range(5, 105) + [160, 161]
+        for acc_num in acc_nums:
+            clk = (clk_start + (acc_num - 5) * acc_len) & 0xffffffff
+            host_time = get_host_time(acc_num) + random.normal(0, 1e-4)
+            clock.update(clk, acc_num, host_time)
+            self.assertEqual(clock.ready(), acc_num > 5)
+
+        # The counter wraps three times between the last reads.
+        self.assertAlmostEqual(clock.period, acc_len / clk_rate, delta=1e-6)
+        self.assertAlmostEqual(clock.get_drift(acc_len / 200e6), -20,
+                               delta=1)
+        self.assertAlmostEqual(clock.get_acc_time(200), get_host_time(200),
+                               delta=1e-4)
+        self.assertGreater(clock.jitter, 0.7e-4)
+        self.assertLess(clock.jitter, 1.3e-4)
+
+        # Polls with the clock take their times from the counters.
+        roach = ClockROACH(1., clk_rate)
+        roach.set_hw_time(True)
+        pc._time = roach
+        try:
+            for i in range(5):
+                jd = roach.poll()
+        finally:
+            pc._time = time
+        self.assertLess(roach.poll_count, pc.POLL_MAX_FAST)
+        acc_time = (jd - 2440587.5) * 86400 + 0.5 * roach.clock.period
+        self.assertAlmostEqual(acc_time, roach.count, delta=1e-3)
+
     def test_set_attributes(self):
         self.poco.get_model('rpoco8')
         self.poco.set_attributes('psa898_v003', 200e6, 2)
         self.assertEqual(self.poco.sdf, -1 * 0.2 / 2 / self.poco.nchan)
         self.assertEqual(self.poco.sfreq, 0.2)
 
+    def test_lst_cache(self):
+        self.poco.get_model('rpoco8')
+        self.poco.set_attributes('psa898_v003', 200e6, 2)
+        lst_cache = self.poco.lst_cache
+        for jd in [2457000.1, 2457000.1001, 2457000.4, 2457003.9]:
+            lst_diff = lst_cache.get_lst(jd) - lst_cache.get_exact_lst(jd)
+            lst_diff = (lst_diff + np.pi) % (2 * np.pi) - np.pi
+            self.assertLess(abs(lst_diff), 1e-6)
+
+    def test_npy_appender(self):
+        data = np.arange(60, dtype=np.complex64).reshape((5, 3, 4))
+        filename = os.path.join(self.tmpdir, 'vis.npy')
+        npy_file = pc.NpyAppender(filename, (3, 4), np.complex64)
+        npy_file.append(data[:2])
+        npy_file.append(data[2:])
+        npy_file.close()
+        self.assertTrue(np.array_equal(np.load(filename), data))
+
+    def test_miriad_writer(self):
+        import aipy
+        roach = self.get_fake_roach()
+        stream = [roach.read_integration() for i in range(3)]
+        jd_start = 2457000.1
+        inttimes = [None, None, 0.5 * roach.int_time]
+
+        # The files from both Miriad writers must read back the same.
+        uv = {}
+        for fmt in ['miriad', 'miriad-numpy']:
+            roach.set_filename(os.path.join(self.tmpdir, fmt, 'poco'))
+            writer = pc.WRITERS[fmt](roach, roach.plan)
+            writer.open()
+            for i, vis in enumerate(stream):
+                writer.write(jd_start + i * 1e-4, vis.copy(),
+                             inttime=inttimes[i])
+            writer.close()
+            uvdir = os.path.join(self.tmpdir, fmt)
+            uvfile = os.path.join(uvdir, os.listdir(uvdir)[0])
+            uv[fmt] = aipy.miriad.UV(uvfile)
+
+        uv_aipy, uv_numpy = uv['miriad'], uv['miriad-numpy']
+        self.assertEqual(sorted(uv_aipy.vars()), sorted(uv_numpy.vars()))
+        for item in ['history', 'obstype', 'nchan0', 'ngains', 'freqs']:
+            self.assertTrue(np.all(uv_aipy._rdhd(item) ==
+                                   uv_numpy._rdhd(item)))
+
+        nrecords = 0
+        for rec_aipy, rec_numpy in itertools.izip(uv_aipy.all(raw=True),
+                                                  uv_numpy.all(raw=True)):
+            (uvw, t, ij), data, flags = rec_numpy
+            self.assertTrue(np.array_equal(uvw, rec_aipy[0][0]))
+            self.assertEqual((t, ij), rec_aipy[0][1:])
+            self.assertTrue(np.array_equal(data, rec_aipy[1]))
+            self.assertTrue(np.array_equal(flags, rec_aipy[2]))
+            for var in ['lst', 'nchan', 'sdf', 'pol', 'inttime']:
+                self.assertEqual(uv_numpy[var], uv_aipy[var])
+            inttime = inttimes[nrecords / len(roach.plan.baselines)]
+            self.assertAlmostEqual(uv_numpy['inttime'],
+                                   inttime or roach.int_time, places=6)
+            nrecords += 1
+        self.assertEqual(nrecords, len(stream) * len(roach.plan.baselines))
+
+        # Files closed without records are laid out the same way, with the
+        # type of observation set anyway.
+        names = {}
+        for fmt in ['miriad', 'miriad-numpy']:
+            uvdir = os.path.join(self.tmpdir, fmt + '-empty')
+            roach.set_filename(os.path.join(uvdir, 'poco'))
+            writer = pc.WRITERS[fmt](roach, roach.plan)
+            writer.open()
+            writer.close()
+            uvfile = os.path.join(uvdir, os.listdir(uvdir)[0])
+            names[fmt] = sorted(os.listdir(uvfile))
+        self.assertEqual(names['miriad'], names['miriad-numpy'])
+        obstype = '\0\0\0\1mixed-auto-cross'
+        obstype = 'obstype'.ljust(15, '\0') + chr(len(obstype)) + obstype
+        with open(os.path.join(uvfile, 'header'), 'rb') as fileobj:
+            self.assertIn(obstype, fileobj.read())
+
+    def test_rotating_writer(self):
+        roach = self.get_fake_roach()
+        roach.set_writer('numpy')
+        vis = roach.read_integration()
+        with self.assertRaises(ValueError):
+            roach.set_rotation('files', 3)
+
+        # Number of integrations in each file for every rotation mode.
+        rotations = [('integrations', 3, [3, 3, 1]),
+                     ('bytes', 2 * vis.nbytes, [2, 2, 2, 1]),
+                     ('seconds', 250, [3, 3, 1])]
+        for mode, value, nintegs in rotations:
+            outdir = os.path.join(self.tmpdir, mode)
+            roach.set_filename(os.path.join(outdir, 'poco'))
+            roach.set_rotation(mode, value)
+            writer = pc.RotatingWriter(roach, roach.plan)
+            writer.open()
+            for i in range(7):
+                writer.write(2457000.1 + i * 100 / 86400., vis)
+            writer.close()
+
+            files = sorted(os.listdir(outdir))
+            self.assertTrue(all([f.endswith('.vis') for f in files]))
+            jd = [np.load(os.path.join(outdir, f, 'jd.npy')) for f in files]
+            self.assertEqual(sorted(map(len, jd)), sorted(nintegs))
+
+    def test_journal(self):
+        roach = self.get_fake_roach()
+        roach.set_channel_range(100, 300)
+        plan = roach.plan
+        stream = []
+        for i in range(3):
+            raw = roach.new_raw_buffer(plan)
+            self.assertEqual(roach.read_raw(plan, raw), 0)
+            stream.append(raw)
+
+        writer = pc.JournalWriter(roach, plan)
+        writer.open()
+        for i, raw in enumerate(stream):
+            writer.write(2457000.1 + i * 1e-4, raw, i + 10)
+
+            # Journals that weren't closed are read up to the last record.
+            header, records = pc.read_journal(roach.tmp_file)
+            self.assertIsNone(header['nrecords'])
+            self.assertEqual(len(records), i + 1)
+        writer.close()
+
+        journal = os.path.join(self.tmpdir, os.listdir(self.tmpdir)[0])
+        header, records = pc.read_journal(journal)
+        self.assertEqual(header['nrecords'], len(stream))
+        self.assertEqual(list(records['acc_num']), [10, 11, 12])
+        self.assertTrue(np.array_equal(records['payload'], stream))
+
+        # The converted data must match the decoded raw data.
+        outfile = pc.convert_journal(journal, 'numpy')
+        vis = np.load(os.path.join(outfile, 'vis.npy'))
+        for i, raw in enumerate(stream):
+            self.assertTrue(np.array_equal(vis[i],
+                            roach.unpack_integration(plan, raw)))
+        self.assertTrue(np.array_equal(
+            np.load(os.path.join(outfile, 'baselines.npy')),
+            plan.baselines))
+
+    def test_averaging_writer(self):
+        roach = self.get_fake_roach()
+        with self.assertRaises(ValueError):
+            roach.set_averaging(0)
+
+        # Raw BRAM data can't be averaged, whichever is set first.
+        roach.set_writer('compact')
+        with self.assertRaises(ValueError):
+            roach.set_averaging(3)
+        roach.set_writer('numpy')
+        roach.set_averaging(3)
+        with self.assertRaises(ValueError):
+            roach.set_writer('journal')
+        self.assertEqual(dict(roach.get_uv_header())['inttime'],
+                         3 * roach.int_time)
+
+        stream = [roach.read_integration() for i in range(7)]
+        jd = 2457000.1 + np.arange(7) * 1e-4
+        numpy_writer = pc.NumpyWriter(roach, roach.plan)
+        writer = pc.AveragingWriter(roach, roach.plan, numpy_writer)
+        writer.open()
+        for i, vis in enumerate(stream):
+            writer.write(jd[i], vis, i)
+        writer.close()
+
+        # Leftover integrations are averaged when the file is closed, and
+        # written with their own integration time.
+        outfile = os.path.join(self.tmpdir, os.listdir(self.tmpdir)[0])
+        vis = np.load(os.path.join(outfile, 'vis.npy'))
+        jd_avg = np.load(os.path.join(outfile, 'jd.npy'))
+        inttime = np.load(os.path.join(outfile, 'inttime.npy'))
+        self.assertEqual(len(vis), 3)
+        for i, (start, stop) in enumerate([(0, 3), (3, 6), (6, 7)]):
+            mean = np.mean(np.array(stream[start:stop], np.complex128), 0)
+            self.assertTrue(np.allclose(vis[i], mean))
+            self.assertAlmostEqual(jd_avg[i], np.mean(jd[[start, stop-1]]))
+            self.assertAlmostEqual(inttime[i], (stop - start) * roach.int_time)
+
+    def test_compact_writer(self):
+        roach = self.get_fake_roach()
+        plan = roach.plan
+        with self.assertRaises(ValueError):
+            roach.set_compression(10)
+
+        # Values past 2**24 don't fit in a float32 but must come back exact.
+        stream = []
+        vis_stream = []
+        for i in range(5):
+            raw = roach.new_raw_buffer(plan)
+            raw.view('>i4')[:] = np.random.randint(-2**30, 2**30, len(raw) / 4)
+            stream.append(raw)
+            vis = np.zeros(roach.new_vis_buffer(plan).shape, np.complex128)
+            roach.unpack_integration(plan, raw, vis)
+            vis[:, roach.get_dc_chans()] = 0
+            vis_stream.append(vis)
+        self.assertGreater(np.max(np.abs(np.array(vis_stream).real)), 2**24)
+        jd = 2457000.1 + np.arange(5) * 1e-4
+
+        # Blocks of two integrations, so that the last block is partial.
+        chunk = pc.COMPACT_CHUNK
+        pc.COMPACT_CHUNK = 2
+        try:
+            for level, delta in [(0, False), (1, True)]:
+                roach.set_compression(level, delta)
+                writer = pc.CompactWriter(roach, plan)
+                writer.open()
+                for i, raw in enumerate(stream):
+                    writer.write(jd[i], raw)
+                writer.close()
+
+                filename = os.path.join(self.tmpdir,
+                                        os.listdir(self.tmpdir)[0])
+                header, jd_file, vis_file = pc.read_compact(filename)
+                os.remove(filename)
+                self.assertEqual(header['nintegs'], len(stream))
+                self.assertEqual(header['flags'], roach.get_dc_chans())
+                self.assertTrue(np.array_equal(jd_file, jd))
+                self.assertTrue(np.array_equal(vis_file, vis_stream))
+        finally:
+            pc.COMPACT_CHUNK = chunk
+
+    def test_live_export(self):
+        roach = self.get_fake_roach()
+        stream = [roach.read_integration() for i in range(5)]
+        jd = 2457000.1 + np.arange(5) * 1e-4
+
+        name = os.path.basename(self.tmpdir) + '.live'
+        try:
+            roach.set_live_export(name, 3)
+            roach.set_averaging(2)
+            writer = pc.LiveWriter(roach, roach.plan,
+                                   pc.NumpyWriter(roach, roach.plan))
+            writer.open()
+            reader = pc.LiveReader(name)
+            self.assertEqual(reader.header['baselines'],
+                             list(roach.plan.baselines))
+
+            # Integrations are published before they are averaged.
+            self.assertEqual(reader.header['inttime'], roach.int_time)
+            self.assertEqual(reader.wait(0, timeout=0, interval=0), None)
+            for i, vis in enumerate(stream):
+                writer.write(jd[i], vis)
+
+            # Only the latest integrations are kept, without the DC offset.
+            self.assertEqual(reader.wait(0), 5)
+            jd_live, vis_live = reader.get_latest(4)
+            self.assertTrue(np.array_equal(jd_live, jd[2:]))
+            for vis, vis_expected in zip(vis_live, stream[2:]):
+                vis_expected = vis_expected.copy()
+                vis_expected[:, roach.get_dc_chans()] = 0
+                self.assertTrue(np.array_equal(vis, vis_expected))
+
+            writer.close()
+            self.assertFalse(os.path.exists(pc.get_live_path(name)))
+        finally:
+            if os.path.exists(pc.get_live_path(name)):
+                os.remove(pc.get_live_path(name))
+
+    def test_send_file(self):
+        data = os.urandom(50000)
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as fileobj:
+                fileobj.write(data)
+
+            # Both ways of sending must send the same part of the file.
+            for zero_copy in [True, False]:
+                sender, receiver = socket.socketpair()
+                nsent = pc.send_file(sender, filename, 1000, 40000, zero_copy)
+                sender.close()
+                received = ''
+                while True:
+                    chunk = receiver.recv(1 << 16)
+                    if not chunk:
+                        break
+                    received += chunk
+                receiver.close()
+                self.assertEqual(nsent, 40000)
+                self.assertEqual(received, data[1000:41000])
+
+            # Compressed data comes in frames with their length in front.
+            sender, receiver = socket.socketpair()
+            nsent = pc.send_file(sender, filename, 1000, 40000, level=1)
+            sender.close()
+            received = ''
+            while True:
+                chunk = receiver.recv(1 << 16)
+                if not chunk:
+                    break
+                received += chunk
+            receiver.close()
+            decompressor = zlib.decompressobj()
+            decompressed = ''
+            while received:
+                nframe, = struct.unpack('<I', received[:4])
+                decompressed += decompressor.decompress(received[4:4+nframe])
+                received = received[4+nframe:]
+            self.assertEqual(nsent, 40000)
+            self.assertEqual(decompressed, data[1000:41000])
+
+            # Checksums of the blocks are computed as they are sent.
+            sender, receiver = socket.socketpair()
+            checksums = []
+            pc.send_file(sender, filename, 1000, 40000, checksums=checksums,
+                         block=30000)
+            sender.close()
+            receiver.close()
+            self.assertEqual(checksums,
+                             [zlib.crc32(data[1000:31000]) & 0xffffffff,
+                              zlib.crc32(data[31000:41000]) & 0xffffffff])
+
+            sender, receiver = socket.socketpair()
+            with self.assertRaises(IOError):
+                pc.send_file(sender, filename, 40000, 20000)
+            sender.close()
+            receiver.close()
+        finally:
+            os.remove(filename)
+
+    def readout(self, src, dst, nstreams=2):
+        """
+        Read out a directory over the loopback interface.
+        """
+        rx = imp.load_source('pocketcorr_rx',
+                             os.path.join(SCRIPTS, 'pocketcorr_rx.py'))
+        shell = imp.load_source('pocketcorr_shell',
+                                os.path.join(SCRIPTS, 'pocketcorr_shell.py'))
+        messenger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client = shell.POCOserver(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind(('127.0.0.1', 0))
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        server = threading.Thread(target=rx.ctrl_readout,
+                                  args=(src, messenger, client.getsockname(),
+                                        port, nstreams))
+        server.start()
+        try:
+            client.client_readout(dst, ('127.0.0.1', port), nstreams)
+        finally:
+            server.join()
+        message = client.recvfrom(1024)[0]
+        messenger.close()
+        client.close()
+        return message
+
+    def test_readout(self):
+        src = os.path.join(self.tmpdir, 'src')
+        dst = os.path.join(self.tmpdir, 'dst')
+        os.mkdir(src)
+        os.mkdir(dst)
+        os.mkdir(os.path.join(src, 'test.uv'))
+        files = {os.path.join('test.uv', 'visdata'): os.urandom(20000),
+                 os.path.join('test.uv', 'header'): os.urandom(100),
+                 'test.pcz': os.urandom(10000),
+                 'test.journal': '\0' * 30000}
+        for name, data in files.items():
+            with open(os.path.join(src, name), 'wb') as fileobj:
+                fileobj.write(data)
+
+        def check_copy():
+            for name, data in files.items():
+                with open(os.path.join(dst, name), 'rb') as fileobj:
+                    self.assertEqual(fileobj.read(), data)
+
+        sent = []
+        block = pc.MANIFEST_BLOCK
+        send_file = pc.send_file
+        get_transfer_level = pc.get_transfer_level
+        def record_send(tcpsocket, filename, offset=0, nbytes=None,
+                        *args, **kwargs):
+            sent.append((os.path.relpath(filename, src), offset, nbytes,
+                         kwargs.get('level', 0)))
+            return send_file(tcpsocket, filename, offset, nbytes,
+                             *args, **kwargs)
+        pc.MANIFEST_BLOCK = 4096
+        pc.send_file = record_send
+        try:
+            self.assertEqual(self.readout(src, dst), 'Done.')
+            check_copy()
+
+            # A resumed readout only sends the block that changed.
+            del sent[:]
+            path = os.path.join(src, 'test.pcz')
+            data = files['test.pcz']
+            files['test.pcz'] = data[:4096] + os.urandom(4096) + data[8192:]
+            mtime = os.stat(path).st_mtime
+            with open(path, 'r+b') as fileobj:
+                fileobj.write(files['test.pcz'])
+            os.utime(path, (mtime + 10, mtime + 10))
+            self.assertEqual(self.readout(src, dst), 'Done.')
+            self.assertEqual(sent, [('test.pcz', 4096, 4096, 0)])
+            check_copy()
+
+            # Compressed files come out the same.
+            del sent[:]
+            shutil.rmtree(dst)
+            os.mkdir(dst)
+            pc.get_transfer_level = lambda sample, link_rate: 6
+            self.assertEqual(self.readout(src, dst), 'Done.')
+            self.assertEqual(len(sent), len(files))
+            self.assertTrue(all(level == 6 for _, _, _, level in sent))
+            check_copy()
+        finally:
+            pc.MANIFEST_BLOCK = block
+            pc.send_file = send_file
+            pc.get_transfer_level = get_transfer_level
+
+    def test_manifest(self):
+        uvfile = os.path.join(self.tmpdir, 'test.uv')
+        journal = os.path.join(self.tmpdir, 'test.journal')
+        os.mkdir(uvfile)
+        data = os.urandom(pc.MANIFEST_BLOCK + 1000)
+        with open(os.path.join(uvfile, 'visdata'), 'wb') as fileobj:
+            fileobj.write(data)
+        with open(journal, 'wb') as fileobj:
+            fileobj.write(data[:1000])
+        checksums = [zlib.crc32(data[:pc.MANIFEST_BLOCK]) & 0xffffffff,
+                     zlib.crc32(data[pc.MANIFEST_BLOCK:]) & 0xffffffff]
+        path = os.path.join(uvfile, 'visdata')
+        self.assertEqual(pc.get_checksums(path), checksums)
+        self.assertEqual(pc.get_checksums(path, nblocks=1), checksums[:1])
+
+        # The manifest only has the sizes and times of the components.
+        manifest = pc.get_manifest([uvfile, journal])
+        self.assertTrue(manifest['test.uv']['isdir'])
+        self.assertFalse(manifest['test.journal']['isdir'])
+        mtime = os.stat(path).st_mtime
+        self.assertEqual(manifest['test.uv']['components'],
+                         [('visdata', len(data), mtime)])
+        mtime = os.stat(journal).st_mtime
+        self.assertEqual(manifest['test.journal']['components'],
+                         [('', 1000, mtime)])
+
+        # Cached checksums are only used while the file hasn't changed, and
+        # the files that are gone are forgotten when they are saved.
+        cache_file = os.path.join(self.tmpdir, pc.MANIFEST_FILE)
+        cache = pc.ChecksumCache(cache_file)
+        cache.put(journal, 1000, mtime, [0])
+        cache.put(os.path.join(self.tmpdir, 'gone'), 1000, mtime, [0])
+        cache.save()
+        cache = pc.ChecksumCache(cache_file)
+        self.assertEqual(cache.get(journal, 1000, mtime), [0])
+        self.assertIsNone(cache.get(journal, 1000, mtime + 1))
+        self.assertIsNone(cache.get(os.path.join(self.tmpdir, 'gone'),
+                                    1000, mtime))
+
+    def test_rate_limiter(self):
+        # Sends wait for their share of the rate, but not without one.
+        limiter = pc.RateLimiter()
+        start = time.time()
+        limiter.wait(1 << 30)
+        self.assertLess(time.time() - start, 0.05)
+        limiter.rate = 1 << 20
+        start = time.time()
+        for i in range(3):
+            limiter.wait(1 << 17)
+        self.assertGreater(time.time() - start, 0.2)
+
+        # A function for the rate is asked for it on every send.
+        rates = [1 << 20]
+        limiter = pc.RateLimiter(lambda: rates[-1])
+        start = time.time()
+        for i in range(3):
+            limiter.wait(1 << 17)
+        self.assertGreater(time.time() - start, 0.2)
+        rates.append(0)
+        start = time.time()
+        limiter.wait(1 << 30)
+        self.assertLess(time.time() - start, 0.05)
+
+    def test_transfer_level(self):
+        # Data that doesn't compress is never worth compressing, and data
+        # that does is worth compressing over a slow enough link.
+        noise = os.urandom(pc.TRANSFER_SAMPLE)
+        zeros = '\0' * pc.TRANSFER_SAMPLE
+        self.assertEqual(pc.get_transfer_level(noise, 1e3), 0)
+        self.assertEqual(pc.get_transfer_level(zeros, 1e12), 0)
+        self.assertIn(pc.get_transfer_level(zeros, 1e3), pc.TRANSFER_LEVELS)
+
     def test_scheduler(self):
         # not much to do here but check failure cases
         with self.assertRaises(ValueError):